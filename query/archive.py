@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+"""
+Archives for query exports: zip, tar.gz and (if python-zstandard is
+installed) tar.zst.
+
+Compression runs on a pool of threads, as zlib and zstd release the GIL while
+compressing. Zip members are compressed independently; large members and tar
+streams are compressed in independent blocks (as pigz does), which are
+written in order. Every archive logs its compression throughput when closed.
+"""
+import logging
+import os
+import struct
+import tarfile
+import time
+import zipfile
+import zlib
+from collections import OrderedDict, deque
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 1024 * 1024
+
+# Maximum number of blocks (or members) per worker waiting to be written
+_PENDING_PER_WORKER = 4
+
+
+def deflate_block(data, level, last=False):
+    """Returns data as raw deflate data. Unless last, the data is not
+    terminated but ends on a byte boundary, so that it can be followed by
+    the next block.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def zstd_block(data, level, last=False):
+    """Returns data as a zstd frame (a zstd file can consist of several frames)."""
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def compress_member(data, level):
+    """Returns the CRC-32 and the raw deflate data of a zip member."""
+    return zlib.crc32(data) & 0xffffffff, deflate_block(data, level, last=True)
+
+
+class OrderedPool(object):
+    """Runs functions on a pool of threads, and calls their callbacks with
+    their results in the order of submission (in the calling thread).
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.pool = ThreadPool(workers) if workers > 1 else None
+        self.pending = deque()
+        self.busy = 0.0     # seconds spent in the functions
+
+    def _timed(self, function, args):
+        start = time.time()
+        result = function(*args)
+        return result, time.time() - start
+
+    def _done(self, result, callback):
+        result, elapsed = result
+        self.busy += elapsed
+        callback(result)
+
+    def submit(self, function, args, callback):
+        if self.pool is None:
+            self._done(self._timed(function, args), callback)
+            return
+
+        self.pending.append((self.pool.apply_async(self._timed, (function, args)), callback))
+        while self.pending and (self.pending[0][0].ready() or
+                                len(self.pending) > self.workers * _PENDING_PER_WORKER):
+            result, callback = self.pending.popleft()
+            self._done(result.get(), callback)
+
+    def flush(self):
+        while self.pending:
+            result, callback = self.pending.popleft()
+            self._done(result.get(), callback)
+
+    def close(self):
+        self.flush()
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+
+
+class BlockStream(object):
+    """Writable file-like object that compresses the data written to it in
+    blocks on a pool, and writes the compressed blocks in order to out.
+
+    compress_block(data, last) returns a compressed block; last is True for
+    the final block.
+    """
+
+    def __init__(self, out, pool, compress_block, block_size=BLOCK_SIZE):
+        self.out = out
+        self.pool = pool
+        self.compress_block = compress_block
+        self.block_size = block_size
+        self.buffer = []
+        self.buffered = 0
+        self.crc = 0
+        self.size = 0
+        self.compressed_size = 0
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            self._submit(last=False)
+
+    def _submit(self, last):
+        data = ''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        self.pool.submit(partial(self.compress_block, last=last), (data, ), self._write_block)
+
+    def _write_block(self, block):
+        self.out.write(block)
+        self.compressed_size += len(block)
+
+    def close(self):
+        """Compresses the remaining data and waits until all blocks are written."""
+        self._submit(last=True)
+        self.pool.flush()
+
+
+class Archive(object):
+    """An archive that is written to pathname, with the members written by
+    writestr (from a string) or write (from a file).
+
+    Parameters:
+        pathname : str
+            The path of the archive
+        level : int, optional
+            The compression level
+        workers : int, optional
+            The number of threads that compress
+    """
+    extension = None
+    content_type = None
+
+    def __init__(self, pathname, level=6, workers=1, block_size=BLOCK_SIZE):
+        self.pathname = pathname
+        self.level = level
+        self.workers = workers
+        self.block_size = block_size
+        self.pool = OrderedPool(workers)
+        self.uncompressed = 0
+
+    def writestr(self, name, data):
+        raise NotImplementedError
+
+    def write(self, pathname, name):
+        raise NotImplementedError
+
+    def close(self):
+        self.pool.close()
+        self.log()
+
+    def log(self):
+        mb = 1024.0 * 1024.0
+        compressed = os.path.getsize(self.pathname)
+        logger.debug('%s: compressed %.1f MB to %.1f MB (%.0f%%) in %.2f s of compression, %.1f MB/s per worker '
+                     '(%s, level %d, %d workers)',
+                     os.path.basename(self.pathname), self.uncompressed / mb, compressed / mb,
+                     100.0 * compressed / self.uncompressed if self.uncompressed else 100.0, self.pool.busy,
+                     self.uncompressed / mb / self.pool.busy if self.pool.busy else 0.0,
+                     self.extension, self.level, self.workers)
+
+
+class ZipArchive(Archive):
+    """A zip archive (with deflated members), e.g. for Windows users."""
+    extension = 'zip'
+    content_type = 'application/zip'
+
+    def __init__(self, pathname, level=6, workers=1, block_size=BLOCK_SIZE):
+        super(ZipArchive, self).__init__(pathname, level, workers, block_size)
+        self.zip_file = zipfile.ZipFile(pathname, mode='w', compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+
+    def writestr(self, name, data):
+        self.uncompressed += len(data)
+        self.pool.submit(compress_member, (data, self.level), partial(self._write_member, name, len(data)))
+
+    def _start_member(self, zinfo, zip64):
+        """Writes the header of a member (as zipfile.ZipFile.writestr does)."""
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo.header_offset = self.zip_file.fp.tell()
+        self.zip_file._writecheck(zinfo)
+        self.zip_file._didModify = True
+        self.zip_file.fp.write(zinfo.FileHeader(zip64))
+
+    def _end_member(self, zinfo):
+        self.zip_file.filelist.append(zinfo)
+        self.zip_file.NameToInfo[zinfo.filename] = zinfo
+
+    def _write_member(self, name, size, result):
+        crc, data = result
+        zinfo = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+        zinfo.external_attr = 0600 << 16
+        zinfo.file_size = size
+        zinfo.compress_size = len(data)
+        zinfo.CRC = crc
+        self._start_member(zinfo, zinfo.file_size > zipfile.ZIP64_LIMIT or
+                           zinfo.compress_size > zipfile.ZIP64_LIMIT)
+        self.zip_file.fp.write(data)
+        self._end_member(zinfo)
+
+    def write(self, pathname, name):
+        """Adds a (large) file, compressed in blocks (as zipfile.ZipFile.write does for a whole file)."""
+        self.pool.flush()
+
+        st = os.stat(pathname)
+        zinfo = zipfile.ZipInfo(name, time.localtime(st.st_mtime)[:6])
+        zinfo.external_attr = (st.st_mode & 0xFFFF) << 16L
+        zinfo.file_size = st.st_size
+        zinfo.CRC = zinfo.compress_size = 0
+        zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+        self._start_member(zinfo, zip64)
+
+        stream = BlockStream(self.zip_file.fp, self.pool, partial(deflate_block, level=self.level),
+                             self.block_size)
+        with open(pathname, 'rb') as f:
+            for data in iter(lambda: f.read(self.block_size), ''):
+                stream.write(data)
+        stream.close()
+        self.uncompressed += stream.size
+
+        # Rewrite the header with the CRC and the sizes
+        zinfo.CRC = stream.crc & 0xffffffff
+        zinfo.compress_size = stream.compressed_size
+        position = self.zip_file.fp.tell()
+        self.zip_file.fp.seek(zinfo.header_offset, 0)
+        self.zip_file.fp.write(zinfo.FileHeader(zip64))
+        self.zip_file.fp.seek(position, 0)
+        self._end_member(zinfo)
+
+    def close(self):
+        self.pool.flush()
+        self.zip_file.close()
+        super(ZipArchive, self).close()
+
+
+class TarArchive(Archive):
+    """A tar archive, compressed as a whole by the stream of open_stream."""
+
+    def __init__(self, pathname, level=6, workers=1, block_size=BLOCK_SIZE):
+        super(TarArchive, self).__init__(pathname, level, workers, block_size)
+        self.file = open(pathname, 'wb')
+        self.stream = self.open_stream(self.file)
+        self.tar = tarfile.open(mode='w|', fileobj=self.stream)
+
+    def open_stream(self, out):
+        raise NotImplementedError
+
+    def writestr(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = time.time()
+        info.mode = 0600
+        self.tar.addfile(info, StringIO(data))
+        self.uncompressed += len(data)
+
+    def write(self, pathname, name):
+        self.tar.add(pathname, arcname=name)
+        self.uncompressed += os.path.getsize(pathname)
+
+    def close(self):
+        self.tar.close()
+        self.stream.close()
+        self.file.close()
+        super(TarArchive, self).close()
+
+
+class GzipStream(BlockStream):
+    """Writes a gzip file with the blocks of a BlockStream as its deflate data."""
+
+    def __init__(self, out, pool, level, block_size=BLOCK_SIZE):
+        super(GzipStream, self).__init__(out, pool, partial(deflate_block, level=level), block_size)
+        # Magic number, deflate, no flags, modification time, no extra flags, unknown OS
+        out.write('\037\213\010\000' + struct.pack('<L', int(time.time())) + '\000\377')
+
+    def close(self):
+        super(GzipStream, self).close()
+        self.out.write(struct.pack('<LL', self.crc & 0xffffffff, self.size & 0xffffffff))
+
+
+class TarGzArchive(TarArchive):
+    """A gzipped tar archive."""
+    extension = 'tar.gz'
+    content_type = 'application/gzip'
+
+    def open_stream(self, out):
+        return GzipStream(out, self.pool, self.level, self.block_size)
+
+
+class TarZstArchive(TarArchive):
+    """A tar archive compressed with zstd (a frame per block)."""
+    extension = 'tar.zst'
+    content_type = 'application/zstd'
+
+    def open_stream(self, out):
+        if zstandard is None:
+            raise ValueError('tar.zst archives require python-zstandard')
+        return BlockStream(out, self.pool, partial(zstd_block, level=self.level), self.block_size)
+
+
+# Archive classes by format
+ARCHIVE_FORMATS = OrderedDict((cls.extension, cls) for cls in (ZipArchive, TarGzArchive, TarZstArchive))
+
+
+def available_archive_formats():
+    """Returns the archive formats that can be created."""
+    return [f for f in ARCHIVE_FORMATS if f != TarZstArchive.extension or zstandard is not None]
+
+
+def archive_format(filename):
+    """Returns the archive format of a filename, or None if it has none."""
+    for extension in ARCHIVE_FORMATS:
+        if filename.endswith('.' + extension):
+            return extension
+    return None
@@ -54,8 +54,8 @@ def execute(query, req_dict, zip_basename, to_email, email_message):
     if settings.DEBUG:
         print 'Calling zipquerydata\n'
 
-    zipquerydata(req_base64)
-    msg = 'management/download/'  # - Celery task id: {}'.format(task.id)
+    task = zipquerydata.delay(req_base64)
+    msg = 'management/download/ - Celery task id: {}'.format(task.id)
     logger.info(msg)
     return msg
 
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare inverse document frequencies computed from termvectors with those
+computed from terms aggregations (see gathertermcounts --method).
+"""
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from query.models import Term
+from query.management.commands.gathertermcounts import TIMEFRAMES, timeframe_parameters, \
+    termvector_document_frequencies, aggregation_document_frequencies, compute_idf
+
+
+def idf_drift(reference, candidate):
+    """
+    Returns statistics on the difference between two dictionaries that map terms to IDFs.
+    Only terms present in both dictionaries are compared.
+    """
+    common = set(reference) & set(candidate)
+    diffs = sorted((abs(reference[t] - candidate[t]), t) for t in common)
+
+    result = {
+        'common': len(common),
+        'only_reference': len(set(reference) - common),
+        'only_candidate': len(set(candidate) - common),
+        'mean': 0.0,
+        'p95': 0.0,
+        'max': 0.0,
+        'largest': [],
+    }
+    if diffs:
+        result['mean'] = sum(d for d, _ in diffs) / len(diffs)
+        result['p95'] = diffs[min(len(diffs) - 1, int(0.95 * len(diffs)))][0]
+        result['max'] = diffs[-1][0]
+        result['largest'] = [(t, reference[t], candidate[t]) for _, t in reversed(diffs[-10:])]
+
+    return result
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Reports the drift between IDFs computed from termvectors (the reference) and IDFs computed ' \
+           'from terms aggregations. Make sure ElasticSearch is running!'
+    option_list = BaseCommand.option_list + (
+        make_option('--stored',
+                    action='store_true',
+                    dest='stored',
+                    default=False,
+                    help='Use the IDFs in the Term table as reference instead of recomputing them from termvectors'),
+        make_option('--num-terms',
+                    dest='num_terms',
+                    type='int',
+                    default=100000,
+                    help='Maximum number of terms per timeframe for the aggregation method'),
+        make_option('--timeframe',
+                    dest='timeframes',
+                    action='append',
+                    help='Only compare this timeframe (can be repeated)'),
+    )
+
+    def handle(self, *args, **options):
+        timeframes = options['timeframes'] or TIMEFRAMES.keys()
+        for timeframe in timeframes:
+            if timeframe not in TIMEFRAMES:
+                raise CommandError('Unknown timeframe "{}"'.format(timeframe))
+
+        for timeframe in timeframes:
+            print 'Timeframe {}'.format(timeframe)
+            date_range, exclude_dist, total_documents = timeframe_parameters(timeframe)
+
+            if options['stored']:
+                reference = {w: float(idf) for w, idf in
+                             Term.objects.filter(timeframe=timeframe).values_list('word', 'idf')}
+            else:
+                counter = termvector_document_frequencies(date_range, exclude_dist, verbose=False)
+                reference = {t: compute_idf(total_documents, c) for t, c in counter.items() if c > 1}
+
+            counter = aggregation_document_frequencies(date_range, exclude_dist, options['num_terms'])
+            candidate = {t: compute_idf(total_documents, c) for t, c in counter.items() if c > 1}
+
+            drift = idf_drift(reference, candidate)
+            print '  terms compared: {}'.format(drift['common'])
+            print '  only in reference: {}, only in aggregation: {}'.format(drift['only_reference'],
+                                                                           drift['only_candidate'])
+            print '  absolute IDF drift: mean {:.4f}, p95 {:.4f}, max {:.4f}'.format(drift['mean'],
+                                                                                    drift['p95'],
+                                                                                    drift['max'])
+            for term, ref, cand in drift['largest']:
+                print u'    {}: {:.4f} vs. {:.4f}'.format(term, ref, cand)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Precompute the stemmed forms of the Term vocabulary, so most stem lookups
+(see services.views.stemmed_form) do not need ElasticSearch.
+"""
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from query.models import Term, Stem
+from services.es import analyze_words, STEMMING_ANALYZER
+from texcavator.utils import chunks
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Stores the stemmed forms of all words in the Term table. ' \
+           'Make sure ElasticSearch is running!'
+    option_list = BaseCommand.option_list + (
+        make_option('--analyzer',
+                    dest='analyzer',
+                    default=STEMMING_ANALYZER,
+                    help='The analyzer used for stemming'),
+        make_option('--chunk-size',
+                    dest='chunk_size',
+                    type='int',
+                    default=1000,
+                    help='Number of words per _analyze request'),
+    )
+
+    def handle(self, *args, **options):
+        analyzer = options['analyzer']
+
+        print 'Emptying table...'
+        Stem.objects.filter(analyzer=analyzer).delete()
+
+        words = sorted(set(Term.objects.values_list('word', flat=True)))
+        print 'Stemming {} words...'.format(len(words))
+
+        for i, chunk in enumerate(chunks(words, options['chunk_size'])):
+            stems = analyze_words(settings.ES_INDEX, chunk, analyzer)
+            Stem.objects.bulk_create([Stem(analyzer=analyzer, word=w, stem=s) for w, s in stems.iteritems()])
+            print 'Stemmed {} words'.format(min((i + 1) * options['chunk_size'], len(words)))
+
+        print 'Done.'
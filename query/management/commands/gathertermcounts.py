@@ -1,19 +1,97 @@
 import math
-import os
 import time
 from collections import Counter
+from optparse import make_option
 
-import dawg
-
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 
 from query.models import Distribution, Term
-from services.es import count_search_results, document_id_chunks, termvector_wordcloud
+from services.es import count_search_results, document_id_chunks, termvector_wordcloud, \
+    term_document_frequencies
+from texcavator.idf import write_idf_store, idf_store_path
 from texcavator.utils import daterange2dates
 
 TIMEFRAMES = {'pre': '19000101,19400515', 'WWII': '19400516,19450508', 'post': '19450509,19901231'}
 
+METHOD_TERMVECTORS = 'termvectors'
+METHOD_AGGREGATION = 'aggregation'
+METHODS = (METHOD_TERMVECTORS, METHOD_AGGREGATION)
+
+
+def timeframe_parameters(timeframe):
+    """
+    Returns the date range, the excluded distributions and the total number of documents for a timeframe.
+    """
+    exclude_dist = list(Distribution.objects.exclude(name='Landelijk').values_list('id', flat=True))
+    date_range = daterange2dates(TIMEFRAMES[timeframe])
+
+    total_documents = count_search_results(settings.ES_INDEX,
+                                           settings.ES_DOCTYPE,
+                                           None,
+                                           date_range,
+                                           exclude_dist, [], []).get('count')
+
+    return date_range, exclude_dist, total_documents
+
+
+def termvector_document_frequencies(date_range, exclude_dist, verbose=True):
+    """
+    Returns the document frequencies per term by merging the termvectors of all documents.
+    """
+    sets = document_id_chunks(10000,
+                              settings.ES_INDEX,
+                              settings.ES_DOCTYPE,
+                              None,
+                              date_range,
+                              dist=exclude_dist)
+
+    counter = Counter()
+    for n, s in enumerate(sets):
+        start_time = time.time()
+        counter += termvector_wordcloud(settings.ES_INDEX,
+                                        settings.ES_DOCTYPE,
+                                        s,
+                                        min_length=2,
+                                        add_freqs=False)
+        if verbose:
+            print 'Completed set {} in {} seconds...'.format(n + 1, time.time() - start_time)
+
+    return counter
+
+
+def aggregation_document_frequencies(date_range, exclude_dist, num_terms):
+    """
+    Returns the document frequencies per term from a terms aggregation in ElasticSearch.
+    """
+    counter = term_document_frequencies(settings.ES_INDEX,
+                                        settings.ES_DOCTYPE,
+                                        date_range,
+                                        exclude_dist,
+                                        num_terms=num_terms)
+
+    # Apply the same minimal word length as the termvector method
+    for term in [t for t in counter if len(t) < 2]:
+        del counter[term]
+
+    return counter
+
+
+def document_frequencies(method, date_range, exclude_dist, num_terms):
+    """
+    Returns the document frequencies per term, using the given method.
+    """
+    if method == METHOD_AGGREGATION:
+        return aggregation_document_frequencies(date_range, exclude_dist, num_terms)
+    return termvector_document_frequencies(date_range, exclude_dist)
+
+
+def compute_idf(total_documents, count):
+    """
+    Returns the inverse document frequency of a term.
+    """
+    return math.log10(total_documents / float(count))
+
 
 class Command(BaseCommand):
     """
@@ -22,66 +100,67 @@ class Command(BaseCommand):
     """
     args = ''
     help = 'Gather term counts in the complete index. Make sure ElasticSearch is running!'
+    option_list = BaseCommand.option_list + (
+        make_option('--method',
+                    dest='method',
+                    default=METHOD_TERMVECTORS,
+                    help='How to compute document frequencies: "termvectors" (exact, retrieves every document) '
+                         'or "aggregation" (terms aggregation in ElasticSearch, limited to --num-terms terms)'),
+        make_option('--num-terms',
+                    dest='num_terms',
+                    type='int',
+                    default=100000,
+                    help='Maximum number of terms per timeframe for the aggregation method'),
+        make_option('--timeframe',
+                    dest='timeframes',
+                    action='append',
+                    help='Only gather term counts for this timeframe (can be repeated)'),
+    )
 
     def handle(self, *args, **options):
+        method = options['method']
+        if method not in METHODS:
+            raise CommandError('Unknown method "{}", choose from: {}'.format(method, ', '.join(METHODS)))
+
+        timeframes = options['timeframes'] or TIMEFRAMES.keys()
+        for timeframe in timeframes:
+            if timeframe not in TIMEFRAMES:
+                raise CommandError('Unknown timeframe "{}"'.format(timeframe))
+
         print 'Emptying table...'
-        Term.objects.all().delete()
+        Term.objects.filter(timeframe__in=timeframes).delete()
 
-        for timeframe, dates in TIMEFRAMES.items():
+        for timeframe in timeframes:
             print 'Retrieving documents for timeframe {}...'.format(timeframe)
-            exclude_dist = Distribution.objects.exclude(name='Landelijk').values_list('id', flat=True)
-            date_range = daterange2dates(dates)
-
-            total_documents = count_search_results(settings.ES_INDEX,
-                                                   settings.ES_DOCTYPE,
-                                                   None,
-                                                   date_range,
-                                                   exclude_dist, [], []).get('count')
+            date_range, exclude_dist, total_documents = timeframe_parameters(timeframe)
             print 'Total documents: {}'.format(total_documents)
 
-            sets = document_id_chunks(10000,
-                                      settings.ES_INDEX,
-                                      settings.ES_DOCTYPE,
-                                      None,
-                                      date_range,
-                                      dist=exclude_dist)
-
-            print 'Counting terms...'
-            counter = Counter()
-            for n, s in enumerate(sets):
-                start_time = time.time()
-                counter += termvector_wordcloud(settings.ES_INDEX,
-                                                settings.ES_DOCTYPE,
-                                                s,
-                                                min_length=2,
-                                                add_freqs=False)
-                print 'Completed set {} in {} seconds...'.format(n + 1, time.time() - start_time)
+            print 'Counting terms using {}...'.format(method)
+            start_time = time.time()
+            counter = document_frequencies(method, date_range, exclude_dist, options['num_terms'])
+            print 'Counted {} terms in {} seconds'.format(len(counter), time.time() - start_time)
 
             print 'Calculating IDFs...'
             terms = []
             for term, count in counter.items():
                 if count > 1:  # don't add single occurrences
-                    idf = math.log10(total_documents / float(count))
+                    idf = compute_idf(total_documents, count)
                     terms.append(Term(timeframe=timeframe, word=term, count=count, idf=idf))
 
             print 'Transferring to database...'
             Term.objects.bulk_create(terms, batch_size=10000)
 
-            print 'Creating RecordDAWG'
-            d = dawg.RecordDAWG('<d', zip([t.word for t in terms], [(t.idf,) for t in terms]))
-            d.save(os.path.join(settings.PROJECT_PARENT, timeframe + '.dawg'))
+            print 'Creating IDF store'
+            version = write_idf_store(idf_store_path(timeframe), [(t.word, t.idf) for t in terms])
+            print 'Written IDF store version {}'.format(version)
 
         """ Test code below.
-        print 'Testing DAWG'
+        print 'Testing IDF store'
         start_time = time.time()
-        d = dawg.RecordDAWG('<d')
-        d.load('pre.dawg')
+        store = get_idf_store('pre')
         text = 'dit is een test' # replace with something longer
         for word in text.lower().split(' '):
-            try:
-                print d[word][0][0]
-            except KeyError:
-                print 1
+            print store.get(word, 1)
         print 'Took: {}'.format(time.time() - start_time)
 
         print 'Testing database'
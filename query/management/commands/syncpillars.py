@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Store the newspapers per pillar in the pillar index (ES_PILLAR_INDEX).
+
+Afterwards, the index is kept up to date when Newspapers or Pillars change.
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from query.models import newspaper_classification
+from services.es import update_pillar_index
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Stores the newspapers per pillar in the pillar index. Make sure ElasticSearch is running!'
+
+    def handle(self, *args, **options):
+        if not getattr(settings, 'ES_PILLAR_INDEX', None):
+            raise CommandError('ES_PILLAR_INDEX is not set')
+
+        classification = newspaper_classification()
+        update_pillar_index(classification)
+        print 'Stored {} pillars in index {}.'.format(len(classification), settings.ES_PILLAR_INDEX)
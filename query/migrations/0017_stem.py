@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query', '0016_auto_20160203_1324'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Stem',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('analyzer', models.CharField(max_length=50)),
+                ('word', models.CharField(max_length=200)),
+                ('stem', models.CharField(max_length=200)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='stem',
+            unique_together=set([('analyzer', 'word')]),
+        ),
+    ]
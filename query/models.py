@@ -1,11 +1,12 @@
 import json
-from collections import defaultdict
 
+from django.conf import settings
 from django.db import models
 from django.db.models import signals
 from django.contrib.auth.models import User
 
-from .tasks import write_newspaper_classification
+from .stopwords import invalidate_stopwords
+from .tasks import write_newspaper_classification, write_pillar_index
 
 
 class ArticleType(models.Model):
@@ -55,15 +56,23 @@ class Newspaper(models.Model):
         return self.title
 
 
-def update_newspaper_classification(sender, instance, created, **kwargs):
-    """Updates the newspaper classification to be used both in Django as well as Celery"""
-    classification = defaultdict(list)
+def newspaper_classification():
+    """Returns a dictionary that maps all pillar ids to lists of newspaper ids"""
+    classification = {pillar_id: [] for pillar_id in Pillar.objects.values_list('id', flat=True)}
     for newspaper in Newspaper.objects.all():
-        if newspaper.pillar:
-            classification[newspaper.pillar.id].append(newspaper.pk)
-    classification_json = json.dumps(classification)
+        if newspaper.pillar_id:
+            classification[newspaper.pillar_id].append(newspaper.pk)
+    return classification
+
+
+def update_newspaper_classification(sender, instance, created, **kwargs):
+    """Updates the newspaper classification to be used both in Django as well as Celery,
+    and in the pillar index (if ES_PILLAR_INDEX is set)"""
+    classification_json = json.dumps(newspaper_classification())
     write_newspaper_classification(classification_json)
     write_newspaper_classification.delay(classification_json)
+    if getattr(settings, 'ES_PILLAR_INDEX', None):
+        write_pillar_index.delay(classification_json)
 
 
 signals.post_save.connect(update_newspaper_classification, sender=Newspaper)
@@ -185,6 +194,10 @@ class StopWord(models.Model):
         }
 
 
+signals.post_save.connect(invalidate_stopwords, sender=StopWord)
+signals.post_delete.connect(invalidate_stopwords, sender=StopWord)
+
+
 class Term(models.Model):
     """Model to store frequencies and inverse document frequencies per term"""
     PRE_WWII = 'pre'
@@ -202,3 +215,16 @@ class Term(models.Model):
 
     class Meta:
         unique_together = (('timeframe', 'word'),)
+
+
+class Stem(models.Model):
+    """Model to store the stemmed forms of the Term vocabulary per analyzer (see the gatherstems command)"""
+    analyzer = models.CharField(max_length=50)
+    word = models.CharField(max_length=200)
+    stem = models.CharField(max_length=200)
+
+    class Meta:
+        unique_together = (('analyzer', 'word'),)
+
+    def __unicode__(self):
+        return u'{}: {}'.format(self.word, self.stem)
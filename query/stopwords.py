@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""Compiled stopword sets.
+
+The stopwords that apply to a word cloud (the default stopwords, the stopwords
+of a user and the stopwords of a query) are compiled into a single set. This
+set is stored in Redis under a key derived from its contents, so only this key
+has to be sent to Celery. Processes keep recently used sets in memory.
+
+Every change to a StopWord increases the version of its owner (a user, or the
+default stopwords), which invalidates the compiled sets of that owner.
+"""
+import hashlib
+import json
+import logging
+
+from django.conf import settings
+
+from redis import RedisError
+
+from texcavator.utils import redis_client, LRUCache
+
+STOPWORDS_KEY = 'texcavator:stopwords:{}'
+STOPWORDS_SCOPE_KEY = 'texcavator:stopwords:scope:{}:{}:{}:{}'
+STOPWORDS_VERSION_KEY = 'texcavator:stopwords:version:{}'
+STOPWORDS_TTL = 24 * 60 * 60
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_OWNER = 'default'
+
+_stopword_sets = LRUCache(getattr(settings, 'STOPWORDS_CACHE_SIZE', 100))
+
+
+def stopwords_key(words):
+    """
+    Returns the key of a set of stopwords, which only depends on its contents.
+    """
+    data = u'\n'.join(sorted(set(words))).encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+
+def compile_stopwords(user, query_id=None, use_default=False):
+    """
+    Compiles the stopwords of a user (and optionally a query and the default
+    stopwords) and returns the key of the resulting set.
+    The set itself can be retrieved via :func:`get_stopwords`.
+    """
+    redis = redis_client()
+    owners = [_DEFAULT_OWNER, user.pk]
+    versions = redis.mget([STOPWORDS_VERSION_KEY.format(o) for o in owners])
+    scope = STOPWORDS_SCOPE_KEY.format(user.pk, query_id or '', int(use_default),
+                                       '.'.join(v or '0' for v in versions))
+
+    # Reuse the compiled set if it is still present
+    key = redis.get(scope)
+    if key and redis.expire(STOPWORDS_KEY.format(key), STOPWORDS_TTL):
+        return key
+
+    words = _load_stopwords(user, query_id, use_default)
+    key = stopwords_key(words)
+
+    pipe = redis.pipeline()
+    pipe.set(STOPWORDS_KEY.format(key), json.dumps(sorted(words)), ex=STOPWORDS_TTL)
+    pipe.set(scope, key, ex=STOPWORDS_TTL)
+    pipe.execute()
+    _stopword_sets.set(key, words)
+
+    return key
+
+
+def _load_stopwords(user, query_id, use_default):
+    # Imported here, as query.models connects invalidate_stopwords
+    from query.models import StopWord
+
+    words = set(StopWord.objects
+                .filter(user=user)
+                .filter(query=None)
+                .values_list('word', flat=True))
+
+    if query_id:
+        words.update(StopWord.objects
+                     .filter(user=user)
+                     .filter(query__id=query_id)
+                     .values_list('word', flat=True))
+
+    if use_default:
+        words.update(StopWord.objects
+                     .filter(user=None)
+                     .filter(query=None)
+                     .values_list('word', flat=True))
+
+    return frozenset(words)
+
+
+def get_stopwords(key):
+    """
+    Returns the set of stopwords for a key returned by :func:`compile_stopwords`.
+    An empty key results in an empty set. Reading a set from Redis extends its
+    lifetime; raises KeyError if it has expired.
+    """
+    if not key:
+        return frozenset()
+
+    words = _stopword_sets.get(key)
+    if words is None:
+        pipe = redis_client().pipeline()
+        pipe.get(STOPWORDS_KEY.format(key))
+        pipe.expire(STOPWORDS_KEY.format(key), STOPWORDS_TTL)
+        data, _ = pipe.execute()
+        if data is None:
+            raise KeyError('Stopword set {} has expired'.format(key))
+        words = frozenset(json.loads(data))
+        _stopword_sets.set(key, words)
+
+    return words
+
+
+def invalidate_stopwords(sender, instance, **kwargs):
+    """
+    Invalidates the compiled stopword sets of the owner of a StopWord.
+    If Redis cannot be reached, the change is saved anyway; compiled sets then
+    expire after STOPWORDS_TTL.
+    """
+    owner = instance.user_id or _DEFAULT_OWNER
+    try:
+        redis_client().incr(STOPWORDS_VERSION_KEY.format(owner))
+    except RedisError:
+        logger.exception('Invalidating the stopwords of %s failed', owner)
@@ -1,27 +1,70 @@
 # -*- coding: utf-8 -*-
-"""Task for creating a zipfile of a set of documents (query export).
-Could in the future be implemented with Celery."""
+"""Task for creating an archive (zip or tar, see query.archive) of a set of documents (query export).
+The export runs as a Celery task on the bulk queue."""
 import base64
 import os
 import logging
 import json
 import csv
-import zipfile
+import re
 
 from celery import shared_task
 from math import ceil
 from time import time, localtime, strftime
 from sys import exc_info, stderr
-from dicttoxml import dicttoxml
+from StringIO import StringIO
+from xml.sax.saxutils import XMLGenerator
+from xml.sax.xmlreader import AttributesImpl
 
 from django.conf import settings
 from django.core.mail import send_mail
 from django.http import HttpResponse
 
-from services.es import do_search
+from services.es import do_search, update_pillar_index
+from .archive import ARCHIVE_FORMATS
 
 logger = logging.getLogger(__name__)
 
+# The fields of a KB document, in the order of the columns (csv) or elements (xml) of an export
+KB_FIELDS = ["identifier",                        # 2
+
+             "paper_dc_date",                    # 3
+             "paper_dc_identifier",                # 4
+             "paper_dc_identifier_resolver",        # 5
+             "paper_dc_language",                # 6
+             "paper_dc_title",                    # 7
+             "paper_dc_publisher",                # 8
+             "paper_dc_source",                    # 9
+
+             "paper_dcterms_alternative",         # 10
+             "paper_dcterms_isPartOf",            # 11
+             "paper_dcterms_isVersionOf",        # 12
+             "paper_dcterms_issued",                # 13
+             "paper_dcterms_spatial",            # 14
+             "paper_dcterms_spatial_creation",     # 15
+             "paper_dcterms_temporal",            # 16
+
+             "paper_dcx_issuenumber",   # 17 can contain '-' instead of a number
+             "paper_dcx_recordRights",              # 18
+             "paper_dcx_recordIdentifier",         # 19
+             "paper_dcx_volume",                    # 20
+
+             "paper_ddd_yearsDigitized",            # 21
+
+             "article_dc_identifier_resolver",    # 21
+             "article_dc_subject",                # 22
+             "article_dc_title",                    # 23
+             "article_dcterms_accessRights",        # 24
+             "article_dcx_recordIdentifier",        # 25
+
+             "text_content"]                        # 26
+
+# The fields of the simplified export
+SIMPLIFIED_FIELDS = ["article_dc_title", "text_content"]
+
+# Characters that are not allowed in XML 1.0 (e.g. control characters from OCR)
+_INVALID_XML_CHARS = re.compile(u'[^\u0009\u000a\u000d\u0020-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]')
+
 
 @shared_task
 def write_newspaper_classification(classification_json):
@@ -29,6 +72,12 @@ def write_newspaper_classification(classification_json):
         out.write(classification_json)
 
 
+@shared_task
+def write_pillar_index(classification_json):
+    update_pillar_index(json.loads(classification_json))
+
+
+@shared_task
 def zipquerydata(*args):
     t1 = time()
 
@@ -136,14 +185,14 @@ def create_zip(req_dict):
 
 
 def download_collect(req_dict, zip_basename, to_email, email_message):
-    """ Collect the documents and put them in a zipfile.
+    """ Collect the documents and put them in an archive (a zip file by default).
     """
     msg = "%s: %s" % (__name__, "download_collect()")
     logger.debug(msg)
     if settings.DEBUG:
         print >> stderr, msg
 
-    # download format: JSON or XML
+    # download format: JSON, JSON Lines, XML or CSV
     format = req_dict.get('format', 'json')
     if settings.DEBUG:
         print >> stderr, "format", format
@@ -156,19 +205,22 @@ def download_collect(req_dict, zip_basename, to_email, email_message):
     chunk_1_size = 1
     hits, resp_object = get_es_chunk(req_dict, start_record, chunk_1_size)
 
+    # archive format: zip, tar.gz or tar.zst
+    archive_class = ARCHIVE_FORMATS[req_dict.get('archive', 'zip')]
+
     zip_basedir = settings.QUERY_DATA_DOWNLOAD_PATH
-    zip_filename = zip_basename + ".zip"
+    zip_filename = zip_basename + "." + archive_class.extension
     zip_pathname = os.path.join(zip_basedir, zip_filename)
 
     logger.debug(zip_pathname)
     if settings.DEBUG:
         print >> stderr, zip_pathname
 
-    # create zipfile
+    # create archive
     try:
-        zip_file = zipfile.ZipFile(zip_pathname,
-                                   mode='w',
-                                   compression=zipfile.ZIP_DEFLATED)
+        zip_file = archive_class(zip_pathname,
+                                 level=getattr(settings, 'QUERY_DATA_COMPRESSION_LEVEL', 6),
+                                 workers=getattr(settings, 'QUERY_DATA_COMPRESSION_WORKERS', 1))
     except Exception as e:
         msg = "opening OCR file failed: {}".format(str(e))
         if settings.DEBUG:
@@ -205,6 +257,8 @@ def download_collect(req_dict, zip_basename, to_email, email_message):
             ctype = 'application/json; charset=UTF-8'
             return HttpResponse(json_list, content_type=ctype)
 
+    file_writer = export_writer(format, zip_basedir, zip_basename, getattr(settings, 'QUERY_DATA_SPLIT_MB', 0))
+
     for ichunk in range(nchunks):
         start_record = ichunk * chunk_size
         nchunk = ichunk + 1
@@ -217,16 +271,17 @@ def download_collect(req_dict, zip_basename, to_email, email_message):
 
         hits_list = hits["hits"]
         hits_zipped += len(hits_list)
-        zip_chunk(req_dict, ichunk, hits_list, zip_file, csv_writer, format)
+        zip_chunk(req_dict, ichunk, hits_list, zip_file, csv_writer or file_writer, format)
 
     if format == "csv":
         csv_file.close()
-        csv_file = open(csv_pathname, 'r')
-        zip_file.writestr(csv_filename, csv_file.read())
-        csv_file.close()
+        zip_file.write(csv_pathname, csv_filename)
         if settings.DEBUG:
             print >> stderr, "deleting %s" % csv_pathname
         os.remove(csv_pathname)     # not needed anymore
+    elif file_writer:
+        file_writer.close(zip_file)
+    zip_file.close()
 
     if settings.DEBUG:
         print >> stderr, "hits_zipped:", hits_zipped
@@ -253,6 +308,7 @@ def get_es_chunk(req_dict, start_record, chunk_size):
     if settings.DEBUG:
         print >> stderr, msg
 
+    source_include, source_exclude = export_source_fields(req_dict)
     validity, es_dict = do_search(settings.ES_INDEX,
                                   settings.ES_DOCTYPE,
                                   req_dict['query'],
@@ -262,15 +318,40 @@ def get_es_chunk(req_dict, start_record, chunk_size):
                                   req_dict['exclude_distributions'],
                                   req_dict['exclude_article_types'],
                                   req_dict['selected_pillars'],
-                                  True)
+                                  True,
+                                  source_include=source_include,
+                                  source_exclude=source_exclude)
 
     return es_dict['hits'], None
 
 
-def zip_chunk(req_dict, ichunk, hits_list, zip_file, csv_writer, format):
+def export_fields(req_dict):
+    """Returns the KB fields of an export in csv or xml format, or of a simplified export.
+    A metadata-only export does not include the text of the documents.
+    """
+    fields = SIMPLIFIED_FIELDS if req_dict.get('simplified', False) == "true" else KB_FIELDS
+    if req_dict.get('metadata_only', False) == "true":
+        fields = [f for f in fields if f != "text_content"]
+    return fields
+
+
+def export_source_fields(req_dict):
+    """Returns the fields of the _source to include and to exclude in the
+    search results of an export: only the fields that are exported.
+    """
+    if req_dict.get('simplified', False) == "true" or req_dict.get('format', 'json') in ("csv", "xml"):
+        return export_fields(req_dict), None
+    if req_dict.get('metadata_only', False) == "true":
+        return None, ["text_content"]
+    return None, None
+
+
+def zip_chunk(req_dict, ichunk, hits_list, zip_file, writer, format):
     """Zip a chunk of documents.
 
-    Documents are retrieved from elasticsearch in chunks.
+    Documents are retrieved from elasticsearch in chunks. The csv, jsonl and
+    xml formats are written to a single file by writer (a csv writer or an
+    ExportFileWriter), json to a zip member per document.
     """
     msg = "%s: %s" % (__name__, "zip_chunk()")
     logger.debug(msg)
@@ -282,6 +363,7 @@ def zip_chunk(req_dict, ichunk, hits_list, zip_file, csv_writer, format):
         return
 
     is_simplified = req_dict.get('simplified', False) == "true"
+    fields = export_fields(req_dict)
 
     for i, hit in enumerate(hits_list):
         # Use '-' instead of ':' in file names (Windows doesn't like colons in filenames)
@@ -289,27 +371,148 @@ def zip_chunk(req_dict, ichunk, hits_list, zip_file, csv_writer, format):
 
         # For the simplified export, only export the article title and full text
         if is_simplified:
-            hit = {c: hit["_source"][c] for c in ["article_dc_title", "text_content"]}
-
-        # Alternative export per format (xml, csv, json)
-        if format == "xml":
-            pseudo_filename += ".xml"
-            xml = dicttoxml(hit)
-            zip_file.writestr(pseudo_filename, xml)
-        elif format == "csv":
+            hit = {c: hit["_source"][c] for c in fields if c in hit["_source"]}
+
+        # Alternative export per format (csv, jsonl, xml, json)
+        if format == "csv":
             # By default, metadata is an empty cell
             metadata = ''
             if i == 0:
-                es_header_names, kb_header_names = hit2csv_header(csv_writer, ichunk, is_simplified)
+                es_header_names, kb_header_names = hit2csv_header(writer, ichunk, is_simplified, fields)
                 if ichunk == 0:
                     # Only on the first row of the first chunk, we set the metadata
                     metadata = hit2csv_metadata(req_dict)
-            hit2csv_data(csv_writer, hit, metadata, es_header_names, kb_header_names)
+            hit2csv_data(writer, hit, metadata, es_header_names, kb_header_names)
+        elif format in ("jsonl", "xml"):
+            writer.write(hit)
         else:         # "json"
             pseudo_filename += ".json"
             zip_file.writestr(pseudo_filename, json.dumps(hit))
 
 
+def export_writer(format, basedir, basename, split_mb=0):
+    """Returns the ExportFileWriter for a format, or None if the format has none."""
+    writers = {"jsonl": JSONLinesWriter, "xml": XMLWriter}
+    if format not in writers:
+        return None
+    return writers[format](basedir, basename, split_mb)
+
+
+class ExportFileWriter(object):
+    """Writes documents to a file, that is added to the zip file as a single
+    member.
+
+    If split_mb is given, a new file is started whenever the current file
+    would grow beyond split_mb megabytes.
+    """
+    extension = None
+
+    def __init__(self, basedir, basename, split_mb=0):
+        self.basedir = basedir
+        self.basename = basename
+        self.split_bytes = int(split_mb * 1024 * 1024)
+        self.filenames = []
+        self.file = None
+        self.size = 0
+        self.documents = 0
+
+    def header(self):
+        return ''
+
+    def footer(self):
+        return ''
+
+    def serialize(self, hit):
+        """Returns a document as a (byte) string."""
+        raise NotImplementedError
+
+    def _next_file(self):
+        if self.file:
+            self.file.write(self.footer())
+            self.file.close()
+        if self.split_bytes:
+            filename = '{}-{:03d}.{}'.format(self.basename, len(self.filenames) + 1, self.extension)
+        else:
+            filename = '{}.{}'.format(self.basename, self.extension)
+        self.filenames.append(filename)
+        self.file = open(os.path.join(self.basedir, filename), 'wb')
+        self.file.write(self.header())
+        self.size = len(self.header()) + len(self.footer())
+        self.documents = 0
+
+    def write(self, hit):
+        data = self.serialize(hit)
+        if self.file is None or (self.split_bytes and self.documents and
+                                 self.size + len(data) > self.split_bytes):
+            self._next_file()
+        self.file.write(data)
+        self.size += len(data)
+        self.documents += 1
+
+    def close(self, zip_file):
+        """Adds the file(s) to the zip file and deletes them."""
+        if self.file is None:
+            self._next_file()     # an export without documents still contains an (empty) file
+        self.file.write(self.footer())
+        self.file.close()
+        for filename in self.filenames:
+            pathname = os.path.join(self.basedir, filename)
+            zip_file.write(pathname, filename)
+            os.remove(pathname)
+
+
+class JSONLinesWriter(ExportFileWriter):
+    """Writes documents as JSON Lines (one JSON object per line)."""
+    extension = 'jsonl'
+
+    def serialize(self, hit):
+        return json.dumps(hit) + '\n'
+
+
+class XMLWriter(ExportFileWriter):
+    """Writes documents as XML, with a document element per hit, containing an
+    element per KB field (in the order of KB_FIELDS).
+    """
+    extension = 'xml'
+
+    def __init__(self, basedir, basename, split_mb=0):
+        super(XMLWriter, self).__init__(basedir, basename, split_mb)
+        self.buffer = StringIO()
+        self.generator = XMLGenerator(self.buffer, 'utf-8')
+        self.no_attributes = AttributesImpl({})
+
+    def header(self):
+        return '<?xml version="1.0" encoding="utf-8"?>\n<documents>\n'
+
+    def footer(self):
+        return '</documents>\n'
+
+    def serialize(self, hit):
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+        source = hit.get("_source", hit)
+        attributes = {}
+        if "_id" in hit:
+            attributes[u"id"] = hit["_id"]
+        if hit.get("_score") is not None:
+            attributes[u"score"] = unicode(hit["_score"])
+
+        self.generator.startElement(u"document", AttributesImpl(attributes))
+        for field in KB_FIELDS:
+            value = source.get(field)
+            if value is None:
+                continue
+            if not isinstance(value, basestring):
+                value = unicode(value)
+            self.generator.startElement(field, self.no_attributes)
+            self.generator.characters(_INVALID_XML_CHARS.sub(u'', value))
+            self.generator.endElement(field)
+        self.generator.endElement(u"document")
+        self.generator.ignorableWhitespace(u'\n')
+        return self.buffer.getvalue()
+
+
 def hit2csv_metadata(req_dict):
     """
     Returns the metadata in JSON format.
@@ -326,10 +529,11 @@ def hit2csv_metadata(req_dict):
     return json.dumps(result, ensure_ascii=False).encode('utf8')
 
 
-def hit2csv_header(csv_writer, ichunk, is_simplified):
+def hit2csv_header(csv_writer, ichunk, is_simplified, fields=None):
     """
     Returns the header row of the csv that is created.
     For the simplified export, only the article title and text content are included.
+    If given, fields are the KB fields of the header (see export_fields).
     """
     es_header_names = kb_header_names = []
     metadata_header_name = ["metadata"]
@@ -337,42 +541,12 @@ def hit2csv_header(csv_writer, ichunk, is_simplified):
     if not is_simplified:
         es_header_names = ["_id", "_score"]
 
-    if is_simplified:
-        kb_header_names = ["article_dc_title", "text_content"]
+    if fields is not None:
+        kb_header_names = list(fields)
+    elif is_simplified:
+        kb_header_names = list(SIMPLIFIED_FIELDS)
     else:
-        kb_header_names = \
-            ["identifier",                        # 2
-
-             "paper_dc_date",                    # 3
-             "paper_dc_identifier",                # 4
-             "paper_dc_identifier_resolver",        # 5
-             "paper_dc_language",                # 6
-             "paper_dc_title",                    # 7
-             "paper_dc_publisher",                # 8
-             "paper_dc_source",                    # 9
-
-             "paper_dcterms_alternative",         # 10
-             "paper_dcterms_isPartOf",            # 11
-             "paper_dcterms_isVersionOf",        # 12
-             "paper_dcterms_issued",                # 13
-             "paper_dcterms_spatial",            # 14
-             "paper_dcterms_spatial_creation",     # 15
-             "paper_dcterms_temporal",            # 16
-
-             "paper_dcx_issuenumber",   # 17 can contain '-' instead of a number
-             "paper_dcx_recordRights",              # 18
-             "paper_dcx_recordIdentifier",         # 19
-             "paper_dcx_volume",                    # 20
-
-             "paper_ddd_yearsDigitized",            # 21
-
-             "article_dc_identifier_resolver",    # 21
-             "article_dc_subject",                # 22
-             "article_dc_title",                    # 23
-             "article_dcterms_accessRights",        # 24
-             "article_dcx_recordIdentifier",        # 25
-
-             "text_content"]                        # 26
+        kb_header_names = list(KB_FIELDS)
 
     if ichunk == 0:
         csv_writer.writerow(metadata_header_name + es_header_names + kb_header_names)
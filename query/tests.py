@@ -1,6 +1,24 @@
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import zipfile
+from StringIO import StringIO
+from xml.etree import ElementTree
+
+from django.conf import settings
 from django.test import TestCase
 
 from .models import StopWord
+from .stopwords import stopwords_key, get_stopwords
+from .archive import ARCHIVE_FORMATS, available_archive_formats, archive_format
+from .tasks import zip_chunk, get_es_chunk, export_source_fields, JSONLinesWriter, XMLWriter, KB_FIELDS
+from services import es
+from services.corpus import generate_corpus
+from services.fake_es import FakeElasticsearch
+from texcavator.utils import daterange2dates
+from .management.commands.compareidf import idf_drift
 
 
 class SimpleTest(TestCase):
@@ -10,3 +28,137 @@ class SimpleTest(TestCase):
         s = StopWord(word='test')
         self.assertEqual(s.get_stopword_dict(), {'id': s.id, 'user': '', 'query': '', 'word': s.word})
 
+    def test_idf_drift(self):
+        """Tests the comparison of two IDF sets
+        """
+        drift = idf_drift({'a': 1.0, 'b': 2.0, 'c': 3.0}, {'a': 1.5, 'b': 2.0, 'd': 1.0})
+        self.assertEqual(drift['common'], 2)
+        self.assertEqual(drift['only_reference'], 1)
+        self.assertEqual(drift['only_candidate'], 1)
+        self.assertAlmostEqual(drift['mean'], 0.25)
+        self.assertAlmostEqual(drift['max'], 0.5)
+        self.assertEqual(drift['largest'][0], ('a', 1.0, 1.5))
+
+    def test_stopwords_key(self):
+        """Tests that the key of a stopword set only depends on its contents
+        """
+        self.assertEqual(stopwords_key([u'de', u'het']), stopwords_key([u'het', u'de', u'de']))
+        self.assertNotEqual(stopwords_key([u'de']), stopwords_key([u'de', u'het']))
+        self.assertEqual(get_stopwords(''), frozenset())
+
+    def test_invalidate_stopwords(self):
+        """Tests that stopwords can be saved and deleted if Redis cannot be reached
+        """
+        with self.settings(REDIS_URL='redis://localhost:1/0'):
+            s = StopWord.objects.create(word='test')
+            s.delete()
+
+    def test_jsonl_export(self):
+        """Tests that a JSON Lines export is written to a single zip member, or split in parts
+        """
+        hits = [{'_id': 'ddd:{}'.format(i), '_source': {'article_dc_title': 't', 'text_content': 'x' * 100,
+                                                          'paper_dc_date': '1900-01-01'}} for i in range(30)]
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            for split_mb, simplified in ((0, 'false'), (0.001, 'true')):
+                zip_file = zipfile.ZipFile(StringIO(), mode='w')
+                writer = JSONLinesWriter(tmp_dir, 'export', split_mb)
+                zip_chunk({'simplified': simplified}, 0, hits, zip_file, writer, 'jsonl')
+                writer.close(zip_file)
+                members = zip_file.namelist()
+                if split_mb:
+                    self.assertEqual(members[:2], ['export-001.jsonl', 'export-002.jsonl'])
+                    self.assertTrue(all(zip_file.getinfo(m).file_size <= 1048 for m in members))
+                else:
+                    self.assertEqual(members, ['export.jsonl'])
+                lines = ''.join(zip_file.read(m) for m in members).splitlines()
+                self.assertEqual(len(lines), 30)
+                self.assertEqual(json.loads(lines[0]), hits[0] if simplified == 'false' else
+                                 {'article_dc_title': 't', 'text_content': 'x' * 100})
+                self.assertEqual(os.listdir(tmp_dir), [])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_export_source_fields(self):
+        """Tests that only the exported fields are retrieved from ElasticSearch
+        """
+        self.assertEqual(export_source_fields({'format': 'json'}), (None, None))
+        self.assertEqual(export_source_fields({'format': 'jsonl', 'metadata_only': 'true'}), (None, ['text_content']))
+        self.assertEqual(export_source_fields({'format': 'csv'}), (KB_FIELDS, None))
+        self.assertEqual(export_source_fields({'format': 'json', 'simplified': 'true', 'metadata_only': 'true'}),
+                         (['article_dc_title'], None))
+
+        corpus = list(generate_corpus(50))
+        all_fields = set(corpus[0][1])
+        es._client = FakeElasticsearch.with_corpus(settings.ES_INDEX, settings.ES_DOCTYPE, corpus)
+        try:
+            for params, expected in (({'format': 'json'}, all_fields),
+                                     ({'format': 'xml', 'metadata_only': 'true'}, set(KB_FIELDS) - {'text_content'}),
+                                     ({'format': 'csv', 'simplified': 'true'}, {'article_dc_title', 'text_content'})):
+                req_dict = {'query': 'de', 'dates': daterange2dates(settings.TEXCAVATOR_DATE_RANGE),
+                            'exclude_distributions': [], 'exclude_article_types': [], 'selected_pillars': []}
+                req_dict.update(params)
+                hits, _ = get_es_chunk(req_dict, 0, 10)
+                self.assertTrue(hits['hits'])
+                for hit in hits['hits']:
+                    self.assertEqual(set(hit['_source']), expected & all_fields)
+        finally:
+            es._client = None
+
+    def test_xml_export(self):
+        """Tests that an XML export consists of well-formed files with the KB fields of the documents
+        """
+        hits = [{'_id': 'ddd:{}'.format(i), '_score': 1.5,
+                 '_source': {'text_content': u'Caf\xe9 <b> & \x0c', 'paper_dc_date': '1900-01-01', 'other': 'x'}}
+                for i in range(30)]
+        hits[1]['_source']['text_content'] = u'Smile \U0001f600\x01'
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            zip_file = zipfile.ZipFile(StringIO(), mode='w')
+            writer = XMLWriter(tmp_dir, 'export', 0.002)
+            zip_chunk({}, 0, hits, zip_file, writer, 'xml')
+            writer.close(zip_file)
+            self.assertGreater(len(zip_file.namelist()), 1)
+
+            documents = []
+            for member in zip_file.namelist():
+                documents.extend(ElementTree.fromstring(zip_file.read(member)).findall('document'))
+            self.assertEqual(len(documents), 30)
+            self.assertEqual(documents[0].get('id'), 'ddd:0')
+            self.assertEqual([e.tag for e in documents[0]], ['paper_dc_date', 'text_content'])
+            self.assertEqual(documents[0].find('text_content').text, u'Caf\xe9 <b> & ')
+            self.assertEqual(documents[1].find('text_content').text, u'Smile \U0001f600')
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_archives(self):
+        """Tests that archives compressed in parallel blocks contain all members
+        """
+        large = ''.join('line {} of a large member\n'.format(i) for i in range(5000))
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tmp_dir, 'large.txt'), 'wb') as f:
+                f.write(large)
+            for archive in available_archive_formats():
+                pathname = os.path.join(tmp_dir, 'export.' + archive)
+                self.assertEqual(archive_format(pathname), archive)
+                out = ARCHIVE_FORMATS[archive](pathname, level=1, workers=3, block_size=10000)
+                for i in range(20):
+                    out.writestr('doc{}.json'.format(i), json.dumps({'id': i}))
+                out.write(os.path.join(tmp_dir, 'large.txt'), 'large.txt')
+                out.close()
+
+                if archive == 'zip':
+                    members = zipfile.ZipFile(pathname)
+                    self.assertIsNone(members.testzip())
+                    read = members.read
+                elif archive == 'tar.gz':
+                    members = tarfile.open(pathname, 'r:gz')
+                    read = lambda name: members.extractfile(name).read()
+                else:
+                    continue
+                self.assertEqual(read('large.txt'), large)
+                self.assertEqual(json.loads(read('doc7.json')), {'id': 7})
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertIsNone(archive_format('export'))
@@ -23,6 +23,7 @@ from .models import Distribution, ArticleType, Query, DayStatistic, \
 from .utils import get_query_object, query2docidsdate, count_results
 from .burstsdetector import bursts
 from .download import create_zipname, execute
+from .archive import ARCHIVE_FORMATS, available_archive_formats, archive_format
 from services.es import get_search_parameters
 from texcavator.utils import json_response_message
 
@@ -380,9 +381,15 @@ def download_prepare(request):
             print >> stderr, msg
         return json_response_message('error', msg)
 
+    archive = request.REQUEST.get('archive', 'zip')
+    if archive not in available_archive_formats():
+        msg = "Archive format <b>" + archive + "</b> is not available. " + \
+              "Please choose one of: " + ", ".join(available_archive_formats())
+        return json_response_message('error', msg)
+
     zip_basename = create_zipname(user, query)
     url = urljoin('http://{}'.format(request.get_host()),
-                  "/query/download/" + quote_plus(zip_basename))
+                  "/query/download/" + quote_plus(zip_basename + "." + archive))
     email_message = "Texcavator query: " + query.title + "\n" + zip_basename + \
         "\nURL: " + url
     if settings.DEBUG:
@@ -393,7 +400,7 @@ def download_prepare(request):
     execute(query, dict(request.REQUEST), zip_basename, user.email, email_message)
 
     msg = "Your export for query <b>" + query.title + \
-          "</b> is completed.<br/>An e-mail with a download link has been sent " + \
+          "</b> is being prepared.<br/>An e-mail with a download link will be sent " + \
           "to <b>" + user.email + "</b>."
     return json_response_message('SUCCESS', msg)
 
@@ -406,7 +413,7 @@ def download_data(request, zip_name):
 
     Parameters:
         request: the default Django request
-        zip_name: the name of the zip to be downloaded
+        zip_name: the name of the archive to be downloaded (without extension for zip files)
 
     Returns:
         A HTTPResponse that will allow downloading of the zip file.
@@ -419,11 +426,16 @@ def download_data(request, zip_name):
     # TODO: use mod_xsendfile
     zip_basedir = os.path.join(settings.PROJECT_PARENT,
                                settings.QUERY_DATA_DOWNLOAD_PATH)
-    zip_filename = unquote_plus(zip_name) + ".zip"
+    zip_filename = unquote_plus(zip_name)
+    archive = archive_format(zip_filename)
+    if archive is None:
+        # Links to zip files do not always include the extension
+        archive = 'zip'
+        zip_filename += ".zip"
     zip_pathname = os.path.join(zip_basedir, zip_filename)
 
     wrapper = FileWrapper(open(zip_pathname, 'rb'))
-    response = HttpResponse(wrapper, content_type='application/zip')
+    response = HttpResponse(wrapper, content_type=ARCHIVE_FORMATS[archive].content_type)
     response['Content-Length'] = os.path.getsize(zip_pathname)
     response['Content-Disposition'] = "attachment; filename=%s" % zip_filename
 
@@ -0,0 +1,26 @@
+import json
+
+from django.contrib import admin
+from django.utils.html import escape
+from services.models import ProfileTrace
+
+
+class ProfileTraceAdmin(admin.ModelAdmin):
+    list_display = ('created', 'name', 'user', 'total_ms', 'es_ms', 'took_ms', 'python_ms', 'num_calls')
+    list_filter = ('name', 'user')
+    readonly_fields = ('created', 'name', 'user', 'total_ms', 'es_ms', 'took_ms', 'python_ms', 'calls_table')
+    exclude = ('calls',)
+
+    def num_calls(self, obj):
+        return len(json.loads(obj.calls))
+
+    def calls_table(self, obj):
+        return '<pre>{}</pre>'.format(escape(json.dumps(json.loads(obj.calls), indent=2)))
+    calls_table.allow_tags = True
+    calls_table.short_description = 'Elasticsearch requests'
+
+    def has_add_permission(self, request):
+        return False
+
+
+admin.site.register(ProfileTrace, ProfileTraceAdmin)
@@ -0,0 +1,468 @@
+# -*- coding: utf-8 -*-
+"""Benchmark scenarios for Elasticsearch-heavy operations.
+
+A scenario prepares its input once (see :meth:`Scenario.setup`), so that the
+measured iterations (see :meth:`Scenario.run`) only consist of the operation
+itself. Iterations can be run concurrently, to measure the behaviour under
+load. Results are summarized as percentiles and throughput, which can be
+stored as JSON and compared against a baseline.
+
+Saved queries can also be replayed as a load test: requests arrive at a fixed
+(Poisson) rate, regardless of how fast they are handled, so the latencies
+include the time spent waiting for a free worker.
+
+See the benchmark and replayqueries management commands.
+"""
+import json
+import math
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from Queue import Queue
+from StringIO import StringIO
+
+from celery.result import AsyncResult
+from dicttoxml import dicttoxml
+
+from django.conf import settings
+
+from services.es import do_search, count_search_results, metadata_aggregation, \
+    termvector_wordcloud, multiple_document_word_cloud, get_document_ids
+from services.models import DocID, QueryTerm
+from services.tasks import start_tv_cloud
+from texcavator.utils import daterange2dates
+
+# Used when no queries are given and no query terms are stored (see gatherqueryterms)
+DEFAULT_QUERIES = ('oorlog', 'koningin', 'amsterdam AND haven')
+
+SCENARIOS = {}
+
+
+def register(cls):
+    """
+    Class decorator that makes a scenario available under its name.
+    """
+    SCENARIOS[cls.name] = cls
+    return cls
+
+
+class Scenario(object):
+    """A benchmarked operation.
+
+    Options are the options of the benchmark command: queries, documents and
+    seed (amongst others). Scenarios that process a number of documents per
+    iteration set documents_per_run, to report documents per second.
+    """
+    name = None
+    documents_per_run = None
+
+    def __init__(self, options):
+        self.options = options
+        self.rng = random.Random(options.get('seed'))
+        self.dates = daterange2dates(settings.TEXCAVATOR_DATE_RANGE)
+
+    def setup(self):
+        """
+        Prepares the input of the iterations. Called once, before the warmup.
+        """
+        pass
+
+    def run(self, rng):
+        """
+        Runs a single iteration. rng is a random generator private to the thread.
+        """
+        raise NotImplementedError
+
+    def queries(self):
+        """
+        Returns the queries given as option, or random weighted queries of stored query terms.
+        """
+        if self.options.get('queries'):
+            return list(self.options['queries'])
+
+        terms = QueryTerm.sample_ids(1000, self.options.get('seed'))
+        if not terms:
+            return list(DEFAULT_QUERIES)
+        queries = []
+        for _ in range(20):
+            sample = self.rng.sample(terms, min(10, len(terms)))
+            queries.append(' OR '.join('{}^{}'.format(t, self.rng.randint(1, 40)) for t in sample))
+        return queries
+
+    def document_ids(self):
+        """
+        Returns a random pool of stored document ids (see gatherdocids) to sample from.
+        """
+        doc_ids = DocID.sample_ids(self.options['documents'] * 10, self.options.get('seed'))
+        if not doc_ids:
+            raise ValueError('No document ids found; please run the gatherdocids command first')
+        return doc_ids
+
+    def sample_ids(self, rng):
+        return rng.sample(self.doc_ids, min(self.options['documents'], len(self.doc_ids)))
+
+
+class QueryScenario(Scenario):
+    """A scenario that runs an operation for one of a set of queries."""
+
+    def setup(self):
+        self.query_list = self.queries()
+
+    def run(self, rng):
+        self.query(rng.choice(self.query_list))
+
+    def query(self, q):
+        raise NotImplementedError
+
+
+@register
+class SearchScenario(QueryScenario):
+    """Retrieves the first page of search results (as the search view does)."""
+    name = 'search'
+
+    def query(self, q):
+        valid, result = do_search(settings.ES_INDEX, settings.ES_DOCTYPE, q, 0, 20, self.dates, [], [], [])
+        if not valid:
+            raise ValueError(u'Invalid query "{}": {}'.format(q, result))
+
+
+@register
+class CountScenario(QueryScenario):
+    """Counts the search results (as the doc_count view does)."""
+    name = 'count'
+
+    def query(self, q):
+        count_search_results(settings.ES_INDEX, settings.ES_DOCTYPE, q, self.dates, [], [], [])
+
+
+@register
+class MetadataScenario(QueryScenario):
+    """Aggregates the metadata of the search results (as the metadata view does)."""
+    name = 'metadata'
+
+    def query(self, q):
+        metadata_aggregation(settings.ES_INDEX, settings.ES_DOCTYPE, q, self.dates, [], [], [])
+
+
+@register
+class TimelineScenario(QueryScenario):
+    """Retrieves the document ids and dates of the search results (as the timeline view does)."""
+    name = 'timeline'
+
+    def query(self, q):
+        get_document_ids(settings.ES_INDEX, settings.ES_DOCTYPE, q, self.dates)
+
+
+@register
+class TermvectorCloudScenario(Scenario):
+    """Generates a word cloud from the termvectors of a random set of documents."""
+    name = 'tvcloud'
+
+    def setup(self):
+        self.doc_ids = self.document_ids()
+
+    def run(self, rng):
+        termvector_wordcloud(settings.ES_INDEX, settings.ES_DOCTYPE, self.sample_ids(rng))
+
+
+@register
+class AggregationCloudScenario(Scenario):
+    """Generates a word cloud with a terms aggregation over a random set of documents."""
+    name = 'aggcloud'
+
+    def setup(self):
+        self.doc_ids = self.document_ids()
+
+    def run(self, rng):
+        multiple_document_word_cloud(settings.ES_INDEX, settings.ES_DOCTYPE, None, self.dates, [], [], [],
+                                     self.sample_ids(rng))
+
+
+def export_request(q, dates):
+    """
+    Returns the parameters of an export of the results of query q.
+    """
+    return {
+        'query': q,
+        'dates': dates,
+        'exclude_distributions': [],
+        'exclude_article_types': [],
+        'selected_pillars': [],
+    }
+
+
+@register
+class ExportScenario(QueryScenario):
+    """Exports the first documents of the search results to an archive in a temporary directory."""
+    name = 'export'
+
+    def query(self, q):
+        # Imported here, as query.tasks depends on the query app
+        from query.archive import ARCHIVE_FORMATS
+        from query.tasks import get_es_chunk, zip_chunk, export_writer
+
+        export_format = self.options.get('export_format', 'json')
+        req_dict = export_request(q, self.dates)
+        req_dict['format'] = export_format
+        if self.options.get('metadata_only'):
+            req_dict['metadata_only'] = 'true'
+        archive_class = ARCHIVE_FORMATS[self.options.get('archive', 'zip')]
+        hits, _ = get_es_chunk(req_dict, 0, self.options['documents'])
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            archive = archive_class(os.path.join(tmp_dir, 'export.' + archive_class.extension),
+                                    level=self.options.get('compression_level', 6),
+                                    workers=self.options.get('compression_workers', 1))
+            writer = export_writer(export_format, tmp_dir, 'export')
+            zip_chunk(req_dict, 0, hits['hits'], archive, writer, export_format)
+            if writer:
+                writer.close(archive)
+            archive.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class XMLScenario(Scenario):
+    """Serializes the first documents of the search results of the first query
+    to XML in an uncompressed in-memory zip file, so that only the serialization
+    is measured.
+    """
+
+    def setup(self):
+        from query.tasks import get_es_chunk
+
+        hits, _ = get_es_chunk(export_request(self.queries()[0], self.dates), 0, self.options['documents'])
+        self.hits = hits['hits']
+        self.documents_per_run = len(self.hits)
+
+    def run(self, rng):
+        zip_file = zipfile.ZipFile(StringIO(), mode='w', compression=zipfile.ZIP_STORED)
+        self.serialize(zip_file)
+        zip_file.close()
+
+    def serialize(self, zip_file):
+        raise NotImplementedError
+
+
+@register
+class XMLWriterScenario(XMLScenario):
+    """Serializes documents with the streaming XML writer of the export (to a single member)."""
+    name = 'xmlwriter'
+
+    def serialize(self, zip_file):
+        from query.tasks import XMLWriter
+
+        tmp_dir = tempfile.mkdtemp()
+        writer = XMLWriter(tmp_dir, 'export')
+        for hit in self.hits:
+            writer.write(hit)
+        writer.close(zip_file)
+        os.rmdir(tmp_dir)
+
+
+@register
+class DictToXMLScenario(XMLScenario):
+    """Serializes documents with dicttoxml, to a member per document (the former XML export)."""
+    name = 'dicttoxml'
+
+    def serialize(self, zip_file):
+        for hit in self.hits:
+            zip_file.writestr(hit['_id'].replace(':', '-') + '.xml', dicttoxml(hit))
+
+
+def run_scenario(scenario, iterations, warmup=0, concurrency=1):
+    """
+    Runs the iterations of a scenario, divided over concurrency threads,
+    after warmup iterations that are not measured.
+    Returns the durations of the iterations (in seconds) and the total wall time.
+    """
+    scenario.setup()
+    rng = random.Random(scenario.options.get('seed'))
+    for _ in range(warmup):
+        scenario.run(rng)
+
+    durations = []
+    errors = []
+    lock = threading.Lock()
+    remaining = [iterations]
+
+    def worker(seed):
+        thread_rng = random.Random(seed)
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            start = time.time()
+            try:
+                scenario.run(thread_rng)
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+                return
+            with lock:
+                durations.append(time.time() - start)
+
+    threads = [threading.Thread(target=worker, args=(rng.random(),)) for _ in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.time() - start
+
+    if errors:
+        raise errors[0]
+    return durations, wall
+
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile (nearest rank) of a sorted list of values.
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+def summarize(durations, wall):
+    """
+    Returns the statistics of a benchmark run, with durations in milliseconds.
+    """
+    ms = sorted(d * 1000 for d in durations)
+    return {
+        'iterations': len(ms),
+        'mean_ms': sum(ms) / len(ms) if ms else None,
+        'min_ms': ms[0] if ms else None,
+        'p50_ms': percentile(ms, 50),
+        'p95_ms': percentile(ms, 95),
+        'p99_ms': percentile(ms, 99),
+        'max_ms': ms[-1] if ms else None,
+        'throughput': len(ms) / wall if wall else None,
+    }
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Compares results against a baseline (both map scenarios to summaries).
+    Returns a list of (scenario, statistic, baseline value, value, relative change, regression),
+    in which a regression is an increase of a percentile by more than tolerance.
+    """
+    comparison = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        for stat in ('p50_ms', 'p95_ms', 'p99_ms'):
+            old, new = baseline[name].get(stat), results[name].get(stat)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            comparison.append((name, stat, old, new, change, change > tolerance))
+    return comparison
+
+
+def load_results(filename):
+    """
+    Returns the results stored in a JSON file written by the benchmark command.
+    """
+    with open(filename) as f:
+        return json.load(f)['results']
+
+
+def _search(params):
+    valid, result = do_search(settings.ES_INDEX, settings.ES_DOCTYPE, params['query'], 0, 20, params['dates'],
+                              params['exclude_distributions'], params['exclude_article_types'],
+                              params['selected_pillars'])
+    if not valid:
+        raise ValueError(u'Invalid query "{}": {}'.format(params['query'], result))
+
+
+def _doc_count(params):
+    count_search_results(settings.ES_INDEX, settings.ES_DOCTYPE, params['query'], params['dates'],
+                         params['exclude_distributions'], params['exclude_article_types'],
+                         params['selected_pillars'])
+
+
+def _metadata(params):
+    metadata_aggregation(settings.ES_INDEX, settings.ES_DOCTYPE, params['query'], params['dates'],
+                         params['exclude_distributions'], params['exclude_article_types'],
+                         params['selected_pillars'])
+
+
+def _timeline(params):
+    get_document_ids(settings.ES_INDEX, settings.ES_DOCTYPE, params['query'], params['dates'],
+                     params['exclude_distributions'], params['exclude_article_types'], params['selected_pillars'])
+
+
+def _tv_cloud(params, timeout=600):
+    # As the view, start (or join) a Celery task, and wait for its result like the client does
+    task_id = start_tv_cloud(params, 2, '')
+    result = AsyncResult(task_id).get(timeout=timeout)
+    if result.get('status') != 'ok':
+        raise ValueError(result.get('error', 'Word cloud failed'))
+
+
+# The code paths of the views that handle saved queries, by endpoint
+ENDPOINTS = {
+    'search': _search,
+    'doc_count': _doc_count,
+    'metadata': _metadata,
+    'timeline': _timeline,
+    'tv_cloud': _tv_cloud,
+}
+
+
+def replay(calls, concurrency=1, rate=None, seed=None):
+    """
+    Replays calls, (endpoint, function) tuples, with concurrency workers.
+
+    If rate is given, calls arrive with exponentially distributed intervals
+    (rate calls per second on average), otherwise they arrive all at once.
+    The latency of a call runs from its arrival until it is finished.
+    Returns a dictionary that maps endpoints to their latencies (in seconds)
+    and errors, and the total wall time.
+    """
+    results = {endpoint: {'latencies': [], 'errors': []} for endpoint, _ in calls}
+    lock = threading.Lock()
+    queue = Queue()
+
+    def worker():
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            endpoint, function, arrival = item
+            try:
+                function()
+            except Exception as e:
+                with lock:
+                    results[endpoint]['errors'].append(u'{}: {}'.format(type(e).__name__, e))
+            else:
+                with lock:
+                    results[endpoint]['latencies'].append(time.time() - arrival)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+
+    rng = random.Random(seed)
+    start = time.time()
+    arrival = start
+    for endpoint, function in calls:
+        if rate:
+            arrival += rng.expovariate(rate)
+            time.sleep(max(arrival - time.time(), 0))
+        queue.put((endpoint, function, time.time()))
+
+    for _ in threads:
+        queue.put(None)
+    for thread in threads:
+        thread.join()
+
+    return results, time.time() - start
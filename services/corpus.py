@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""Synthetic corpus of KB-shaped newspaper articles.
+
+Documents have the fields of the KB index that Texcavator uses (identifiers,
+dates, distribution, article type, titles and text). The text is drawn from a
+vocabulary with Zipfian word frequencies: common Dutch function words first,
+then generated words, among which some words that occur in typical queries.
+A small fraction of the words is distorted, like OCR errors.
+
+The corpus only depends on its parameters and the seed, so it can be used for
+reproducible tests and benchmarks (see services.fake_es).
+"""
+import random
+from bisect import bisect_right
+from datetime import date, timedelta
+
+from services.es import DUPLICATE_IDENTIFIER_PREFIX, _KB_DISTRIBUTION_VALUES, _KB_ARTICLE_TYPE_VALUES
+
+COMMON_WORDS = (u'de', u'van', u'het', u'een', u'en', u'in', u'te', u'dat', u'op', u'is', u'die', u'voor',
+                u'met', u'niet', u'aan', u'zijn', u'door', u'bij', u'als', u'ook', u'wordt', u'hij', u'er',
+                u'om', u'uit', u'tot', u'nog', u'over', u'werd', u'maar', u'naar', u'heeft', u'deze', u'zal')
+
+TOPIC_WORDS = (u'oorlog', u'koningin', u'amsterdam', u'haven', u'regeering', u'minister', u'kamer',
+               u'stad', u'schip', u'markt', u'prijs', u'gemeente', u'kerk', u'school', u'trein', u'vrede',
+               u'indië', u'rotterdam', u'arbeiders', u'staking', u'verkiezingen', u'radio', u'koffie')
+
+_SYLLABLES = (u'ba', u'be', u'bo', u'da', u'de', u'dor', u'ge', u'gen', u'ha', u'her', u'ka', u'ker',
+              u'la', u'le', u'len', u'ma', u'me', u'mer', u'na', u'ne', u'nen', u'ont', u'pa', u'pe',
+              u'ra', u're', u'ren', u'sa', u'sche', u'sen', u'ta', u'te', u'ten', u'ter', u'va', u'ver',
+              u'vo', u'wa', u'we', u'zee', u'zo', u'aar', u'eer', u'oor', u'ui', u'ijk', u'lijk', u'heid')
+
+# Typical OCR confusions
+_OCR_ERRORS = ((u'e', u'c'), (u'rn', u'm'), (u'n', u'u'), (u'i', u'l'), (u'h', u'b'), (u'o', u'0'))
+
+_TEMPORAL_VALUES = (u'Dag', u'Week', u'Maand')
+
+
+def vocabulary(size, rng):
+    """
+    Returns a list of size distinct words, ordered by decreasing frequency.
+    """
+    words = list(COMMON_WORDS)
+    seen = set(COMMON_WORDS + TOPIC_WORDS)
+    while len(words) < size:
+        word = u''.join(rng.choice(_SYLLABLES) for _ in range(rng.randint(2, 4)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+
+    # Spread the topic words over the ranks, so queries differ in selectivity
+    for i, word in enumerate(TOPIC_WORDS):
+        words.insert(min(len(COMMON_WORDS) + 20 * (i + 1) ** 2, len(words)), word)
+    return words[:size]
+
+
+class ZipfSampler(object):
+    """Samples indices 0..n-1, in which index i has a probability proportional to 1 / (i + 1) ** s."""
+
+    def __init__(self, n, s=1.1):
+        self.cumulative = []
+        total = 0.0
+        for i in xrange(n):
+            total += 1.0 / (i + 1) ** s
+            self.cumulative.append(total)
+        self.total = total
+
+    def sample(self, rng):
+        return bisect_right(self.cumulative, rng.random() * self.total)
+
+
+def ocr_noise(word, rng, rate):
+    """
+    Returns the word, or (with probability rate) a distorted version of it.
+    """
+    if rng.random() >= rate:
+        return word
+    original, error = rng.choice(_OCR_ERRORS)
+    if original in word:
+        return word.replace(original, error, 1)
+    # Split the word, as happens with hyphenation at the end of a line
+    i = rng.randint(1, max(len(word) - 1, 1))
+    return word[:i] + u' ' + word[i:]
+
+
+def generate_newspapers(n, rng):
+    """
+    Returns n newspapers: dictionaries with their id, title, distribution and publication frequency.
+    """
+    distributions = sorted(_KB_DISTRIBUTION_VALUES.values())
+    newspapers = []
+    for i in range(n):
+        newspapers.append({
+            'id': u'{:08d}X'.format(10000000 + i),
+            'title': u'{} {} {}'.format(rng.choice((u'Courant', u'Dagblad', u'Nieuwsblad', u'Bode')),
+                                        rng.choice(TOPIC_WORDS).title(), i),
+            'spatial': _KB_DISTRIBUTION_VALUES['sd_national'] if rng.random() < 0.5 else rng.choice(distributions),
+            'temporal': rng.choice(_TEMPORAL_VALUES),
+        })
+    return newspapers
+
+
+def generate_corpus(n, seed=0, vocabulary_size=20000, n_newspapers=None, years=(1850, 1995),
+                    words_per_article=(20, 600), ocr_error_rate=0.02, duplicate_rate=0.01):
+    """
+    Generates n articles, as (document id, source) tuples.
+
+    Parameters:
+        n : int
+            The number of articles
+        seed : int, optional
+            The seed of the random generator
+        vocabulary_size : int, optional
+            The number of distinct words (before OCR errors)
+        n_newspapers : int, optional
+            The number of newspapers; by default one per 100 articles
+        years : tuple(int), optional
+            The first and last year of publication
+        words_per_article : tuple(int), optional
+            The minimal and maximal length of the text of an article
+        ocr_error_rate : float, optional
+            The fraction of words with an OCR error
+        duplicate_rate : float, optional
+            The fraction of articles in duplicate newspapers (see #73)
+    """
+    rng = random.Random(seed)
+    words = vocabulary(vocabulary_size, rng)
+    zipf = ZipfSampler(len(words))
+    newspapers = generate_newspapers(n_newspapers or max(n // 100, 1), rng)
+    article_types = sorted(_KB_ARTICLE_TYPE_VALUES.values())
+
+    first_day = date(years[0], 1, 1)
+    n_days = (date(years[1], 12, 31) - first_day).days + 1
+
+    for i in xrange(n):
+        paper = rng.choice(newspapers)
+        day = first_day + timedelta(days=rng.randrange(n_days))
+        # Issues of 20 articles each
+        prefix = DUPLICATE_IDENTIFIER_PREFIX if rng.random() < duplicate_rate else u'ddd:010'
+        issue = u'{}{:06d}:mpeg21'.format(prefix, i // 20)
+        identifier = u'{}:a{:04d}'.format(issue, i % 20 + 1)
+
+        length = rng.randint(*words_per_article)
+        text = u' '.join(ocr_noise(words[zipf.sample(rng)], rng, ocr_error_rate) for _ in xrange(length))
+        title = u' '.join(words[zipf.sample(rng)] for _ in xrange(rng.randint(1, 6))).capitalize()
+
+        yield identifier, {
+            'identifier': identifier,
+            'paper_dc_date': day.isoformat(),
+            'paper_dc_identifier': paper['id'],
+            'paper_dc_identifier_resolver': u'http://resolver.kb.nl/resolve?urn={}'.format(issue),
+            'paper_dc_language': u'nl',
+            'paper_dc_title': paper['title'],
+            'paper_dcterms_spatial': paper['spatial'],
+            'paper_dcterms_temporal': paper['temporal'],
+            'article_dc_identifier_resolver': u'http://resolver.kb.nl/resolve?urn={}'.format(identifier),
+            'article_dc_subject': _KB_ARTICLE_TYPE_VALUES['st_article'] if rng.random() < 0.7 else
+            rng.choice(article_types),
+            'article_dc_title': title,
+            'text_content': text,
+        }
@@ -1,18 +1,22 @@
 # -*- coding: utf-8 -*-
 """Elasticsearch functionality"""
 
+import copy
 import json
 import logging
 import os
+import time
+from bisect import bisect_right
 from collections import Counter, defaultdict
 from datetime import datetime
 
 from elasticsearch import Elasticsearch
-from elasticsearch.client import indices
 
 from django.conf import settings
 
-from texcavator.utils import daterange2dates
+from services.profiling import ProfilingTransport
+from services.tvcache import termvector_cache_enabled, get_termvector_cache
+from texcavator.utils import daterange2dates, LRUCache
 
 logger = logging.getLogger(__name__)
 
@@ -36,21 +40,55 @@ _KB_ARTICLE_TYPE_VALUES = {'st_article': 'artikel',
 _DOCUMENT_TEXT_FIELD = 'text_content'
 _DOCUMENT_TITLE_FIELD = 'article_dc_title'
 _AGG_FIELD = _DOCUMENT_TEXT_FIELD
-_STEMMING_ANALYZER = 'dutch_analyzer'
+STEMMING_ANALYZER = 'dutch_analyzer'
+
+# Newspaper classification, see query.models.update_newspaper_classification
+NEWSPAPERS_FILE = 'newspapers.txt'
+_PILLAR_DOCTYPE = 'pillar'
+
+# Duplicate newspapers, see #73 and the resolveduplicates command
+DUPLICATE_IDENTIFIER_PREFIX = 'ddd:11'
+DUPLICATES_FILE = 'duplicates.txt'
+_duplicates = {}
+
+# Built queries, keyed by their canonical parameters
+_queries = LRUCache(getattr(settings, 'QUERY_CACHE_SIZE', 1000))
+
+# Index generations are looked up at most once per this many seconds
+_GENERATION_TTL = 300
+_generations = {}
+
+# Recently retrieved documents (complete _source)
+_documents = LRUCache(getattr(settings, 'DOCUMENT_CACHE_SIZE', 500))
+
+# Recently stemmed words, keyed by index, analyzer and word
+_stems = LRUCache(getattr(settings, 'STEM_CACHE_SIZE', 10000))
+
+_client = None
 
 
 def _es():
-    """Returns ElasticSearch instance."""
-    node = {'host': settings.ELASTICSEARCH_HOST,
-            'port': settings.ELASTICSEARCH_PORT}
-    if settings.ELASTICSEARCH_USERNAME:
-        node['http_auth'] = (settings.ELASTICSEARCH_USERNAME, settings.ELASTICSEARCH_PASSWORD)
-        node['use_ssl'] = settings.ELASTICSEARCH_USE_SSL
-    return Elasticsearch([node])
+    """Returns ElasticSearch instance (one per process, the client is thread-safe)."""
+    global _client
+    if _client is None and getattr(settings, 'ES_FAKE_DOCUMENTS', 0):
+        # Imported here, as the synthetic corpus depends on constants in this module
+        from services.corpus import generate_corpus
+        from services.fake_es import FakeElasticsearch
+        corpus = generate_corpus(settings.ES_FAKE_DOCUMENTS, getattr(settings, 'ES_FAKE_SEED', 0))
+        _client = FakeElasticsearch.with_corpus(settings.ES_INDEX, settings.ES_DOCTYPE, corpus)
+    if _client is None:
+        node = {'host': settings.ELASTICSEARCH_HOST,
+                'port': settings.ELASTICSEARCH_PORT}
+        if settings.ELASTICSEARCH_USERNAME:
+            node['http_auth'] = (settings.ELASTICSEARCH_USERNAME, settings.ELASTICSEARCH_PASSWORD)
+            node['use_ssl'] = settings.ELASTICSEARCH_USE_SSL
+        _client = Elasticsearch([node], transport_class=ProfilingTransport)
+    return _client
 
 
 def do_search(idx, typ, query, start, num, date_ranges, exclude_distributions,
-              exclude_article_types, selected_pillars, return_source=False, sort_order='_score'):
+              exclude_article_types, selected_pillars, return_source=False, sort_order='_score',
+              source_include=None, source_exclude=None):
     """Returns ElasticSearch search results.
 
     Fetch all documents matching the query and return a list of
@@ -91,6 +129,9 @@ def do_search(idx, typ, query, start, num, date_ranges, exclude_distributions,
             The sort order for this query. Syntax is fieldname:order, multiple
             sort orders can be separated by commas. Note that if the sort_order
             doesn't contain _score, no scores will be returned.
+        source_include, source_exclude : list(str), optional
+            If return_source, only return these fields of the _source, or
+            do not return these fields of the _source
 
     Returns:
         validity : boolean
@@ -102,22 +143,24 @@ def do_search(idx, typ, query, start, num, date_ranges, exclude_distributions,
     q = create_query(query, date_ranges, exclude_distributions,
                      exclude_article_types, selected_pillars)
 
-    valid_q = indices.IndicesClient(_es()).validate_query(index=idx,
-                                                          doc_type=typ,
-                                                          body=q,
-                                                          explain=True)
+    valid_q = _es().indices.validate_query(index=idx, doc_type=typ, body=q, explain=True)
 
     if valid_q.get('valid'):
         if return_source:
             # for each document return the _source field that contains all
-            # document fields (no fields parameter in the ES call)
+            # (or the included) document fields (no fields parameter in the ES call)
+            params = {}
+            if source_include:
+                params['_source_include'] = ','.join(source_include)
+            if source_exclude:
+                params['_source_exclude'] = ','.join(source_exclude)
             return True, _es().search(index=idx, doc_type=typ, body=q,
-                                      from_=start, size=num, sort=sort_order)
+                                      from_=start, size=num, sort=sort_order, **params)
         else:
             # for each document return the fields listed in_ES_RETURN_FIELDS
-            return True, _es().search(index=idx, doc_type=typ, body=q,
-                                      fields=_ES_RETURN_FIELDS, from_=start,
-                                      size=num, sort=sort_order)
+            results = _es().search(index=idx, doc_type=typ, body=hit_fields(q, _ES_RETURN_FIELDS),
+                                   from_=start, size=num, sort=sort_order)
+            return True, source_to_fields(results)
     return False, valid_q.get('explanations')[0].get('error')
 
 
@@ -141,13 +184,69 @@ def get_document(idx, typ, doc_id):
             The type of document requested
         doc_id : str
             The id of the document to be retrieved
+
+    Returns:
+        The _source of the document, or None if the document does not exist.
+        Raises an elasticsearch TransportError if retrieval fails.
     """
-    try:
-        result = _es().get(index=idx, doc_type=typ, id=doc_id)
-    except:
-        return None
+    return get_documents(idx, typ, [doc_id]).get(doc_id)
+
+
+def get_documents(idx, typ, doc_ids, include=None, exclude=None):
+    """Return multiple documents given their ids, using a single mget request.
 
-    return result['_source']
+    Complete documents are kept in an in-process LRU cache, so documents that
+    were viewed recently are not retrieved again; the requested fields are
+    selected from them. Other documents are retrieved with only the requested
+    fields, and are only cached if they are complete.
+
+    Parameters:
+        idx : str
+            The name of the elasticsearch index
+        typ : str
+            The type of document requested
+        doc_ids : list(str)
+            The ids of the documents to be retrieved
+        include : list(str), optional
+            Only return these fields of the documents
+        exclude : list(str), optional
+            Do not return these fields of the documents
+
+    Returns:
+        dict : dict
+            A dictionary that maps document ids to (the requested fields of)
+            their _source. Documents that do not exist are not included.
+            Raises an elasticsearch TransportError if retrieval fails.
+    """
+    def select_fields(source):
+        return {k: v for k, v in source.iteritems()
+                if (not include or k in include) and (not exclude or k not in exclude)}
+
+    result = {}
+    missing = []
+    for doc_id in doc_ids:
+        source = _documents.get((idx, doc_id))
+        if source is not None:
+            result[doc_id] = select_fields(source)
+        elif doc_id not in missing:
+            missing.append(doc_id)
+
+    if missing:
+        params = {}
+        if include:
+            params['_source_include'] = ','.join(include)
+        if exclude:
+            params['_source_exclude'] = ','.join(exclude)
+        docs = _es().mget(index=idx, doc_type=typ, body={'ids': missing}, **params)
+
+        for doc in docs.get('docs'):
+            if not doc.get('found', False):
+                continue
+            if not params:
+                _documents.set((idx, doc['_id']), doc['_source'])
+            result[doc['_id']] = doc['_source']
+
+    return result
 
 
 def create_query(query_str, date_ranges, exclude_distributions,
@@ -157,30 +256,62 @@ def create_query(query_str, date_ranges, exclude_distributions,
     This method accepts boolean queries in the Elasticsearch query string
     syntax (see Elasticsearch reference).
 
+    All metadata restrictions are placed in (non-scoring) filter context. The
+    parameters are put in a canonical order first, so identical restrictions
+    always produce identical filters, which ES can cache. Queries are
+    memoized per parameter combination; the caller receives a copy it may
+    modify.
+
     Returns a dict that represents the query in the elasticsearch query DSL.
     """
+    date_ranges = sorted(set((d['lower'], d['upper']) for d in date_ranges))
+    exclude_distributions = sorted(set(exclude_distributions))
+    exclude_article_types = sorted(set(exclude_article_types))
+    selected_pillars = sorted(set(selected_pillars))
+
+    # The query also depends on the settings and on the files with the newspaper classification
+    key = (query_str, tuple(date_ranges), tuple(exclude_distributions), tuple(exclude_article_types),
+           tuple(selected_pillars), _es_version(), _pillar_index(),
+           getattr(settings, 'KB_HOTFIX_DUPLICATE_NEWSPAPERS', True),
+           getattr(settings, 'QUERY_ALLOW_LEADING_WILDCARD', True),
+           _modified(NEWSPAPERS_FILE), _modified(DUPLICATES_FILE))
+
+    query = _queries.get(key)
+    if query is None:
+        query = _build_query(query_str, date_ranges, exclude_distributions,
+                             exclude_article_types, selected_pillars)
+        _queries.set(key, query)
 
+    return copy.deepcopy(query)
+
+
+def _build_query(query_str, date_ranges, exclude_distributions,
+                 exclude_article_types, selected_pillars):
     filter_must = []
     filter_should = []
     filter_must_not = []
 
-    for date_range in date_ranges:
+    for lower, upper in date_ranges:
         filter_should.append(
             {
                 'range': {
                     'paper_dc_date': {
-                        'gte': date_range['lower'],
-                        'lte': date_range['upper']
+                        'gte': lower,
+                        'lte': upper
                     }
                 }
             }
         )
 
-    # Filters on newspapers. This reads from a local file; as Celery can't read from the database.
+    # Filters on newspapers. Either via terms lookups in the pillar index,
+    # or via a local file, as Celery can't read from the database.
     newspaper_ids = []
-    if selected_pillars:
+    if selected_pillars and _pillar_index():
+        lookups = [pillar_filter(pillar) for pillar in selected_pillars]
+        filter_must.append(lookups[0] if len(lookups) == 1 else {'bool': {'should': lookups}})
+    elif selected_pillars:
         try:
-            with open(os.path.join(settings.PROJECT_PARENT, 'newspapers.txt'), 'rb') as in_file:
+            with open(os.path.join(settings.PROJECT_PARENT, NEWSPAPERS_FILE), 'rb') as in_file:
                 categorization = json.load(in_file)
                 for pillar, n_ids in categorization.iteritems():
                     if int(pillar) in selected_pillars:
@@ -188,7 +319,7 @@ def create_query(query_str, date_ranges, exclude_distributions,
         except IOError:
             logging.warning('No newspaper classification found. Continuing without filter on newspapers.')
     if newspaper_ids:
-        filter_must.append({'terms': {'paper_dc_identifier': newspaper_ids}})
+        filter_must.append({'terms': {'paper_dc_identifier': sorted(newspaper_ids)}})
 
     for ds in exclude_distributions:
         filter_must_not.append(
@@ -198,29 +329,219 @@ def create_query(query_str, date_ranges, exclude_distributions,
         filter_must_not.append(
             {"term": {"article_dc_subject": _KB_ARTICLE_TYPE_VALUES[typ]}})
 
-    query = {
-        'query': {
+    # Temporary hotfix for duplicate newspapers, see #73.
+    filter_must_not.extend(duplicate_newspapers_filters())
+
+    # Add the query string part.
+    query = None
+    if query_str:
+        # Former version of the hotfix for duplicate newspapers, only kept for benchmarking.
+        if getattr(settings, 'KB_HOTFIX_DUPLICATE_NEWSPAPERS', True) == 'query_string':
+            query_str += ' -identifier:ddd\:11*'
+        alw = getattr(settings, 'QUERY_ALLOW_LEADING_WILDCARD', True)
+        query = {'query_string': {'query': query_str, 'allow_leading_wildcard': alw}}
+
+    return {'query': filtered_query(query, filter_must, filter_should, filter_must_not)}
+
+
+def pillar_filter(pillar):
+    """Returns a terms lookup filter on the newspapers of a pillar in the pillar index.
+
+    ES retrieves (and caches) the newspaper ids itself, so they do not have to
+    be sent with every request.
+    """
+    return {
+        'terms': {
+            'paper_dc_identifier': {
+                'index': _pillar_index(),
+                'type': _PILLAR_DOCTYPE,
+                'id': str(pillar),
+                'path': 'newspapers'
+            }
+        }
+    }
+
+
+def update_pillar_index(classification):
+    """Stores the newspaper ids per pillar in the pillar index (ES_PILLAR_INDEX).
+
+    Parameters:
+        classification : dict
+            A dictionary that maps pillar ids to lists of newspaper ids
+    """
+    idx = _pillar_index()
+    if not _es().indices.exists(index=idx):
+        _es().indices.create(index=idx, body={
+            'settings': {
+                # Keep a copy on every node, so lookups are always local
+                'number_of_shards': 1,
+                'auto_expand_replicas': '0-all'
+            },
+            'mappings': {
+                _PILLAR_DOCTYPE: {
+                    'properties': {
+                        'newspapers': {'type': 'object', 'enabled': False}
+                    }
+                }
+            }
+        })
+
+    body = []
+    for pillar, newspaper_ids in classification.iteritems():
+        body.append({'index': {'_index': idx, '_type': _PILLAR_DOCTYPE, '_id': str(pillar)}})
+        body.append({'newspapers': sorted(newspaper_ids)})
+    if body:
+        _es().bulk(body=body)
+
+
+def _pillar_index():
+    return getattr(settings, 'ES_PILLAR_INDEX', None)
+
+
+def filtered_query(query=None, must=(), should=(), must_not=()):
+    """Returns a query with filters in filter context.
+
+    For ES 1.x (see ELASTICSEARCH_VERSION) this is a filtered query with a
+    bool filter, for later versions a bool query with filter clauses. At
+    least one of the should filters must match.
+
+    Parameters:
+        query : dict, optional
+            The scoring part of the query
+        must, should, must_not : list(dict), optional
+            The filters
+
+    Returns:
+        query : dict
+            The query (without the enclosing 'query' key)
+    """
+    if _es_version() < 2:
+        result = {
             'filtered': {
                 'filter': {
                     'bool': {
-                        'must': filter_must,
-                        'should': filter_should,
-                        'must_not': filter_must_not
+                        'must': list(must),
+                        'should': list(should),
+                        'must_not': list(must_not)
                     }
                 }
             }
         }
-    }
+        if query:
+            result['filtered']['query'] = query
+        return result
+
+    filters = list(must)
+    if should:
+        filters.append({'bool': {'should': list(should)}})
+    result = {'bool': {'filter': filters, 'must_not': list(must_not)}}
+    if query:
+        result['bool']['must'] = query
+    return result
 
-    # Add the query string part.
-    if query_str:
-        # Temporary hotfix for duplicate newspapers, see #73.
-        if getattr(settings, 'KB_HOTFIX_DUPLICATE_NEWSPAPERS', True):
-            query_str += ' -identifier:ddd\:11*'
-        alw = getattr(settings, 'QUERY_ALLOW_LEADING_WILDCARD', True)
-        query['query']['filtered']['query'] = {'query_string': {'query': query_str, 'allow_leading_wildcard': alw}}
 
-    return query
+def hit_fields(body, fields=()):
+    """Restricts the hits of a search request to their ids and the given
+    fields. ES 1.x reads the 'fields' from the _source; ES 5 only returns
+    stored fields (renamed to 'stored_fields'), and the KB fields are not
+    stored, so the _source is filtered instead. Use :func:`source_to_fields`
+    on the results to read the fields in the same way for all versions.
+    """
+    if _es_version() < 5:
+        body['_source'] = False
+        body['fields'] = list(fields)
+    else:
+        body['_source'] = list(fields) if fields else False
+    return body
+
+
+def source_to_fields(results):
+    """Moves the (filtered) _source of search hits to their 'fields', as ES 1.x
+    returns them (see :func:`hit_fields`).
+    """
+    if _es_version() >= 5:
+        for hit in results['hits']['hits']:
+            hit['fields'] = {k: [v] for k, v in (hit.pop('_source', None) or {}).iteritems()}
+    return results
+
+
+def _es_version():
+    return getattr(settings, 'ELASTICSEARCH_VERSION', 1)
+
+
+def _modified(filename):
+    """Returns the modification time of a file in PROJECT_PARENT, or None if it does not exist."""
+    try:
+        return os.stat(os.path.join(settings.PROJECT_PARENT, filename)).st_mtime
+    except OSError:
+        return None
+
+
+def duplicate_newspapers_filters():
+    """Returns the filters that exclude duplicate newspapers, see #73.
+
+    Duplicate newspapers have identifiers that start with "ddd:11". If the
+    duplicates have been resolved into newspaper ids (by the
+    resolveduplicates command), these are excluded with a terms filter,
+    otherwise a prefix filter on the identifier is used. Both are placed in
+    filter context, so ES caches them.
+    """
+    if getattr(settings, 'KB_HOTFIX_DUPLICATE_NEWSPAPERS', True) in (False, 'query_string'):
+        return []
+
+    duplicates = load_duplicate_newspapers()
+    if duplicates is None:
+        return [{'prefix': {'identifier': DUPLICATE_IDENTIFIER_PREFIX}}]
+
+    filters = []
+    if duplicates['paper_ids']:
+        filters.append({'terms': {'paper_dc_identifier': duplicates['paper_ids']}})
+    if duplicates['partial']:
+        filters.append({'prefix': {'identifier': DUPLICATE_IDENTIFIER_PREFIX}})
+    return filters
+
+
+def load_duplicate_newspapers():
+    """Returns the resolved duplicate newspapers, or None if these have not been resolved.
+
+    This reads from a local file, as Celery can't read from the database. The
+    file is only read again if it has been modified.
+    """
+    mtime = _modified(DUPLICATES_FILE)
+    if mtime is None:
+        return None
+
+    if _duplicates.get('mtime') != mtime:
+        with open(os.path.join(settings.PROJECT_PARENT, DUPLICATES_FILE), 'rb') as in_file:
+            _duplicates['value'] = json.load(in_file)
+        _duplicates['mtime'] = mtime
+
+    return _duplicates['value']
+
+
+def resolve_duplicate_newspapers(idx, typ):
+    """Returns the newspapers that contain duplicate documents.
+
+    Returns:
+        list : list
+            (paper id, number of duplicate documents, number of other documents) tuples
+    """
+    agg = {'papers': {'terms': {'field': 'paper_dc_identifier', 'size': 0}}}
+
+    q = {'query': filtered_query(must=[{'prefix': {'identifier': DUPLICATE_IDENTIFIER_PREFIX}}]),
+         'aggs': agg}
+    result = _es().search(index=idx, doc_type=typ, body=q, search_type='count')
+    duplicates = {b['key']: b['doc_count'] for b in result['aggregations']['papers']['buckets']}
+    if not duplicates:
+        return []
+
+    q = {'query': filtered_query(must=[{'terms': {'paper_dc_identifier': sorted(duplicates)}}]),
+         'aggs': agg}
+    result = _es().search(index=idx, doc_type=typ, body=q, search_type='count')
+    totals = {b['key']: b['doc_count'] for b in result['aggregations']['papers']['buckets']}
+
+    return [(paper_id, count, totals.get(paper_id, count) - count)
+            for paper_id, count in sorted(duplicates.iteritems())]
 
 
 def create_ids_query(ids):
@@ -238,16 +559,14 @@ def create_ids_query(ids):
             A dictionary representing an ES ids query
     """
     query = {
-        'query': {
-            'filtered': {
-                'filter': {
-                    'ids': {
-                        'type': settings.ES_DOCTYPE,
-                        'values': ids
-                    }
+        'query': filtered_query(must=[
+            {
+                'ids': {
+                    'type': settings.ES_DOCTYPE,
+                    'values': ids
                 }
             }
-        }
+        ])
     }
 
     return query
@@ -264,27 +583,16 @@ def create_day_statistics_query(date_range, agg_name):
     num_days = diff.days
 
     return {
-        'query': {
-            'filtered': {
-                'filter': {
-                    'bool': {
-                        'must': [
-                            {
-                                'range': {
-                                    'paper_dc_date': {
-                                        'gte': date_range['lower'],
-                                        'lte': date_range['upper']
-                                    }
-                                }
-                            }
-                        ]
+        'query': filtered_query(must=[
+            {
+                'range': {
+                    'paper_dc_date': {
+                        'gte': date_range['lower'],
+                        'lte': date_range['upper']
                     }
-                },
-                'query': {
-                    'match_all': {}
                 }
             }
-        },
+        ]),
         'aggs': {
             agg_name: {
                 'terms': {
@@ -324,8 +632,8 @@ def single_document_word_cloud(idx, typ, doc_id, min_length=0, stopwords=[], ste
             The id of the document the word cloud should be created for
         min_length : int, optional
             The minimum length of words in the word cloud
-        stopwords : list, optional
-            A list of words that should be removed from the word cloud
+        stopwords : frozenset, optional
+            The words that should be removed from the word cloud
         stems : boolean, optional
             Whether or not we should look at the stemmed columns
 
@@ -352,17 +660,14 @@ def single_document_word_cloud(idx, typ, doc_id, min_length=0, stopwords=[], ste
             'error': 'No document id provided.'
         }
 
-    bdy = {
-        'fields': get_cloud_fields(stems)
-    }
-    t_vector = _es().termvector(index=idx, doc_type=typ, id=doc_id, body=bdy)
+    t_vectors = get_termvectors(idx, typ, [doc_id], get_cloud_fields(stems))
 
-    if t_vector.get('found', False):
+    if doc_id in t_vectors:
         wordcloud = Counter()
-        for field, data in t_vector.get('term_vectors').iteritems():
-            for term, count_dict in data.get('terms').iteritems():
-                if term not in stopwords and len(term) >= min_length:
-                    wordcloud[term] += int(count_dict.get('term_freq'))
+        stopwords = frozenset(stopwords)
+        for term, count in t_vectors[doc_id].iteritems():
+            if term not in stopwords and len(term) >= min_length:
+                wordcloud[term] = count
 
         return {
             'result': wordcloud,
@@ -430,7 +735,7 @@ def multiple_document_word_cloud(idx, typ, query, date_ranges, dist, art_types,
     }
 
 
-def termvector_wordcloud(idx, typ, doc_ids, min_length=0, stems=False, add_freqs=True):
+def termvector_wordcloud(idx, typ, doc_ids, min_length=0, stems=False, add_freqs=True, stopwords=frozenset()):
     """Return word frequencies in a set of documents.
 
     Return data required to draw a word cloud for multiple documents by
@@ -453,6 +758,8 @@ def termvector_wordcloud(idx, typ, doc_ids, min_length=0, stems=False, add_freqs
             Whether or not we should look at the stemmed columns
         add_freqs : boolean, optional
             Whether or not we should count total occurrences
+        stopwords : frozenset, optional
+            The words that should not be counted
 
     See also
         :func:`single_document_word_cloud` generate data for a single document
@@ -467,32 +774,149 @@ def termvector_wordcloud(idx, typ, doc_ids, min_length=0, stems=False, add_freqs
     if not doc_ids:
         return wordcloud
 
-    bdy = {
-        'ids': doc_ids,
-        'parameters': {
-            'fields': get_cloud_fields(stems),
-            'term_statistics': False,
-            'field_statistics': False,
-            'offsets': False,
-            'payloads': False,
-            'positions': False
+    t_vectors = get_termvectors(idx, typ, doc_ids, get_cloud_fields(stems))
+
+    for terms in t_vectors.itervalues():
+        if add_freqs:
+            wordcloud.update({t: c for t, c in terms.iteritems()
+                              if len(t) >= min_length and t not in stopwords})
+        else:
+            # only count individual occurrences
+            wordcloud.update(t for t in terms if len(t) >= min_length and t not in stopwords)
+
+    return wordcloud
+
+
+def get_termvectors(idx, typ, doc_ids, fields):
+    """Return the term frequencies of a set of documents.
+
+    Termvectors are read from the termvector cache (if enabled); only the
+    documents missing from the cache are requested from elasticsearch.
+
+    Parameters:
+        idx : str
+            The name of the elasticsearch index
+        typ : str
+            The type of document requested
+        doc_ids : list(str)
+            The requested documents
+        fields : list(str)
+            The fields to retrieve the termvectors for
+
+    Returns:
+        dict : dict
+            A dictionary that maps document ids to dictionaries of term
+            frequencies (summed over the fields). Documents that could not be
+            found are not included.
+    """
+    if not doc_ids:
+        return {}
+
+    cache = None
+    if termvector_cache_enabled():
+        cache = get_termvector_cache(index_generation(idx), fields)
+    result = cache.get_many(doc_ids) if cache else {}
+
+    missing = [doc_id for doc_id in doc_ids if doc_id not in result]
+    if missing:
+        bdy = {
+            'ids': missing,
+            'parameters': {
+                'fields': fields,
+                'term_statistics': False,
+                'field_statistics': False,
+                'offsets': False,
+                'payloads': False,
+                'positions': False
+            }
+        }
+        t_vectors = _es().mtermvectors(index=idx, doc_type=typ, body=bdy)
+
+        fetched = {}
+        for doc in t_vectors.get('docs'):
+            if not doc.get('found', False):
+                continue
+            terms = defaultdict(int)
+            for field, data in doc.get('term_vectors', {}).iteritems():
+                for term, details in data.get('terms').iteritems():
+                    terms[term] += int(details['term_freq'])
+            fetched[doc['_id']] = terms
+
+        if cache:
+            cache.set_many(fetched)
+        result.update(fetched)
+
+    return result
+
+
+def index_generation(idx):
+    """Return an identifier for the current generation of an index.
+
+    The uuid of an index changes when it is recreated, e.g. when an alias is
+    moved to a reindexed copy, so it is part of the termvector cache keys.
+    """
+    generation, expires = _generations.get(idx, (None, 0))
+    if time.time() > expires:
+        index_settings = _es().indices.get_settings(index=idx)
+        uuids = sorted(s['settings']['index']['uuid'] for s in index_settings.values())
+        generation = '-'.join(uuids)
+        _generations[idx] = (generation, time.time() + _GENERATION_TTL)
+    return generation
+
+
+def term_document_frequencies(idx, typ, date_ranges, exclude_distributions=[],
+                              num_terms=100000, min_doc_count=2):
+    """Return document frequencies per term using a terms aggregation.
+
+    Instead of retrieving the termvector of every document (see
+    :func:`termvector_wordcloud` with add_freqs=False), the document
+    frequencies are computed by Elasticsearch itself: the doc_count of a
+    terms aggregation bucket is the number of documents that contain the term.
+    The aggregation runs on the text field only, so terms that only occur in
+    article titles are not counted.
+
+    Parameters:
+        idx : str
+            The name of the elasticsearch index
+        typ : str
+            The type of document requested
+        date_ranges : list(dict)
+            A list of dictionaries containg the upper and lower dates of the
+            requested date ranges
+        exclude_distributions : list, optional
+            A list of strings respresenting distributions that should be
+            excluded
+        num_terms : int, optional
+            The maximum number of terms (ordered by document frequency) that
+            is returned
+        min_doc_count : int, optional
+            The minimal number of documents a term should occur in
+
+    Returns:
+        counter : Counter
+            A Counter that maps terms to their document frequency
+    """
+    agg_name = 'document_frequencies'
+
+    q = create_query(None, date_ranges, exclude_distributions, [], [])
+    q['aggs'] = {
+        agg_name: {
+            'terms': {
+                'field': _AGG_FIELD,
+                'size': num_terms,
+                'shard_size': num_terms,
+                'min_doc_count': min_doc_count
+            }
         }
     }
 
-    t_vectors = _es().mtermvectors(index=idx, doc_type=typ, body=bdy)
+    aggr = _es().search(index=idx, doc_type=typ, body=q, size=0)
 
-    for doc in t_vectors.get('docs'):
-        temp = defaultdict(int) if add_freqs else set()
-        for field, data in doc.get('term_vectors').iteritems():
-            for term, details in data.get('terms').iteritems():
-                if len(term) >= min_length:
-                    if add_freqs:
-                        temp[term] += int(details['term_freq'])
-                    else:
-                        temp.add(term)  # only count individual occurrences
-        wordcloud.update(temp)
+    result = Counter()
+    for bucket in aggr.get('aggregations').get(agg_name).get('buckets'):
+        result[bucket.get('key')] = bucket.get('doc_count')
 
-    return wordcloud
+    return result
 
 
 def get_search_parameters(req_dict):
@@ -554,14 +978,14 @@ def get_document_ids(idx, typ, query, date_ranges, exclude_distributions=[],
                      exclude_article_types, selected_pillars)
 
     date_field = 'paper_dc_date'
-    fields = [date_field]
+    hit_fields(q, [date_field])
     get_more_docs = True
     start = 0
     num = 2500
 
     while get_more_docs:
-        results = _es().search(index=idx, doc_type=typ, body=q, fields=fields,
-                               from_=start, size=num)
+        results = source_to_fields(_es().search(index=idx, doc_type=typ, body=q,
+                                                from_=start, size=num))
         for result in results['hits']['hits']:
             doc_ids.append(
                 {
@@ -586,13 +1010,46 @@ def document_id_chunks(chunk_size, idx, typ, query, date_ranges, dist=[],
     """
     q = create_query(query, date_ranges, dist, art_types, selected_pillars)
 
+    hit_fields(q)
+    get_more_docs = True
+    start = 0
+
+    while get_more_docs:
+        results = _es().search(index=idx, doc_type=typ, body=q, from_=start,
+                               size=chunk_size)
+        yield [result['_id'] for result in results['hits']['hits']]
+
+        start = start + chunk_size
+
+        if len(results['hits']['hits']) < chunk_size:
+            get_more_docs = False
+
+
+def random_document_id_chunks(chunk_size, idx, typ, query, date_ranges, dist=[],
+                              art_types=[], selected_pillars=[], seed=0):
+    """Generator for retrieving document ids for the results of a query in a
+    random order.
+
+    The order is determined by the seed, so consecutive chunks together form a
+    growing uniform random sample of the results. Used by the
+    generate_tv_cloud task in sampling mode.
+    """
+    q = create_query(query, date_ranges, dist, art_types, selected_pillars)
+    q['query'] = {
+        'function_score': {
+            'query': q['query'],
+            'functions': [{'random_score': {'seed': seed}}],
+            'boost_mode': 'replace'
+        }
+    }
+
+    hit_fields(q)
     get_more_docs = True
     start = 0
-    fields = []
 
     while get_more_docs:
         results = _es().search(index=idx, doc_type=typ, body=q, from_=start,
-                               fields=fields, size=chunk_size)
+                               size=chunk_size)
         yield [result['_id'] for result in results['hits']['hits']]
 
         start = start + chunk_size
@@ -670,5 +1127,86 @@ def get_stemmed_form(idx, word):
         word : str
             The input word
     """
-    result = indices.IndicesClient(_es()).analyze(index=idx, text=word, analyzer=_STEMMING_ANALYZER)
-    return result['tokens'][0]['token']
+    return get_stemmed_forms(idx, [word])[word]
+
+
+def get_stemmed_forms(idx, words, analyzer=STEMMING_ANALYZER, lookup=None):
+    """
+    Returns the stemmed forms of multiple words.
+
+    Stems are looked up in a process-wide LRU cache first, then via lookup
+    (if given), and finally in a single _analyze request for all remaining
+    words. Words for which the analyzer returns no tokens (e.g. stopwords)
+    are returned unchanged.
+
+    Parameters:
+        idx : str
+            The name of the elasticsearch index
+        words : list(str)
+            The input words
+        analyzer : str, optional
+            The name of the analyzer
+        lookup : function, optional
+            A function that returns a dictionary of the stems it knows for a
+            list of words, e.g. from a precomputed table
+
+    Returns:
+        dict : dict
+            A dictionary that maps the words to their stemmed forms
+    """
+    result = {}
+    missing = []
+    for word in set(words):
+        stem = _stems.get((idx, analyzer, word))
+        if stem is not None:
+            result[word] = stem
+        else:
+            missing.append(word)
+
+    found = {}
+    if missing and lookup:
+        found = lookup(missing)
+        result.update(found)
+        missing = [w for w in missing if w not in found]
+
+    if missing:
+        result.update(analyze_words(idx, missing, analyzer))
+
+    for word in missing + found.keys():
+        _stems.set((idx, analyzer, word), result[word])
+
+    return result
+
+
+def analyze_words(idx, words, analyzer=STEMMING_ANALYZER):
+    """
+    Returns the first token produced by an analyzer for each word in a single
+    _analyze request, or the word itself if no token was produced.
+
+    The words are joined by newlines; tokens are mapped back to their words
+    via their offsets (see :func:`first_tokens`).
+    """
+    text = u'\n'.join(words)
+    result = _es().indices.analyze(index=idx, analyzer=analyzer, body=text.encode('utf-8'))
+    return first_tokens(words, result['tokens'])
+
+
+def first_tokens(words, tokens):
+    """
+    Maps the tokens of an _analyze request for the newline-joined words to
+    the words, and returns the first token per word (or the word itself if
+    it has no tokens).
+    """
+    starts = []
+    offset = 0
+    for word in words:
+        starts.append(offset)
+        offset += len(word) + 1
+
+    result = {}
+    for token in tokens:
+        word = words[bisect_right(starts, token['start_offset']) - 1]
+        if word not in result:
+            result[word] = token['token']
+
+    return {word: result.get(word, word) for word in words}
@@ -0,0 +1,744 @@
+# -*- coding: utf-8 -*-
+"""In-process stand-in for Elasticsearch.
+
+:class:`FakeElasticsearch` implements the subset of the Elasticsearch (1.x)
+client API that Texcavator uses: search (with the filters, query strings and
+terms and date histogram aggregations built in services.es), scroll, count,
+mget, mtermvectors, termvector, bulk, and the indices operations exists,
+create, get_settings, validate_query and analyze. Documents are held in memory and every request is
+evaluated by a linear scan, which is fast enough for corpora of some tens of
+thousands of documents.
+
+Set ES_FAKE_DOCUMENTS to let services.es use a stand-in with a synthetic
+corpus of that many documents (see services.corpus), e.g. for tests and
+benchmarks without an Elasticsearch cluster. Scores are simple term
+frequencies, so rankings differ from those of Elasticsearch.
+"""
+import calendar
+import fnmatch
+import hashlib
+import re
+import time
+import uuid
+from collections import Counter, OrderedDict
+from datetime import datetime
+
+from elasticsearch import NotFoundError, RequestError
+
+# Fields that are analyzed (tokenized and lowercased); other fields are matched as a whole
+ANALYZED_FIELDS = ('text_content', 'article_dc_title', 'paper_dc_title')
+# Fields searched by query strings without a field (the _all field in the KB index)
+DEFAULT_FIELDS = ('text_content', 'article_dc_title')
+# Date fields, for which terms aggregations return timestamps
+DATE_FIELDS = ('paper_dc_date',)
+
+_STOPWORDS = frozenset([u'de', u'het', u'een', u'en', u'van', u'in', u'te', u'dat', u'die', u'op'])
+_SUFFIXES = (u'heden', u'ingen', u'en', u'e', u's')
+
+_TOKEN = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """
+    Returns the (lowercased) tokens in a text, with their start and end offsets.
+    """
+    return [(m.group().lower(), m.start(), m.end()) for m in _TOKEN.finditer(text or u'')]
+
+
+def stem(token):
+    """
+    Returns the stem of a token: a crude approximation of the Dutch snowball stemmer.
+    """
+    for suffix in _SUFFIXES:
+        if token.endswith(suffix) and len(token) - len(suffix) >= 3:
+            return token[:-len(suffix)]
+    return token
+
+
+def analyze(text, analyzer=None):
+    """
+    Returns the tokens of a text as an analyzer would; the dutch_analyzer also
+    removes stopwords and stems.
+    """
+    tokens = tokenize(text)
+    if analyzer == 'dutch_analyzer':
+        tokens = [(stem(t), start, end) for t, start, end in tokens if t not in _STOPWORDS]
+    return tokens
+
+
+class QueryStringError(ValueError):
+    pass
+
+
+class FakeDocument(object):
+    """A document, with its analyzed fields (computed when first needed)."""
+
+    def __init__(self, doc_id, doc_type, source):
+        self.id = doc_id
+        self.type = doc_type
+        self.source = source
+        self._tokens = {}
+
+    def value(self, field):
+        if field.endswith('.raw') or field.endswith('.stemmed'):
+            field = field.rsplit('.', 1)[0]
+        return self.source.get(field)
+
+    def tokens(self, field):
+        """
+        Returns the tokens of a field; for '.stemmed' fields, the stemmed tokens.
+        """
+        if field not in self._tokens:
+            if field.endswith('.stemmed'):
+                tokens = [stem(t) for t in self.tokens(field[:-len('.stemmed')])]
+            else:
+                tokens = [t for t, _, _ in tokenize(self.value(field))]
+            self._tokens[field] = tokens
+        return self._tokens[field]
+
+    def terms(self, field):
+        """
+        Returns the terms of a field: the tokens of analyzed fields, otherwise the value itself.
+        """
+        if field.split('.')[0] in ANALYZED_FIELDS and not field.endswith('.raw'):
+            return self.tokens(field)
+        value = self.value(field)
+        if value is None:
+            return []
+        return value if isinstance(value, list) else [value]
+
+
+class FakeIndex(object):
+    def __init__(self, name, body=None):
+        self.name = name
+        self.uuid = uuid.uuid4().hex
+        self.body = body or {}
+        self.docs = OrderedDict()
+
+    def add(self, doc_id, doc_type, source):
+        self.docs[doc_id] = FakeDocument(doc_id, doc_type, source)
+
+    def documents(self, doc_type=None):
+        for doc in self.docs.itervalues():
+            if doc_type is None or doc.type == doc_type:
+                yield doc
+
+
+class FakeElasticsearch(object):
+    """Stand-in for elasticsearch.Elasticsearch."""
+
+    def __init__(self):
+        self._indices = {}
+        self._scrolls = {}
+        self.indices = FakeIndicesClient(self)
+
+    @classmethod
+    def with_corpus(cls, index, doc_type, documents):
+        """
+        Returns a stand-in with an index that contains documents, (document id, source) tuples.
+        """
+        es = cls()
+        idx = es.create_index(index)
+        for doc_id, source in documents:
+            idx.add(doc_id, doc_type, source)
+        return es
+
+    def create_index(self, name, body=None):
+        self._indices[name] = FakeIndex(name, body)
+        return self._indices[name]
+
+    def _index(self, name):
+        if name not in self._indices:
+            raise NotFoundError(404, 'IndexMissingException[[{}] missing]'.format(name))
+        return self._indices[name]
+
+    def index(self, index, doc_type, body, id=None, **params):
+        doc_id = id or uuid.uuid4().hex
+        if index not in self._indices:
+            self.create_index(index)
+        self._indices[index].add(doc_id, doc_type, body)
+        return {'_index': index, '_type': doc_type, '_id': doc_id, '_version': 1, 'created': True}
+
+    def bulk(self, body, index=None, doc_type=None, **params):
+        start = time.time()
+        items = []
+        actions = iter(body)
+        for action in actions:
+            (op, meta), = action.items()
+            idx = meta.get('_index', index)
+            typ = meta.get('_type', doc_type)
+            if op in ('index', 'create'):
+                result = self.index(idx, typ, next(actions), id=meta.get('_id'))
+            elif op == 'delete':
+                self._index(idx).docs.pop(meta['_id'], None)
+                result = {'_index': idx, '_type': typ, '_id': meta['_id']}
+            else:
+                raise RequestError(400, 'ActionRequestValidationException', 'Unsupported action {}'.format(op))
+            result['status'] = 200
+            items.append({op: result})
+        return {'took': _took(start), 'errors': False, 'items': items}
+
+    def search(self, index=None, doc_type=None, body=None, **params):
+        start = time.time()
+        body = body or {}
+        query = body.get('query', {'match_all': {}})
+        docs = self._matching(index, doc_type, query)
+
+        result = {
+            'timed_out': False,
+            '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+            'hits': {
+                'total': len(docs),
+                'max_score': max(score for score, _ in docs) if docs else None,
+                'hits': []
+            }
+        }
+
+        size = int(params.get('size', body.get('size', 10)))
+        if params.get('search_type') == 'scan':
+            # The first page of a scan only contains the scroll id
+            scroll_id = uuid.uuid4().hex
+            self._scrolls[scroll_id] = (index, body, params, docs, [0], size)
+            result['_scroll_id'] = scroll_id
+        elif params.get('search_type') != 'count' and size > 0:
+            offset = int(params.get('from_', body.get('from', 0)))
+            docs = _sort(docs, params.get('sort'))
+            result['hits']['hits'] = [self._hit(index, doc, score, body, params)
+                                      for score, doc in docs[offset:offset + size]]
+            if 'scroll' in params:
+                scroll_id = uuid.uuid4().hex
+                self._scrolls[scroll_id] = (index, body, params, docs, [offset + size], size)
+                result['_scroll_id'] = scroll_id
+
+        if 'aggs' in body or 'aggregations' in body:
+            aggs = body.get('aggs', body.get('aggregations'))
+            result['aggregations'] = {name: _aggregate(agg, [doc for _, doc in docs])
+                                      for name, agg in aggs.iteritems()}
+
+        result['took'] = _took(start)
+        return result
+
+    def scroll(self, scroll_id=None, body=None, **params):
+        start = time.time()
+        scroll_id = scroll_id or body
+        if scroll_id not in self._scrolls:
+            raise NotFoundError(404, 'SearchContextMissingException[No search context found]')
+        index, body, search_params, docs, position, size = self._scrolls[scroll_id]
+        hits = [self._hit(index, doc, score, body, search_params)
+                for score, doc in docs[position[0]:position[0] + size]]
+        position[0] += size
+        return {'_scroll_id': scroll_id, 'took': _took(start), 'timed_out': False,
+                '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+                'hits': {'total': len(docs), 'max_score': None, 'hits': hits}}
+
+    def clear_scroll(self, scroll_id=None, body=None, **params):
+        for s in (scroll_id or body or '').split(','):
+            self._scrolls.pop(s, None)
+        return {}
+
+    def count(self, index=None, doc_type=None, body=None, **params):
+        query = (body or {}).get('query', {'match_all': {}})
+        return {'count': len(self._matching(index, doc_type, query)),
+                '_shards': {'total': 1, 'successful': 1, 'failed': 0}}
+
+    def mget(self, body, index=None, doc_type=None, **params):
+        include = _field_list(params.get('_source_include'))
+        exclude = _field_list(params.get('_source_exclude'))
+        ids = body.get('ids') or [d['_id'] for d in body.get('docs', [])]
+
+        idx = self._index(index)
+        docs = []
+        for doc_id in ids:
+            doc = idx.docs.get(doc_id)
+            if doc is None or (doc_type and doc.type != doc_type):
+                docs.append({'_index': index, '_type': doc_type, '_id': doc_id, 'found': False})
+                continue
+            source = {k: v for k, v in doc.source.iteritems()
+                      if (not include or k in include) and (not exclude or k not in exclude)}
+            docs.append({'_index': index, '_type': doc.type, '_id': doc_id, '_version': 1,
+                         'found': True, '_source': source})
+        return {'docs': docs}
+
+    def termvector(self, index, doc_type, id, body=None, **params):
+        fields = _field_list(params.get('fields')) or (body or {}).get('fields') or DEFAULT_FIELDS
+        return self._termvector(self._index(index), doc_type, id, fields)
+
+    def mtermvectors(self, index=None, doc_type=None, body=None, **params):
+        start = time.time()
+        body = body or {}
+        fields = body.get('parameters', {}).get('fields') or _field_list(params.get('fields')) or DEFAULT_FIELDS
+        ids = body.get('ids') or [d['_id'] for d in body.get('docs', [])]
+
+        idx = self._index(index)
+        return {'docs': [self._termvector(idx, doc_type, doc_id, fields) for doc_id in ids],
+                'took': _took(start)}
+
+    def _termvector(self, idx, doc_type, doc_id, fields):
+        doc = idx.docs.get(doc_id)
+        if doc is None or (doc_type and doc.type != doc_type):
+            return {'_index': idx.name, '_type': doc_type, '_id': doc_id, 'found': False}
+
+        term_vectors = {}
+        for field in fields:
+            tokens = doc.tokens(field)
+            if tokens:
+                term_vectors[field] = {'terms': {t: {'term_freq': c} for t, c in Counter(tokens).iteritems()}}
+        return {'_index': idx.name, '_type': doc.type, '_id': doc_id, '_version': 1, 'found': True,
+                'term_vectors': term_vectors}
+
+    def _matching(self, index, doc_type, query):
+        """
+        Returns (score, document) tuples for the documents that match a query.
+        """
+        try:
+            evaluator = QueryEvaluator(self, query)
+        except QueryStringError as e:
+            raise RequestError(400, 'SearchPhaseExecutionException', str(e))
+
+        docs = []
+        for doc in self._index(index).documents(doc_type):
+            score = evaluator.score(doc)
+            if score is not None:
+                docs.append((score, doc))
+        return docs
+
+    def _hit(self, index, doc, score, body, params):
+        hit = {'_index': index, '_type': doc.type, '_id': doc.id, '_score': score}
+        # As in ES 1.x, fields are read from the _source; none of the fields are stored (ES 5 stored_fields)
+        fields = body.get('fields')
+        if fields:
+            hit['fields'] = {f: [doc.value(f)] for f in fields if doc.value(f) is not None}
+        source = body.get('_source', 'stored_fields' not in body)
+        if source is not False and fields is None:
+            include = _field_list(params.get('_source_include')) or (source if isinstance(source, list) else None)
+            exclude = _field_list(params.get('_source_exclude'))
+            hit['_source'] = {k: v for k, v in doc.source.iteritems()
+                              if (not include or k in include) and (not exclude or k not in exclude)}
+        return hit
+
+    def lookup_terms(self, lookup):
+        """
+        Returns the terms for a terms lookup: a path in a document in another index.
+        """
+        doc = self._index(lookup['index']).docs.get(lookup['id'])
+        if doc is None:
+            return []
+        value = doc.source
+        for part in lookup['path'].split('.'):
+            value = value.get(part, {}) if isinstance(value, dict) else {}
+        return value if isinstance(value, list) else [value]
+
+
+class FakeIndicesClient(object):
+    """Stand-in for elasticsearch.client.IndicesClient."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def exists(self, index, **params):
+        return index in self.client._indices
+
+    def create(self, index, body=None, **params):
+        if index in self.client._indices:
+            raise RequestError(400, 'IndexAlreadyExistsException[[{}] already exists]'.format(index))
+        self.client.create_index(index, body)
+        return {'acknowledged': True}
+
+    def get_settings(self, index=None, **params):
+        idx = self.client._index(index)
+        idx_settings = dict(idx.body.get('settings', {}), uuid=idx.uuid)
+        return {index: {'settings': {'index': idx_settings}}}
+
+    def validate_query(self, index=None, doc_type=None, body=None, **params):
+        self.client._index(index)
+        explanation = {'index': index, 'valid': True}
+        try:
+            QueryEvaluator(self.client, (body or {}).get('query', {'match_all': {}}))
+        except QueryStringError as e:
+            explanation = {'index': index, 'valid': False, 'error': str(e)}
+        return {'valid': explanation['valid'],
+                '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+                'explanations': [explanation]}
+
+    def analyze(self, index=None, body=None, **params):
+        text = body.decode('utf-8') if isinstance(body, str) else body or params.get('text', u'')
+        tokens = analyze(text, params.get('analyzer'))
+        return {'tokens': [{'token': t, 'start_offset': start, 'end_offset': end, 'type': '<ALPHANUM>',
+                            'position': i + 1} for i, (t, start, end) in enumerate(tokens)]}
+
+
+class QueryEvaluator(object):
+    """Evaluates a query in the query DSL against documents.
+
+    The score of a document is None if it does not match.
+    """
+
+    def __init__(self, client, query):
+        self.client = client
+        self.query = self._compile(query)
+
+    def score(self, doc):
+        return self.query(doc)
+
+    def _compile(self, query, in_filter=False):
+        (kind, spec), = query.items()
+        compile_kind = getattr(self, '_compile_' + kind, None)
+        if compile_kind is None:
+            raise QueryStringError('No query registered for [{}]'.format(kind))
+        return compile_kind(spec, in_filter)
+
+    def _compile_match_all(self, spec, in_filter):
+        return lambda doc: 1.0
+
+    def _compile_filtered(self, spec, in_filter):
+        query = self._compile(spec.get('query', {'match_all': {}}), in_filter)
+        filt = self._compile(spec.get('filter', {'match_all': {}}), True)
+        return lambda doc: query(doc) if filt(doc) is not None else None
+
+    def _compile_bool(self, spec, in_filter):
+        def clauses(name, filter_context):
+            value = spec.get(name, [])
+            return [self._compile(c, filter_context) for c in (value if isinstance(value, list) else [value])]
+
+        must = clauses('must', in_filter)
+        filters = clauses('filter', True)
+        should = clauses('should', in_filter)
+        must_not = clauses('must_not', True)
+        should_required = bool(should) and (in_filter or not (must or filters))
+
+        def evaluate(doc):
+            score = 0.0
+            for clause in must:
+                s = clause(doc)
+                if s is None:
+                    return None
+                score += s
+            for clause in filters:
+                if clause(doc) is None:
+                    return None
+            for clause in must_not:
+                if clause(doc) is not None:
+                    return None
+            should_scores = [s for s in (clause(doc) for clause in should) if s is not None]
+            if should_required and not should_scores:
+                return None
+            return score + sum(should_scores) if (must or should_scores) else 1.0
+        return evaluate
+
+    def _compile_function_score(self, spec, in_filter):
+        query = self._compile(spec.get('query', {'match_all': {}}), in_filter)
+        seed = None
+        for function in spec.get('functions', []):
+            if 'random_score' in function:
+                seed = function['random_score'].get('seed', 0)
+
+        def evaluate(doc):
+            score = query(doc)
+            if score is None or seed is None:
+                return score
+            digest = hashlib.md5(u'{}:{}'.format(seed, doc.id).encode('utf-8')).hexdigest()
+            return int(digest[:8], 16) / float(0xffffffff)
+        return evaluate
+
+    def _compile_term(self, spec, in_filter):
+        (field, value), = spec.items()
+        value = value.get('value') if isinstance(value, dict) else value
+        return lambda doc: 1.0 if value in doc.terms(field) else None
+
+    def _compile_terms(self, spec, in_filter):
+        (field, values), = [(k, v) for k, v in spec.items() if k not in ('execution', '_cache')]
+        if isinstance(values, dict):
+            values = self.client.lookup_terms(values)
+        values = frozenset(values)
+        return lambda doc: 1.0 if values.intersection(doc.terms(field)) else None
+
+    def _compile_prefix(self, spec, in_filter):
+        (field, prefix), = spec.items()
+        prefix = prefix.get('value') if isinstance(prefix, dict) else prefix
+        return lambda doc: 1.0 if any(t.startswith(prefix) for t in doc.terms(field)) else None
+
+    def _compile_range(self, spec, in_filter):
+        (field, bounds), = spec.items()
+
+        def evaluate(doc):
+            value = doc.value(field)
+            if value is None:
+                return None
+            if ('gte' in bounds and value < bounds['gte']) or ('gt' in bounds and value <= bounds['gt']) or \
+                    ('lte' in bounds and value > bounds['lte']) or ('lt' in bounds and value >= bounds['lt']):
+                return None
+            return 1.0
+        return evaluate
+
+    def _compile_ids(self, spec, in_filter):
+        ids = frozenset(spec.get('values', []))
+        return lambda doc: 1.0 if doc.id in ids else None
+
+    def _compile_query_string(self, spec, in_filter):
+        parser = QueryStringParser(spec['query'], spec.get('allow_leading_wildcard', True))
+        return parser.parse()
+
+
+class QueryStringParser(object):
+    """Parser for the query string syntax of Lucene (a practical subset).
+
+    Supports terms, phrases, wildcards (* and ?), fields (field:term), boosts
+    (term^2), grouping with parentheses, +/- and AND/OR/NOT operators.
+    """
+    _OPERATORS = {'AND': 'AND', '&&': 'AND', 'OR': 'OR', '||': 'OR', 'NOT': 'NOT'}
+    _SPECIAL = u' \t\n()"^:'
+
+    def __init__(self, query, allow_leading_wildcard=True):
+        self.tokens = self._scan(query)
+        self.position = 0
+        self.allow_leading_wildcard = allow_leading_wildcard
+
+    def _scan(self, query):
+        tokens = []
+        i = 0
+        while i < len(query):
+            c = query[i]
+            if c.isspace():
+                i += 1
+            elif c in u'()':
+                tokens.append((c, c))
+                i += 1
+            elif c == u'"':
+                end = query.find(u'"', i + 1)
+                if end < 0:
+                    raise QueryStringError(u'Cannot parse \'{}\': unterminated phrase'.format(query))
+                tokens.append(('PHRASE', query[i + 1:end]))
+                i = end + 1
+            elif c in u'+-' and (not tokens or query[i - 1].isspace() or query[i - 1] == u'('):
+                tokens.append((c, c))
+                i += 1
+            elif c in u'^:':
+                tokens.append((c, c))
+                i += 1
+            else:
+                term = []
+                while i < len(query) and query[i] not in self._SPECIAL:
+                    if query[i] == u'\\' and i + 1 < len(query):
+                        i += 1
+                    term.append(query[i])
+                    i += 1
+                term = u''.join(term)
+                tokens.append((self._OPERATORS.get(term, 'TERM'), term))
+        return tokens
+
+    def _peek(self):
+        return self.tokens[self.position][0] if self.position < len(self.tokens) else None
+
+    def _next(self):
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def parse(self):
+        query = self._parse_clauses()
+        if self.position < len(self.tokens):
+            raise QueryStringError(u'Cannot parse: unexpected \'{}\''.format(self.tokens[self.position][1]))
+        return query
+
+    def _parse_clauses(self):
+        # Occurrences: '+' (must), '-' (must not) or '' (should), following the classic Lucene parser
+        clauses = []
+        while self._peek() not in (None, ')'):
+            conjunction = None
+            if self._peek() in ('AND', 'OR'):
+                if not clauses:
+                    raise QueryStringError(u'Cannot parse: query starts with an operator')
+                conjunction = self._next()[0]
+            occur = ''
+            if self._peek() in ('+', '-', 'NOT'):
+                occur = '-' if self._next()[0] in ('-', 'NOT') else '+'
+            if conjunction == 'AND':
+                if clauses[-1][0] == '':
+                    clauses[-1] = ('+', clauses[-1][1])
+                if occur == '':
+                    occur = '+'
+            clauses.append((occur, self._parse_clause()))
+        if not clauses:
+            raise QueryStringError(u'Cannot parse: empty query')
+
+        must = [q for o, q in clauses if o == '+']
+        should = [q for o, q in clauses if o == '']
+        must_not = [q for o, q in clauses if o == '-']
+
+        def evaluate(doc):
+            score = 0.0
+            for clause in must:
+                s = clause(doc)
+                if s is None:
+                    return None
+                score += s
+            for clause in must_not:
+                if clause(doc) is not None:
+                    return None
+            should_scores = [s for s in (clause(doc) for clause in should) if s is not None]
+            if not must and not should_scores:
+                return None if should else 1.0
+            return score + sum(should_scores)
+        return evaluate
+
+    def _parse_clause(self):
+        fields = DEFAULT_FIELDS
+        kind = self._peek()
+        if kind is None:
+            raise QueryStringError(u'Cannot parse: unexpected end of query')
+        if kind == 'TERM' and self.position + 1 < len(self.tokens) and self.tokens[self.position + 1][0] == ':':
+            fields = (self._next()[1],)
+            self._next()
+            kind = self._peek()
+
+        if kind == '(':
+            self._next()
+            query = self._parse_clauses()
+            if self._peek() != ')':
+                raise QueryStringError(u'Cannot parse: missing closing parenthesis')
+            self._next()
+        elif kind == 'PHRASE':
+            query = self._phrase(self._next()[1], fields)
+        elif kind == 'TERM':
+            query = self._term(self._next()[1], fields)
+        else:
+            raise QueryStringError(u'Cannot parse: unexpected \'{}\''.format(self.tokens[self.position][1]))
+
+        if self._peek() == '^':
+            self._next()
+            try:
+                boost = float(self._next()[1])
+            except (IndexError, ValueError):
+                raise QueryStringError(u'Cannot parse: invalid boost')
+            return _boosted(query, boost)
+        return query
+
+    def _term(self, term, fields):
+        if term[:1] in u'*?' and not self.allow_leading_wildcard:
+            raise QueryStringError(u'Cannot parse \'{}\': \'*\' or \'?\' not allowed as first character '
+                                   u'in WildcardQuery'.format(term))
+        wildcard = u'*' in term or u'?' in term
+
+        analyzed = [f for f in fields if f.split('.')[0] in ANALYZED_FIELDS]
+        keyword = [f for f in fields if f not in analyzed]
+        words = [t for t, _, _ in tokenize(term)] if not wildcard else [term.lower()]
+
+        def evaluate(doc):
+            score = 0.0
+            for field in analyzed:
+                tokens = doc.tokens(field)
+                for word in words:
+                    if wildcard:
+                        score += sum(1 for t in tokens if fnmatch.fnmatchcase(t, word))
+                    else:
+                        score += tokens.count(word)
+            for field in keyword:
+                value = doc.value(field)
+                if value is not None and (fnmatch.fnmatchcase(value, term) if wildcard else value == term):
+                    score += 1
+            return score or None
+        return evaluate
+
+    def _phrase(self, phrase, fields):
+        words = [t for t, _, _ in tokenize(phrase)]
+
+        def evaluate(doc):
+            score = 0.0
+            for field in fields:
+                tokens = doc.tokens(field)
+                n = len(words)
+                score += sum(1 for i in xrange(len(tokens) - n + 1) if tokens[i:i + n] == words)
+            return score or None
+        return evaluate
+
+
+def _boosted(query, boost):
+    def evaluate(doc):
+        score = query(doc)
+        return score * boost if score is not None else None
+    return evaluate
+
+
+def _aggregate(agg, docs):
+    (kind, spec), = [(k, v) for k, v in agg.items() if k != 'aggs']
+    if kind == 'date_histogram':
+        return _date_histogram(spec, docs)
+    if kind != 'terms':
+        raise RequestError(400, 'SearchParseException', 'Unsupported aggregation [{}]'.format(kind))
+
+    field = spec['field']
+    counts = Counter()
+    for doc in docs:
+        counts.update(set(doc.terms(field)))
+
+    min_doc_count = spec.get('min_doc_count', 1)
+    buckets = sorted(((k, c) for k, c in counts.iteritems() if c >= min_doc_count), key=lambda b: (-b[1], b[0]))
+    size = spec.get('size', 10) or len(buckets)
+
+    result = []
+    for key, count in buckets[:size]:
+        bucket = {'key': key, 'doc_count': count}
+        if field in DATE_FIELDS:
+            day = datetime.strptime(key, '%Y-%m-%d')
+            bucket = {'key': calendar.timegm(day.timetuple()) * 1000,
+                      'key_as_string': key + 'T00:00:00.000Z',
+                      'doc_count': count}
+        result.append(bucket)
+
+    return {'doc_count_error_upper_bound': 0,
+            'sum_other_doc_count': sum(c for _, c in buckets[size:]),
+            'buckets': result}
+
+
+def _date_histogram(spec, docs):
+    """
+    Returns the buckets of a date histogram with an interval of a year, month or day.
+    """
+    lengths = {'year': 4, 'month': 7, 'day': 10}
+    if spec.get('interval') not in lengths:
+        raise RequestError(400, 'SearchParseException', 'Unsupported interval [{}]'.format(spec.get('interval')))
+
+    counts = Counter()
+    for doc in docs:
+        value = doc.value(spec['field'])
+        if value:
+            counts[value[:lengths[spec['interval']]]] += 1
+
+    # The length of the key as string per format (datetime.strftime does not support years before 1900)
+    formats = {'yyyy': 4, 'yyyy-MM': 7, 'yyyy-MM-dd': 10}
+    result = []
+    for key in sorted(counts):
+        if counts[key] < spec.get('min_doc_count', 1):
+            continue
+        first_day = (key + '-01-01')[:10]
+        day = datetime.strptime(first_day, '%Y-%m-%d')
+        as_string = first_day[:formats[spec['format']]] if spec.get('format') in formats else \
+            first_day + 'T00:00:00.000Z'
+        result.append({'key': calendar.timegm(day.timetuple()) * 1000,
+                       'key_as_string': as_string,
+                       'doc_count': counts[key]})
+    return {'buckets': result}
+
+
+def _sort(docs, sort=None):
+    """
+    Sorts (score, document) tuples by a sort parameter, e.g. 'paper_dc_date:asc,_score'.
+    """
+    keys = [s.split(':') for s in (sort or '_score').split(',')]
+    for key in reversed(keys):
+        field, order = key[0], key[1] if len(key) > 1 else ('desc' if key[0] == '_score' else 'asc')
+        if field == '_score':
+            docs = sorted(docs, key=lambda d: d[0], reverse=order == 'desc')
+        else:
+            docs = sorted(docs, key=lambda d: d[1].value(field), reverse=order == 'desc')
+    return docs
+
+
+def _field_list(value):
+    if not value:
+        return None
+    return value.split(',') if isinstance(value, basestring) else list(value)
+
+
+def _took(start):
+    return int((time.time() - start) * 1000)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark Elasticsearch-heavy operations (see services.benchmark).
+
+Available scenarios: search, count, metadata, timeline, tvcloud, aggcloud,
+export, and xmlwriter and dicttoxml (XML serialization of --documents search
+results, by the export and by its former implementation). The word cloud
+scenarios require a set of document ids in the database (see gatherdocids).
+Without --query, the query scenarios use random weighted queries of the
+stored query terms (see gatherqueryterms).
+
+Results can be written to a JSON file with --output, and compared against
+such a file with --baseline.
+"""
+import json
+from datetime import datetime
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from query.archive import available_archive_formats
+from services.benchmark import SCENARIOS, run_scenario, summarize, compare, load_results
+
+
+class Command(BaseCommand):
+    args = '<scenario ...>'
+    help = 'Benchmarks the given scenarios (default: all). ' \
+           'Available scenarios: {}. Make sure ElasticSearch is running!'.format(', '.join(sorted(SCENARIOS)))
+    option_list = BaseCommand.option_list + (
+        make_option('--iterations',
+                    dest='iterations',
+                    type='int',
+                    default=20,
+                    help='Number of measured iterations per scenario'),
+        make_option('--warmup',
+                    dest='warmup',
+                    type='int',
+                    default=2,
+                    help='Number of iterations per scenario before measuring'),
+        make_option('--concurrency',
+                    dest='concurrency',
+                    type='int',
+                    default=1,
+                    help='Number of threads running the iterations'),
+        make_option('--documents',
+                    dest='documents',
+                    type='int',
+                    default=2500,
+                    help='Number of documents per word cloud, export or XML serialization'),
+        make_option('--query',
+                    action='append',
+                    dest='queries',
+                    default=[],
+                    help='Query for the query scenarios (can be repeated)'),
+        make_option('--export-format',
+                    dest='export_format',
+                    default='json',
+                    choices=['json', 'jsonl', 'xml'],
+                    help='Format of the export scenario'),
+        make_option('--metadata-only',
+                    action='store_true',
+                    dest='metadata_only',
+                    default=False,
+                    help='Export only the metadata (without the text) in the export scenario'),
+        make_option('--archive',
+                    dest='archive',
+                    default='zip',
+                    choices=available_archive_formats(),
+                    help='Archive format of the export scenario'),
+        make_option('--compression-level',
+                    dest='compression_level',
+                    type='int',
+                    default=getattr(settings, 'QUERY_DATA_COMPRESSION_LEVEL', 6),
+                    help='Compression level of the export scenario'),
+        make_option('--compression-workers',
+                    dest='compression_workers',
+                    type='int',
+                    default=getattr(settings, 'QUERY_DATA_COMPRESSION_WORKERS', 1),
+                    help='Number of threads that compress in the export scenario'),
+        make_option('--seed',
+                    dest='seed',
+                    type='int',
+                    default=None,
+                    help='Seed for the random selection of queries and documents'),
+        make_option('--output',
+                    dest='output',
+                    default=None,
+                    help='Write the results to this JSON file'),
+        make_option('--baseline',
+                    dest='baseline',
+                    default=None,
+                    help='Compare the results with this JSON file (written with --output)'),
+        make_option('--tolerance',
+                    dest='tolerance',
+                    type='float',
+                    default=0.1,
+                    help='Relative increase of a percentile that counts as a regression'),
+    )
+
+    def handle(self, *args, **options):
+        names = args or sorted(SCENARIOS)
+        if options['iterations'] < 1:
+            raise CommandError('At least one iteration is required')
+        unknown = [name for name in names if name not in SCENARIOS]
+        if unknown:
+            raise CommandError('Unknown scenario(s): {}'.format(', '.join(unknown)))
+
+        results = {}
+        print '{:<10} {:>6} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+            'scenario', 'iter', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms', 'ops/s')
+        for name in names:
+            scenario = SCENARIOS[name](options)
+            try:
+                durations, wall = run_scenario(scenario, options['iterations'], options['warmup'],
+                                               options['concurrency'])
+            except Exception as e:
+                raise CommandError(u'Scenario {} failed: {}'.format(name, e))
+            results[name] = summary = summarize(durations, wall)
+            print '{:<10} {iterations:>6} {mean_ms:>9.1f} {p50_ms:>9.1f} {p95_ms:>9.1f} {p99_ms:>9.1f} ' \
+                  '{throughput:>9.2f}'.format(name, **summary)
+            if scenario.documents_per_run and summary['throughput']:
+                summary['documents_per_second'] = summary['throughput'] * scenario.documents_per_run
+                print '{:<10} {:>6} {documents_per_second:>9.0f} documents/s'.format('', '', **summary)
+
+        if options['output']:
+            used = {k: options[k] for k in ('iterations', 'warmup', 'concurrency', 'documents', 'queries',
+                                            'export_format', 'metadata_only', 'archive', 'compression_level',
+                                            'compression_workers', 'seed')}
+            with open(options['output'], 'w') as out:
+                json.dump({'date': datetime.now().isoformat(), 'options': used, 'results': results},
+                          out, indent=2)
+
+        if options['baseline']:
+            regressions = self.compare(results, load_results(options['baseline']), options['tolerance'])
+            if regressions:
+                raise CommandError('{} regression(s) compared to {}'.format(regressions, options['baseline']))
+
+    def compare(self, results, baseline, tolerance):
+        print
+        regressions = 0
+        for name, stat, old, new, change, regression in compare(results, baseline, tolerance):
+            print '{:<10} {:<7} {:>9.1f} -> {:>9.1f} ms ({:+.0%}){}'.format(
+                name, stat, old, new, change, '  REGRESSION' if regression else '')
+            regressions += regression
+        return regressions
@@ -2,71 +2,240 @@
 # -*- coding: utf-8 -*-
 """Gather document ids of documents in the index and store them in the
 database. The collection of document ids is used for testing ElasticSearch
-performance on term aggregations (command: esperformance).
+performance on term aggregations (command: benchmark).
+
+The index is partitioned by year (of paper_dc_date). The partitions are
+scanned in parallel with scrolls, and the ids are written to the database in
+batches as they arrive (via COPY on PostgreSQL). Exactly the requested number
+of ids is stored, and every year contributes in proportion to its number of
+documents, so that the document ids reflect the distribution of the corpus
+over time. With --no-stratify, the first ids in index order are taken instead,
+with a single scroll.
 """
 import logging
+import threading
+from Queue import Queue, Empty
+from StringIO import StringIO
+from optparse import make_option
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
+from django.db import connection, transaction
 
-from services.es import _es
-from services.models import DocID
+from elasticsearch.helpers import scan
+
+from services.es import _es, hit_fields, filtered_query
+from services.models import DocID, random_key
 
 logger = logging.getLogger(__name__)
 
 
+class Budget(object):
+    """A number of document ids that can be taken by several threads"""
+
+    def __init__(self, remaining):
+        self.remaining = remaining
+        self.lock = threading.Lock()
+
+    def take(self, n):
+        """Takes at most n of the remaining ids and returns how many were taken"""
+        with self.lock:
+            taken = min(n, self.remaining)
+            self.remaining -= taken
+            return taken
+
+
+def year_counts():
+    """Returns the number of documents in the index per year"""
+    body = {
+        'query': {'match_all': {}},
+        'aggs': {
+            'years': {
+                'date_histogram': {
+                    'field': 'paper_dc_date',
+                    'interval': 'year',
+                    'format': 'yyyy',
+                }
+            }
+        },
+    }
+    result = _es().search(index=settings.ES_INDEX, doc_type=settings.ES_DOCTYPE, body=body, search_type='count')
+    return {int(b['key_as_string']): b['doc_count']
+            for b in result['aggregations']['years']['buckets'] if b['doc_count']}
+
+
+def stratified_quotas(counts, n):
+    """Divides n over the years in proportion to their number of documents
+    (rounded with the largest remainder method, so that the quotas add up to n)
+    """
+    total = sum(counts.values())
+    exact = {year: float(n) * count / total for year, count in counts.iteritems()}
+    quotas = {year: int(q) for year, q in exact.iteritems()}
+    remainder = n - sum(quotas.values())
+    for year in sorted(exact, key=lambda y: (quotas[y] - exact[y], y))[:remainder]:
+        quotas[year] += 1
+    return quotas
+
+
+def scan_year(year, budget, results, scroll_size, stop=None):
+    """Puts the ids of the documents of a year (or of all documents if year is
+    None) on the results queue, in batches, until the budget is exhausted or
+    the stop event is set.
+    """
+    if year is None:
+        query = hit_fields({'query': {'match_all': {}}})
+    else:
+        query = hit_fields({
+            'query': filtered_query(must=[
+                {
+                    'range': {
+                        'paper_dc_date': {
+                            'gte': '{:04d}-01-01'.format(year),
+                            'lte': '{:04d}-12-31'.format(year)
+                        }
+                    }
+                }
+            ])
+        })
+    batch = []
+    for hit in scan(_es(), query=query, index=settings.ES_INDEX, doc_type=settings.ES_DOCTYPE,
+                    scroll='2m', size=scroll_size):
+        batch.append(hit['_id'])
+        if len(batch) == scroll_size:
+            if stop is not None and stop.is_set():
+                return
+            taken = budget.take(len(batch))
+            results.put(batch[:taken])
+            if taken < len(batch):
+                return
+            batch = []
+    if batch and not (stop is not None and stop.is_set()):
+        results.put(batch[:budget.take(len(batch))])
+
+
+def save_doc_ids(doc_ids):
+    """Stores document ids in the database (via COPY on PostgreSQL)"""
+    if connection.vendor == 'postgresql':
+        rows = StringIO(''.join('{}\t{!r}\n'.format(doc_id, random_key()) for doc_id in doc_ids))
+        with connection.cursor() as cursor:
+            cursor.copy_from(rows, DocID._meta.db_table, columns=('doc_id', 'random_key'))
+    else:
+        DocID.objects.bulk_create([DocID(doc_id=doc_id) for doc_id in doc_ids])
+
+
 class Command(BaseCommand):
     args = '<#-of-document-ids>'
     help = 'Gathers #-of-document-ids from the ElasticSearch index. The ' \
            'collection of document ids is used to test ElastiSearch ' \
            'performance.'
+    option_list = BaseCommand.option_list + (
+        make_option('--no-stratify',
+                    action='store_false',
+                    dest='stratify',
+                    default=True,
+                    help='Take the first document ids in index order, instead of taking document ids from '
+                         'every year in proportion to its number of documents'),
+        make_option('--parallel',
+                    dest='parallel',
+                    type='int',
+                    default=4,
+                    help='Number of years scanned at the same time'),
+        make_option('--scroll-size',
+                    dest='scroll_size',
+                    type='int',
+                    default=1000,
+                    help='Number of document ids per scroll request (per shard)'),
+        make_option('--batch-size',
+                    dest='batch_size',
+                    type='int',
+                    default=10000,
+                    help='Number of document ids written to the database at once'),
+    )
 
     def handle(self, *args, **options):
         n_document_ids = 100000
         if len(args) > 0:
             n_document_ids = int(args[0])
 
-        match_all = {'query': {'match_all': {}}}
-
-        total_docs = _es().count(settings.ES_INDEX,
-                                 settings.ES_DOCTYPE,
-                                 match_all).get('count', 0)
-
+        counts = year_counts()
+        total_docs = sum(counts.values())
         if n_document_ids > total_docs:
             n_document_ids = total_docs
 
-        # Empty database
-        DocID.objects.all().delete()
+        if options['stratify'] and n_document_ids:
+            quotas = stratified_quotas(counts, n_document_ids)
+            budgets = {year: Budget(quota) for year, quota in quotas.iteritems() if quota}
+        else:
+            budgets = {None: Budget(n_document_ids)}
 
         self.stdout.write('Retrieving {num} document ids...'.
                           format(num=n_document_ids))
 
-        fields = []
-        get_more_docs = True
-        start = 0
-        num = 2500
+        years = Queue()
+        for year in sorted(budgets):
+            years.put(year)
+        # Bounded, so the scans wait if writing to the database falls behind
+        results = Queue(maxsize=2 * max(options['parallel'], 1))
+        errors = []
+        stop = threading.Event()
+
+        def worker():
+            try:
+                while not stop.is_set():
+                    year = years.get_nowait()
+                    if budgets[year].remaining > 0:
+                        scan_year(year, budgets[year], results, options['scroll_size'], stop)
+            except Empty:
+                pass
+            except Exception as e:
+                logger.exception('Scanning the index failed')
+                errors.append(e)
+            finally:
+                results.put(None)
+
+        threads = [threading.Thread(target=worker) for _ in range(min(max(options['parallel'], 1), len(budgets)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        # Write the ids as they arrive; in a transaction, so the old ids are kept if anything fails
         num_retrieved = 0
+        finished = 0
+        try:
+            with transaction.atomic():
+                # Empty database
+                DocID.objects.all().delete()
+
+                batch = []
+                while finished < len(threads):
+                    doc_ids = results.get()
+                    if doc_ids is None:
+                        finished += 1
+                        continue
+                    if errors:
+                        stop.set()
+                        continue
+                    batch.extend(doc_ids)
+                    if len(batch) >= options['batch_size']:
+                        save_doc_ids(batch)
+                        num_retrieved += len(batch)
+                        batch = []
+                        self.stdout.write('{} '.format(num_retrieved), ending='')
+                        self.stdout.flush()
+
+                if errors:
+                    raise CommandError('Scanning the index failed: {}'.format(errors[0]))
+                if batch:
+                    save_doc_ids(batch)
+                    num_retrieved += len(batch)
+        finally:
+            # If writing failed, stop the scans, and unblock the workers waiting for room on the queue
+            stop.set()
+            while finished < len(threads):
+                if results.get() is None:
+                    finished += 1
+            for thread in threads:
+                thread.join()
 
-        while get_more_docs:
-            doc_ids = []
-            results = _es().search(index=settings.ES_INDEX,
-                                   doc_type=settings.ES_DOCTYPE,
-                                   body=match_all,
-                                   fields=fields,
-                                   from_=start,
-                                   size=num)
-            for result in results['hits']['hits']:
-                num_retrieved = num_retrieved + 1
-                d = DocID(doc_id=result['_id'])
-                doc_ids.append(d)
-
-                if num_retrieved == n_document_ids:
-                    get_more_docs = False
-
-                if num_retrieved % 1000 == 0:
-                    self.stdout.write('. ', ending='')
-                    self.stdout.flush()
-
-            DocID.objects.bulk_create(doc_ids)
-            start = start + num
         self.stdout.write('')
+        self.stdout.write('Stored {} document ids.'.format(num_retrieved))
@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 """Gather query terms and store them in the database.
 The collection of terms is used for testing ElasticSearch performance on
-weighted queries (command: weighted_queries).
+weighted queries (command: benchmark).
 """
 import logging
 import sys
@@ -43,8 +43,7 @@ class Command(BaseCommand):
         terms = set()
 
         # select random documents
-        document_set = DocID.objects.order_by('?')[0:query_size]
-        doc_ids = [doc.doc_id for doc in document_set]
+        doc_ids = DocID.sample_ids(query_size)
 
         for ids in utils.chunks(doc_ids, es_retrieve):
             bdy = {
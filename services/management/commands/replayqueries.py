@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Replay saved queries as a load test (see services.benchmark.replay).
+
+Samples saved queries (with their periods, excluded distributions and article
+types and selected pillars) and replays them against the code paths of the
+search, doc_count, metadata, timeline and tv_cloud views, at a given arrival
+rate and concurrency. Reports the latency distribution and the error rate
+per endpoint.
+
+Word clouds are generated by the Celery workers, as in production, so make
+sure these are running. Identical word clouds are shared between requests
+(see WORDCLOUD_DEDUPLICATION_TTL), as they are for users.
+"""
+import json
+import random
+from datetime import datetime
+from functools import partial
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from query.models import Query
+from services.benchmark import ENDPOINTS, replay, summarize
+
+DEFAULT_MIX = 'search:4,doc_count:4,metadata:4,timeline:1,tv_cloud:1'
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Replays saved queries against the search, doc_count, metadata, timeline and tv_cloud code paths ' \
+           'and reports latencies and error rates per endpoint. Make sure ElasticSearch and Celery are running!'
+    option_list = BaseCommand.option_list + (
+        make_option('--requests',
+                    dest='requests',
+                    type='int',
+                    default=200,
+                    help='Total number of requests'),
+        make_option('--rate',
+                    dest='rate',
+                    type='float',
+                    default=0,
+                    help='Average number of arriving requests per second (0: all at once)'),
+        make_option('--concurrency',
+                    dest='concurrency',
+                    type='int',
+                    default=8,
+                    help='Number of requests handled at the same time'),
+        make_option('--mix',
+                    dest='mix',
+                    default=DEFAULT_MIX,
+                    help='Relative frequencies of the endpoints (default: {})'.format(DEFAULT_MIX)),
+        make_option('--queries',
+                    dest='queries',
+                    type='int',
+                    default=100,
+                    help='Number of saved queries to sample'),
+        make_option('--user',
+                    action='append',
+                    dest='users',
+                    default=[],
+                    help='Only replay the queries of this user (can be repeated)'),
+        make_option('--timeout',
+                    dest='timeout',
+                    type='int',
+                    default=600,
+                    help='Maximum number of seconds to wait for a word cloud'),
+        make_option('--seed',
+                    dest='seed',
+                    type='int',
+                    default=None,
+                    help='Seed for the sample of queries, the endpoints and the arrival times'),
+        make_option('--output',
+                    dest='output',
+                    default=None,
+                    help='Write the results to this JSON file'),
+    )
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        mix = self.parse_mix(options['mix'])
+        queries = self.sample_queries(rng, options['queries'], options['users'])
+
+        endpoints = [endpoint for endpoint, _ in mix]
+        cumulative = []
+        total = 0
+        for _, weight in mix:
+            total += weight
+            cumulative.append(total)
+
+        calls = []
+        for _ in range(options['requests']):
+            x = rng.random() * total
+            endpoint = next(e for e, c in zip(endpoints, cumulative) if x < c)
+            function = ENDPOINTS[endpoint]
+            if endpoint == 'tv_cloud':
+                function = partial(function, timeout=options['timeout'])
+            calls.append((endpoint, partial(function, rng.choice(queries))))
+
+        print 'Replaying {} requests on {} queries...'.format(len(calls), len(queries))
+        results, wall = replay(calls, options['concurrency'], options['rate'], rng.random())
+
+        summaries = {}
+        print '{:<10} {:>6} {:>7} {:>9} {:>9} {:>9} {:>9}'.format(
+            'endpoint', 'reqs', 'errors', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms')
+        for endpoint in sorted(results):
+            latencies, errors = results[endpoint]['latencies'], results[endpoint]['errors']
+            summary = summarize(latencies, wall)
+            summary['errors'] = len(errors)
+            summary['error_rate'] = len(errors) / float(len(latencies) + len(errors))
+            summaries[endpoint] = summary
+            if latencies:
+                print '{:<10} {:>6} {:>6.1%} {mean_ms:>9.1f} {p50_ms:>9.1f} {p95_ms:>9.1f} {p99_ms:>9.1f}'.format(
+                    endpoint, len(latencies) + len(errors), summary['error_rate'], **summary)
+            else:
+                print '{:<10} {:>6} {:>6.1%}'.format(endpoint, len(errors), 1.0)
+            for error in sorted(set(errors))[:3]:
+                print u'    {}'.format(error)
+        print 'Handled {:.2f} requests per second'.format(len(calls) / wall)
+
+        if options['output']:
+            settings = {k: options[k] for k in ('requests', 'rate', 'concurrency', 'mix', 'queries', 'users',
+                                                'seed')}
+            with open(options['output'], 'w') as out:
+                json.dump({'date': datetime.now().isoformat(), 'options': settings, 'results': summaries},
+                          out, indent=2)
+
+    def parse_mix(self, mix):
+        result = []
+        for part in mix.split(','):
+            endpoint, _, weight = part.partition(':')
+            if endpoint not in ENDPOINTS:
+                raise CommandError('Unknown endpoint {}; choose from {}'.format(endpoint,
+                                                                                 ', '.join(sorted(ENDPOINTS))))
+            try:
+                result.append((endpoint, float(weight or 1)))
+            except ValueError:
+                raise CommandError('Invalid weight for endpoint {}: {}'.format(endpoint, weight))
+        return result
+
+    def sample_queries(self, rng, n, users):
+        queries = Query.objects.all()
+        if users:
+            queries = queries.filter(user__username__in=users)
+        ids = list(queries.values_list('pk', flat=True))
+        if not ids:
+            raise CommandError('No saved queries found')
+
+        sample = rng.sample(ids, min(n, len(ids)))
+        return [q.get_query_dict() for q in Query.objects.filter(pk__in=sample)]
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Resolve the duplicate newspapers (documents with an identifier starting
+with "ddd:11", see #73) into newspaper ids, so they can be excluded with a
+cached terms filter.
+
+With --benchmark, compares the response times of queries with the former
+query string hotfix, with the filter hotfix, and without hotfix.
+"""
+import json
+import os
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from services.es import resolve_duplicate_newspapers, do_search, DUPLICATES_FILE
+from texcavator.utils import daterange2dates
+
+HOTFIX_MODES = (('query string', 'query_string'), ('filter', True), ('off', False))
+
+
+class Command(BaseCommand):
+    args = '<query ...>'
+    help = 'Writes the newspapers with duplicate documents to {}, or benchmarks the hotfix ' \
+           'for duplicate newspapers with the given queries. ' \
+           'Make sure ElasticSearch is running!'.format(DUPLICATES_FILE)
+    option_list = BaseCommand.option_list + (
+        make_option('--benchmark',
+                    action='store_true',
+                    dest='benchmark',
+                    default=False,
+                    help='Compare query response times with the hotfix as query string, as filter, and off'),
+        make_option('--repetitions',
+                    dest='repetitions',
+                    type='int',
+                    default=10,
+                    help='Number of repetitions per query and hotfix mode (for --benchmark)'),
+    )
+
+    def handle(self, *args, **options):
+        if options['benchmark']:
+            self.benchmark(args or ['oorlog', 'koningin', 'amsterdam AND haven'], options['repetitions'])
+        else:
+            self.resolve()
+
+    def resolve(self):
+        papers = resolve_duplicate_newspapers(settings.ES_INDEX, settings.ES_DOCTYPE)
+
+        paper_ids = []
+        partial = False
+        for paper_id, duplicates, others in papers:
+            if others:
+                print 'Newspaper {} has {} duplicate and {} other documents; ' \
+                      'keeping the prefix filter'.format(paper_id, duplicates, others)
+                partial = True
+            else:
+                paper_ids.append(paper_id)
+        print '{} newspapers only consist of duplicates'.format(len(paper_ids))
+
+        with open(os.path.join(settings.PROJECT_PARENT, DUPLICATES_FILE), 'wb') as out:
+            json.dump({'paper_ids': paper_ids, 'partial': partial}, out)
+
+    def benchmark(self, queries, repetitions):
+        dates = daterange2dates(settings.TEXCAVATOR_DATE_RANGE)
+        times = {name: [] for name, _ in HOTFIX_MODES}
+        took = {name: [] for name, _ in HOTFIX_MODES}
+
+        for repetition in range(repetitions):
+            # Interleave the modes, so they are equally affected by caching
+            for name, mode in HOTFIX_MODES:
+                with override_settings(KB_HOTFIX_DUPLICATE_NEWSPAPERS=mode):
+                    for query in queries:
+                        start = time.time()
+                        valid, result = do_search(settings.ES_INDEX, settings.ES_DOCTYPE, query, 0, 20,
+                                                  dates, [], [], [])
+                        if not valid:
+                            raise CommandError(u'Invalid query "{}": {}'.format(query, result))
+                        times[name].append((time.time() - start) * 1000)
+                        took[name].append(result.get('took', 0))
+
+        for name, _ in HOTFIX_MODES:
+            t = sorted(times[name])
+            print '{:<13} mean {:7.1f} ms, median {:7.1f} ms, ES took (mean) {:7.1f} ms'.format(
+                name, sum(t) / len(t), t[len(t) / 2], sum(took[name]) / float(len(took[name])))
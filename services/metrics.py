@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""Request-level metrics in the Prometheus text format.
+
+Every view (see :class:`MetricsMiddleware`) and every Elasticsearch request
+(see services.profiling.ProfilingTransport) is measured. As the web
+application and Celery run in several processes, the measurements are
+aggregated in Redis: a hash per metric, with a field per combination of labels
+(and, for histograms, per bucket). The sums are exposed by the metrics view,
+so they can be scraped by Prometheus.
+
+The measurements of a request (or a Celery task) are buffered in its thread,
+and written to Redis in a single round trip when it ends. Elasticsearch
+requests outside of a request or task are written immediately.
+
+Metrics are enabled by METRICS_ENABLED. Failures to record a measurement are
+logged, and never affect the request itself.
+"""
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from celery.signals import task_prerun, task_postrun
+
+from django.conf import settings
+
+from texcavator.utils import redis_client
+
+logger = logging.getLogger(__name__)
+
+_KEY = 'texcavator:metrics:{}'
+
+_local = threading.local()
+
+# Upper bounds of the histogram buckets
+DURATION_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (1024, 10 * 1024, 100 * 1024, 1024 ** 2, 10 * 1024 ** 2, 100 * 1024 ** 2)
+
+# name: (type, help, buckets)
+METRICS = {
+    'texcavator_request_duration_seconds':
+        ('histogram', 'Duration of requests, per view', DURATION_BUCKETS),
+    'texcavator_requests_total':
+        ('counter', 'Number of requests, per view and status code', None),
+    'texcavator_request_exceptions_total':
+        ('counter', 'Number of requests that raised an exception, per view', None),
+    'texcavator_es_request_duration_seconds':
+        ('histogram', 'Wall time of Elasticsearch requests, per operation', DURATION_BUCKETS),
+    'texcavator_es_took_seconds':
+        ('histogram', 'Time Elasticsearch reports (took) for requests, per operation', DURATION_BUCKETS),
+    'texcavator_es_request_bytes':
+        ('histogram', 'Size of the bodies of Elasticsearch requests, per operation', SIZE_BUCKETS),
+    'texcavator_es_errors_total':
+        ('counter', 'Number of failed Elasticsearch requests, per operation', None),
+}
+
+
+def metrics_enabled():
+    """
+    Returns whether metrics are recorded (METRICS_ENABLED).
+    """
+    return getattr(settings, 'METRICS_ENABLED', False)
+
+
+def format_labels(labels):
+    """
+    Formats a dictionary of labels as in the Prometheus text format, e.g. 'view="search"'.
+    """
+    return ','.join('{}="{}"'.format(k, unicode(v).replace('\\', r'\\').replace('"', r'\"'))
+                    for k, v in sorted(labels.iteritems()))
+
+
+class Recorder(object):
+    """Collects measurements and writes them to Redis in a single round trip.
+    Observations are aggregated per bucket, so the size of a recorder only
+    depends on the number of combinations of labels."""
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.sums = defaultdict(float)
+
+    def inc(self, name, labels, amount=1):
+        self.counters[(name, format_labels(labels))] += amount
+
+    def observe(self, name, labels, value):
+        labels = format_labels(labels)
+        # Only the bucket of the value is stored; buckets are made cumulative on export
+        self.counters[(name, '{}|{}'.format(labels, bisect_left(METRICS[name][2], value)))] += 1
+        self.sums[(name, '{}|sum'.format(labels))] += value
+
+    def flush(self):
+        if not self.counters or not metrics_enabled():
+            return
+        try:
+            pipe = redis_client().pipeline(transaction=False)
+            for (name, field), amount in self.counters.iteritems():
+                pipe.hincrby(_KEY.format(name), field, amount)
+            for (name, field), value in self.sums.iteritems():
+                pipe.hincrbyfloat(_KEY.format(name), field, value)
+            pipe.execute()
+        except Exception as e:
+            logger.warning('Unable to record metrics: {}'.format(e))
+        self.counters.clear()
+        self.sums.clear()
+
+
+def begin_recording():
+    """
+    Buffers the measurements of the current thread until :func:`end_recording`
+    (nested calls, e.g. for an eager task in a request, share the buffer).
+    """
+    if not getattr(_local, 'depth', 0):
+        _local.recorder = Recorder()
+        _local.depth = 0
+    _local.depth += 1
+
+
+def end_recording():
+    """
+    Writes the buffered measurements of the current thread to Redis.
+    """
+    depth = getattr(_local, 'depth', 0)
+    if not depth:
+        return
+    _local.depth = depth - 1
+    if not _local.depth:
+        _local.recorder.flush()
+        _local.recorder = None
+
+
+def current_recorder():
+    """
+    Returns the recorder that buffers the measurements of the current thread, or None.
+    """
+    return getattr(_local, 'recorder', None)
+
+
+@task_prerun.connect
+def begin_task_recording(**kwargs):
+    if metrics_enabled():
+        begin_recording()
+
+
+@task_postrun.connect
+def end_task_recording(**kwargs):
+    end_recording()
+
+
+def export_metrics():
+    """
+    Returns the aggregated metrics in the Prometheus text format.
+    """
+    redis = redis_client()
+    pipe = redis.pipeline(transaction=False)
+    names = sorted(METRICS)
+    for name in names:
+        pipe.hgetall(_KEY.format(name))
+
+    lines = []
+    for name, values in zip(names, pipe.execute()):
+        typ, description, buckets = METRICS[name]
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} {}'.format(name, typ))
+        if typ == 'counter':
+            for labels, value in sorted(values.iteritems()):
+                lines.append('{}{{{}}} {}'.format(name, labels, value))
+        else:
+            lines.extend(_histogram_lines(name, values, buckets))
+
+    return '\n'.join(lines) + '\n'
+
+
+def _histogram_lines(name, values, buckets):
+    series = defaultdict(lambda: [0] * (len(buckets) + 1))
+    sums = defaultdict(float)
+    for field, value in values.iteritems():
+        labels, _, bucket = field.rpartition('|')
+        if bucket == 'sum':
+            sums[labels] = float(value)
+        else:
+            series[labels][int(bucket)] = int(value)
+
+    lines = []
+    for labels in sorted(series):
+        prefix = labels + ',' if labels else ''
+        count = 0
+        for bound, n in zip(buckets + ('+Inf',), series[labels]):
+            count += n
+            lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, prefix, bound, count))
+        lines.append('{}_sum{{{}}} {}'.format(name, labels, repr(sums[labels])))
+        lines.append('{}_count{{{}}} {}'.format(name, labels, count))
+    return lines
+
+
+def reset_metrics():
+    """
+    Removes all aggregated metrics.
+    """
+    redis_client().delete(*[_KEY.format(name) for name in METRICS])
+
+
+def record_es_request(operation, wall, took, request_bytes, failed=False):
+    """
+    Records an Elasticsearch request; wall and took are in seconds.
+    """
+    recorder = current_recorder() or Recorder()
+    labels = {'operation': operation}
+    if failed:
+        recorder.inc('texcavator_es_errors_total', labels)
+    else:
+        recorder.observe('texcavator_es_request_duration_seconds', labels, wall)
+        if took is not None:
+            recorder.observe('texcavator_es_took_seconds', labels, took)
+    recorder.observe('texcavator_es_request_bytes', labels, request_bytes)
+    if recorder is not current_recorder():
+        recorder.flush()
+
+
+def view_name(view_func):
+    """
+    Returns the name of a view function, e.g. 'services.views.search'.
+    """
+    return '{}.{}'.format(view_func.__module__, getattr(view_func, '__name__', type(view_func).__name__))
+
+
+class MetricsMiddleware(object):
+    """Records the duration and the status code of requests, per view, together
+    with the Elasticsearch requests made while handling them."""
+
+    def process_request(self, request):
+        request._metrics_start = time.time()
+        if metrics_enabled():
+            # A request starts with an empty buffer, also if a previous request ended abruptly
+            _local.depth = 0
+            begin_recording()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._metrics_view = view_name(view_func)
+
+    def process_exception(self, request, exception):
+        request._metrics_exception = True
+
+    def process_response(self, request, response):
+        start = getattr(request, '_metrics_start', None)
+        if start is None or not metrics_enabled():
+            return response
+
+        recorder = current_recorder() or Recorder()
+        labels = {'view': getattr(request, '_metrics_view', 'unresolved'), 'method': request.method}
+        # For streaming responses, this is the time until the response starts
+        recorder.observe('texcavator_request_duration_seconds', labels, time.time() - start)
+        recorder.inc('texcavator_requests_total', dict(labels, status=response.status_code))
+        if getattr(request, '_metrics_exception', False):
+            recorder.inc('texcavator_request_exceptions_total', labels)
+        if recorder is current_recorder():
+            end_recording()
+        else:
+            recorder.flush()
+
+        return response
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProfileTrace',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('name', models.CharField(max_length=200)),
+                ('user', models.CharField(max_length=30, blank=True)),
+                ('total_ms', models.FloatField()),
+                ('es_ms', models.FloatField()),
+                ('took_ms', models.FloatField()),
+                ('python_ms', models.FloatField()),
+                ('calls', models.TextField()),
+            ],
+            options={
+                'ordering': ('-id',),
+            },
+            bases=(models.Model,),
+        ),
+    ]
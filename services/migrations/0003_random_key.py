@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import services.models
+
+# Random numbers in [0, 1) per database vendor
+RANDOM_SQL = {
+    'postgresql': 'random()',
+    'mysql': 'RAND()',
+    'sqlite': '(abs(random()) % 1000000000) / 1000000000.0',
+}
+
+
+def fill_random_keys(apps, schema_editor):
+    """Gives every existing row its own random key (AddField sets the same default on all rows)"""
+    expression = RANDOM_SQL.get(schema_editor.connection.vendor)
+    for name in ('DocID', 'QueryTerm'):
+        model = apps.get_model('services', name)
+        if expression:
+            schema_editor.execute('UPDATE {} SET random_key = {}'.format(
+                schema_editor.quote_name(model._meta.db_table), expression))
+        else:
+            for obj in model.objects.all():
+                obj.random_key = services.models.random_key()
+                obj.save(update_fields=['random_key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0002_profiletrace'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='docid',
+            name='random_key',
+            field=models.FloatField(default=services.models.random_key, editable=False, db_index=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='queryterm',
+            name='random_key',
+            field=models.FloatField(default=services.models.random_key, editable=False, db_index=True),
+            preserve_default=True,
+        ),
+        migrations.RunPython(fill_random_keys, reverse_code=lambda apps, schema_editor: None),
+    ]
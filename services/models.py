@@ -1,25 +1,57 @@
 # -*- coding: utf-8 -*-
-"""Models used for measuring ElasticSearch performance in management commands.
+"""Models used for measuring ElasticSearch performance in management commands
+and profiling.
 """
+import random
 
 from django.db import models
 
 
-class DocID(models.Model):
+def random_key():
+    return random.random()
+
+
+class RandomSampleModel(models.Model):
+    """Abstract model with an indexed random key, used to sample rows quickly
+
+    Ordering by '?' sorts the whole table for every sample; instead,
+    sample_ids selects a range of consecutive random keys via the index.
+    As the keys are random, such a range is a random sample of the rows.
+    """
+    random_key = models.FloatField(default=random_key, db_index=True, editable=False)
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def sample_ids(cls, n, seed=None):
+        """Returns the primary keys of n random rows (or of all rows, if there
+        are fewer). Given a seed, the sample only depends on the rows in the table.
+        """
+        start = random.Random(seed).random()
+        keys = cls.objects.order_by('random_key').values_list('pk', flat=True)
+        ids = list(keys.filter(random_key__gte=start)[:n])
+        if len(ids) < n:
+            # Wrap around to the lowest keys
+            ids.extend(keys.filter(random_key__lt=start)[:n - len(ids)])
+        return ids
+
+
+class DocID(RandomSampleModel):
     """Model for a document id used to generate queries of certain sizes
 
     This model is used to store document ids. The document ids are used to
     generate query sets of certain sizes. These query sets are used to test the
-    performance of generating word cloud data using ES in multiple management
-    commands.
+    performance of generating word cloud data using ES (see management command
+    benchmark).
     """
     doc_id = models.CharField(max_length=26, primary_key=True)
 
 
-class QueryTerm(models.Model):
+class QueryTerm(RandomSampleModel):
     """Model to store query terms used to generate random queries
 
-    See management commands gatherqueryterms and weighted_queries.
+    See management commands gatherqueryterms and benchmark.
     """
     term = models.CharField(max_length=26, primary_key=True)
 
@@ -28,3 +60,31 @@ class QueryTerm(models.Model):
 
     def __eq__(self, other):
         return self.term == other.term
+
+
+class ProfileTrace(models.Model):
+    """Model to store the Elasticsearch requests made during a profiled view or task
+
+    See services.profiling. Only the latest traces are kept (see trim).
+    """
+    created = models.DateTimeField(auto_now_add=True)
+    name = models.CharField(max_length=200)
+    user = models.CharField(max_length=30, blank=True)
+    total_ms = models.FloatField()
+    es_ms = models.FloatField()
+    took_ms = models.FloatField()
+    python_ms = models.FloatField()
+    calls = models.TextField()
+
+    class Meta:
+        ordering = ('-id',)
+
+    def __unicode__(self):
+        return u'{} ({:.0f} ms)'.format(self.name, self.total_ms)
+
+    @classmethod
+    def trim(cls, limit):
+        """Deletes all but the latest limit traces"""
+        oldest_kept = cls.objects.order_by('-id').values_list('id', flat=True)[limit - 1:limit]
+        if oldest_kept:
+            cls.objects.filter(id__lt=oldest_kept[0]).delete()
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""Profiling of Elasticsearch requests.
+
+A trace records every Elasticsearch request made while it is active (in the
+current thread): the wall time in the client, the time ES reports (took) and
+the size of the request body. The remainder of the duration of the trace is
+spent in Python. If ES_PROFILE_API is set, search requests are executed with
+"profile": true (ES 5 and later) and the profile is stored as well.
+
+Traces are started per request by staff users via the X-Texcavator-Profile
+header (see :class:`ProfilingMiddleware`), or per task via a flag (see
+services.tasks.generate_tv_cloud). Finished traces are stored as ProfileTrace
+objects, of which only the latest PROFILE_TRACE_LIMIT are kept.
+
+Independently of traces, :class:`ProfilingTransport` records the metrics of
+every Elasticsearch request (see services.metrics).
+"""
+import json
+import logging
+import threading
+import time
+
+from elasticsearch import Transport, TransportError
+from elasticsearch.serializer import JSONSerializer
+
+from django.conf import settings
+
+from services.metrics import metrics_enabled, record_es_request
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = 'HTTP_X_TEXCAVATOR_PROFILE'
+
+_local = threading.local()
+
+
+class Trace(object):
+    """The Elasticsearch requests made during a view or task."""
+
+    def __init__(self, name, user=''):
+        self.name = name
+        self.user = user
+        self.calls = []
+        self.start = time.time()
+
+    def add_call(self, operation, wall_ms, took_ms, request_bytes, profile=None):
+        call = {
+            'operation': operation,
+            'wall_ms': round(wall_ms, 1),
+            'took_ms': took_ms,
+            'request_bytes': request_bytes,
+        }
+        if profile is not None:
+            call['profile'] = profile
+        self.calls.append(call)
+
+    def summary(self):
+        total_ms = (time.time() - self.start) * 1000
+        es_ms = sum(c['wall_ms'] for c in self.calls)
+        return {
+            'total_ms': total_ms,
+            'es_ms': es_ms,
+            'took_ms': sum(c['took_ms'] or 0 for c in self.calls),
+            'python_ms': max(total_ms - es_ms, 0.0),
+        }
+
+
+def start_trace(name, user=''):
+    """
+    Starts a trace in the current thread.
+    """
+    _local.trace = Trace(name, user)
+    return _local.trace
+
+
+def current_trace():
+    """
+    Returns the active trace in the current thread, or None.
+    """
+    return getattr(_local, 'trace', None)
+
+
+def finish_trace():
+    """
+    Stops the active trace in the current thread and stores it.
+    """
+    trace = current_trace()
+    if trace is None:
+        return None
+    _local.trace = None
+
+    from services.models import ProfileTrace
+    try:
+        ProfileTrace.objects.create(name=trace.name[:200],
+                                    user=trace.user,
+                                    calls=json.dumps(trace.calls),
+                                    **trace.summary())
+        ProfileTrace.trim(getattr(settings, 'PROFILE_TRACE_LIMIT', 500))
+    except Exception as e:
+        logger.warning('Unable to store profile trace {}: {}'.format(trace.name, e))
+
+    return trace
+
+
+def es_operation(method, url):
+    """
+    Returns the name of the Elasticsearch API called, e.g. '_search' for '/kb/doc/_search'.
+    """
+    for part in url.split('?')[0].split('/'):
+        if part.startswith('_'):
+            return part
+    return method.lower()
+
+
+class MeasuringSerializer(JSONSerializer):
+    """Serializer that remembers the size of the last request body (per thread)."""
+
+    def dumps(self, data):
+        data = super(MeasuringSerializer, self).dumps(data)
+        _local.request_bytes = len(data)
+        return data
+
+
+class ProfilingTransport(Transport):
+    """Transport that records the metrics of all requests, and the requests made while a trace is active."""
+
+    def __init__(self, hosts, **kwargs):
+        kwargs.setdefault('serializer', MeasuringSerializer())
+        super(ProfilingTransport, self).__init__(hosts, **kwargs)
+
+    def perform_request(self, method, url, params=None, body=None):
+        trace = current_trace()
+        record = metrics_enabled()
+        if trace is None and not record:
+            return super(ProfilingTransport, self).perform_request(method, url, params, body)
+
+        operation = es_operation(method, url)
+        if trace is not None and operation == '_search' and isinstance(body, dict) and \
+                getattr(settings, 'ES_PROFILE_API', False):
+            body = dict(body, profile=True)
+
+        _local.request_bytes = 0
+        start = time.time()
+        try:
+            result = super(ProfilingTransport, self).perform_request(method, url, params, body)
+        except TransportError:
+            if record:
+                record_es_request(operation, time.time() - start, None, _local.request_bytes, failed=True)
+            raise
+        wall = time.time() - start
+
+        # Older clients return (status, data)
+        data = result[1] if isinstance(result, tuple) else result
+        took = data.get('took') if isinstance(data, dict) else None
+        if trace is not None:
+            profile = data.get('profile') if isinstance(data, dict) else None
+            trace.add_call(operation, wall * 1000, took, _local.request_bytes, profile)
+        if record:
+            record_es_request(operation, wall, took / 1000.0 if took is not None else None,
+                              _local.request_bytes)
+
+        return result
+
+
+class ProfilingMiddleware(object):
+    """Traces requests of staff users that carry the X-Texcavator-Profile header."""
+
+    def process_request(self, request):
+        _local.trace = None
+        if request.META.get(PROFILE_HEADER) and request.user.is_staff:
+            start_trace(request.path, request.user.username)
+
+    def process_response(self, request, response):
+        if current_trace() is not None:
+            finish_trace()
+        return response
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""Publishing and listening to progress events of Celery tasks.
+
+Tasks publish their progress on a Redis channel per task id. Clients can
+subscribe to this channel (see :func:`services.views.task_events`) instead of
+polling the result backend.
+"""
+import json
+import time
+
+from django.conf import settings
+
+from texcavator.utils import redis_client
+
+TASK_EVENTS_CHANNEL = 'texcavator:task:{}'
+FINAL_STATES = ('SUCCESS', 'FAILURE', 'REVOKED')
+
+
+def publish_task_event(task_id, state, meta=None):
+    """
+    Publishes the state (and optional metadata) of a task to its channel.
+    """
+    message = json.dumps({'state': state, 'meta': meta})
+    redis_client().publish(TASK_EVENTS_CHANNEL.format(task_id), message)
+
+
+def subscribe_task_events(task_id):
+    """
+    Returns a Redis PubSub object subscribed to the channel of a task.
+    """
+    pubsub = redis_client().pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(TASK_EVENTS_CHANNEL.format(task_id))
+    return pubsub
+
+
+def listen_task_events(pubsub, timeout=None, heartbeat=15):
+    """
+    Yields the events published on a subscribed channel as dictionaries.
+
+    Yields None every `heartbeat` seconds without events, so callers can keep
+    their connection alive. Stops after a final state, or after `timeout`
+    seconds.
+    """
+    if timeout is None:
+        timeout = getattr(settings, 'TASK_EVENTS_TIMEOUT', 600)
+    deadline = time.time() + timeout
+
+    try:
+        while time.time() < deadline:
+            message = pubsub.get_message(timeout=heartbeat)
+            if not message:
+                yield None
+                continue
+
+            event = json.loads(message['data'])
+            yield event
+            if event['state'] in FINAL_STATES:
+                break
+    finally:
+        pubsub.close()
@@ -3,23 +3,75 @@
 """
 from __future__ import absolute_import
 
+import hashlib
+import json
+import logging
 import math
+import time
 from itertools import dropwhile
 from collections import Counter
 
 from celery import shared_task, current_task
+from celery.result import AsyncResult
+from celery.signals import task_postrun, task_revoked
+from celery.utils import uuid
 
 from django.conf import settings
 
-from services.es import document_id_chunks, termvector_wordcloud, count_search_results
-from texcavator.utils import normalize_cloud
+from services.es import document_id_chunks, random_document_id_chunks, termvector_wordcloud, \
+    count_search_results
+from services.profiling import start_trace, finish_trace
+from services.progress import publish_task_event
+from query.stopwords import get_stopwords
+from texcavator.utils import normalize_cloud, redis_client
+
+CLOUD_TASK_KEY = 'texcavator:cloud:{}'
+CLOUD_TASK_CLIENTS_KEY = 'texcavator:cloud_clients:{}'
+CLOUD_TASK_PARAMETERS_KEY = 'texcavator:cloud_parameters:{}'
+
+# Deletes KEYS[1] only if it still has the value ARGV[1]
+_DELETE_IF_EQUAL = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+logger = logging.getLogger(__name__)
 
 
 @shared_task
-def generate_tv_cloud(search_params, min_length, stopwords, date_range=None, stems=False, idf_timeframe=''):
+def generate_tv_cloud(search_params, min_length, stopwords_key, date_range=None, stems=False, idf_timeframe='',
+                      sample=False, profile=False):
+    """
+    Generates multiple document word clouds using the termvector approach (see build_tv_cloud).
+    If profile is set, the Elasticsearch requests are traced (see services.profiling).
+    """
+    if profile:
+        start_trace('generate_tv_cloud')
+    try:
+        return build_tv_cloud(search_params, min_length, stopwords_key, date_range, stems, idf_timeframe, sample)
+    finally:
+        if profile:
+            finish_trace()
+
+
+def build_tv_cloud(search_params, min_length, stopwords_key, date_range=None, stems=False, idf_timeframe='',
+                   sample=False):
     """
     Generates multiple document word clouds using the termvector approach.
+    Stopwords (see query.stopwords) are left out while counting.
+
+    In sampling mode, termvectors are retrieved for a growing random sample of
+    the documents, until the top of the word cloud no longer changes. The word
+    counts are then extrapolated to all documents.
     """
+    try:
+        stopwords = get_stopwords(stopwords_key)
+    except KeyError:
+        logger.warning('Stopword set %s has expired; generating the word cloud without stopwords', stopwords_key)
+        stopwords = frozenset()
+
     # Date range is either provided (in case of burst clouds from the timelines) or from the Query
     dates = date_range or search_params['dates']
 
@@ -34,51 +86,244 @@ def generate_tv_cloud(search_params, min_length, stopwords, date_range=None, ste
     doc_count = result.get('count')
     update_task_status(0, doc_count)
 
+    # Only sample if there are considerably more documents than the minimal sample size
+    min_sample_size = getattr(settings, 'WORDCLOUD_SAMPLE_MIN_SIZE', 5000)
+    sampling = sample and doc_count > 2 * min_sample_size
+
+    chunk_args = (settings.QUERY_DATA_CHUNK_SIZE,
+                  settings.ES_INDEX,
+                  settings.ES_DOCTYPE,
+                  search_params['query'],
+                  dates,
+                  search_params['exclude_distributions'],
+                  search_params['exclude_article_types'],
+                  search_params['selected_pillars'])
+    if sampling:
+        chunks = random_document_id_chunks(*chunk_args)
+    else:
+        chunks = document_id_chunks(*chunk_args)
+
     # Then, create the word clouds per chunk
     progress = 0
     wordcloud_counter = Counter()
-    for subset in document_id_chunks(settings.QUERY_DATA_CHUNK_SIZE,
-                                     settings.ES_INDEX,
-                                     settings.ES_DOCTYPE,
-                                     search_params['query'],
-                                     dates,
-                                     search_params['exclude_distributions'],
-                                     search_params['exclude_article_types'],
-                                     search_params['selected_pillars']):
+    top = []
+    change = 1.0
+    interim_interval = getattr(settings, 'WORDCLOUD_INTERIM_INTERVAL', 5)
+    last_interim = time.time()
+    for subset in chunks:
 
         wordcloud_counter += termvector_wordcloud(settings.ES_INDEX,
                                                   settings.ES_DOCTYPE,
                                                   subset,
                                                   min_length,
-                                                  stems)
+                                                  stems,
+                                                  stopwords=stopwords)
 
-        # Update the task status
+        # Update the task status, with a preliminary word cloud every interim_interval seconds
         progress += len(subset)
-        update_task_status(progress, doc_count)
+        interim = None
+        if interim_interval and time.time() - last_interim >= interim_interval:
+            interim = interim_cloud(wordcloud_counter, idf_timeframe)
+            last_interim = time.time()
+        update_task_status(progress, doc_count, interim)
+
+        # When sampling, stop as soon as the top of the word cloud is stable
+        if sampling:
+            previous, top = top, top_terms(wordcloud_counter, settings.WORDCLOUD_MAX_WORDS)
+            change = rank_change(previous, top)
+            if progress >= min_sample_size and change < getattr(settings, 'WORDCLOUD_SAMPLE_THRESHOLD', 0.05):
+                break
+
+    sample_info = None
+    if sampling:
+        sample_info = {
+            'size': progress,
+            'total': doc_count,
+            'rank_change': change,
+            'estimated_error': sampling_error(wordcloud_counter, top, progress, doc_count)
+        }
+        factor = doc_count / float(progress)
+        wordcloud_counter = Counter({t: int(round(c * factor)) for t, c in wordcloud_counter.iteritems()})
 
     # Remove non-frequent words form the counter
     for key, count in dropwhile(lambda c: c[1] > math.log10(doc_count), wordcloud_counter.most_common()):
         del wordcloud_counter[key]
 
-    # Remove the stopwords from the counter
-    for sw in stopwords:
-        del wordcloud_counter[sw]
-
     # Return a dictionary with the results
     return {
         'result': normalize_cloud(wordcloud_counter, idf_timeframe),
         'status': 'ok',
-        'burstcloud': date_range is not None
+        'burstcloud': date_range is not None,
+        'sample': sample_info
     }
 
 
-def update_task_status(progress, total):
+def interim_cloud(counter, idf_timeframe=''):
+    """
+    Returns a normalized word cloud of the most frequent terms counted so far.
+    """
+    terms = top_terms(counter, settings.WORDCLOUD_MAX_WORDS)
+    return normalize_cloud(Counter({t: counter[t] for t in terms}), idf_timeframe)
+
+
+def top_terms(counter, n):
+    """
+    Returns the n most frequent terms in counter.
+    """
+    return [t for t, _ in counter.most_common(n)]
+
+
+def rank_change(previous, current):
+    """
+    Returns the fraction of terms in current that was not part of previous.
+    """
+    if not current:
+        return 1.0
+    return 1 - len(set(previous) & set(current)) / float(len(current))
+
+
+def sampling_error(counter, terms, sample_size, total):
     """
-    Updates the current task with the progress
+    Returns the estimated relative error of the counts of terms in a sample.
+
+    The counts are assumed to be Poisson distributed, so the relative standard
+    error of a count c is 1/sqrt(c), which is corrected for sampling without
+    replacement from a finite number of documents.
+    """
+    counts = [counter[t] for t in terms if counter[t] > 0]
+    if not counts:
+        return None
+    correction = 1 - sample_size / float(total)
+    return sum(math.sqrt(correction / c) for c in counts) / len(counts)
+
+
+def cloud_task_key(search_params, min_length, stopwords_key, date_range=None, stems=False, idf_timeframe='',
+                   sample=False):
+    """
+    Returns a key that identifies the result of generate_tv_cloud for the given parameters.
+    Parameters that do not influence the word cloud (e.g. the title of the Query) are ignored.
+    """
+    parameters = {
+        'query': search_params['query'],
+        'dates': date_range or search_params['dates'],
+        'exclude_distributions': sorted(search_params['exclude_distributions']),
+        'exclude_article_types': sorted(search_params['exclude_article_types']),
+        'selected_pillars': sorted(search_params['selected_pillars']),
+        'min_length': min_length,
+        'stopwords': stopwords_key,
+        'stems': stems,
+        'idf_timeframe': idf_timeframe or '',
+        'sample': sample,
+    }
+    return hashlib.sha1(json.dumps(parameters, sort_keys=True)).hexdigest()
+
+
+def cloud_queue(search_params, date_range=None):
+    """
+    Returns the Celery queue for a word cloud: small word clouds go to the
+    interactive queue, large word clouds to the bulk queue.
+    """
+    result = count_search_results(settings.ES_INDEX,
+                                  settings.ES_DOCTYPE,
+                                  search_params['query'],
+                                  date_range or search_params['dates'],
+                                  search_params['exclude_distributions'],
+                                  search_params['exclude_article_types'],
+                                  search_params['selected_pillars'])
+    if result.get('count', 0) > getattr(settings, 'CELERY_INTERACTIVE_MAX_DOCUMENTS', 10000):
+        return settings.CELERY_BULK_QUEUE
+    return settings.CELERY_INTERACTIVE_QUEUE
+
+
+def start_tv_cloud(search_params, min_length, stopwords_key, date_range=None, stems=False, idf_timeframe='',
+                   sample=False, profile=False):
+    """
+    Starts generate_tv_cloud and returns its task id.
+
+    If an identical word cloud is already being generated (or has been
+    generated recently), no new task is started; the id of the existing task is
+    returned instead, so all callers share its result. Profiled word clouds
+    always start a new task.
+    """
+    args = (search_params, min_length, stopwords_key, date_range, stems, idf_timeframe, sample)
+    ttl = getattr(settings, 'WORDCLOUD_DEDUPLICATION_TTL', 600)
+    if not ttl or profile:
+        return generate_tv_cloud.apply_async(args, {'profile': profile},
+                                             queue=cloud_queue(search_params, date_range)).id
+
+    redis = redis_client()
+    key = CLOUD_TASK_KEY.format(cloud_task_key(*args))
+
+    while True:
+        task_id = uuid()
+        if redis.set(key, task_id, ex=ttl, nx=True):
+            pipe = redis.pipeline()
+            pipe.set(CLOUD_TASK_CLIENTS_KEY.format(task_id), 1, ex=ttl)
+            pipe.set(CLOUD_TASK_PARAMETERS_KEY.format(task_id), key, ex=ttl)
+            pipe.execute()
+            return generate_tv_cloud.apply_async(args, task_id=task_id,
+                                                 queue=cloud_queue(search_params, date_range)).id
+
+        existing_id = redis.get(key)
+        if existing_id and AsyncResult(existing_id).status not in ('FAILURE', 'REVOKED'):
+            redis.incr(CLOUD_TASK_CLIENTS_KEY.format(existing_id))
+            return existing_id
+
+        # The existing task failed or the key just expired, try to start a new task
+        if existing_id:
+            redis.eval(_DELETE_IF_EQUAL, 1, key, existing_id)
+
+
+def cancel_tv_cloud(task_id):
+    """
+    Cancels a generate_tv_cloud task, unless it is shared with other callers
+    that are still waiting for its result.
+
+    A revoked task that is still queued stays PENDING until a worker discards
+    it, so it is no longer offered to new callers of :func:`start_tv_cloud`.
+    """
+    redis = redis_client()
+    clients_key = CLOUD_TASK_CLIENTS_KEY.format(task_id)
+    if redis.exists(clients_key) and redis.decr(clients_key) > 0:
+        return
+
+    # Before revoking, so new callers cannot attach in between; unless the key already refers to a newer task
+    key = redis.get(CLOUD_TASK_PARAMETERS_KEY.format(task_id))
+    if key:
+        redis.eval(_DELETE_IF_EQUAL, 1, key, task_id)
+
+    AsyncResult(task_id).revoke(terminate=True)
+
+
+def update_task_status(progress, total, interim=None):
+    """
+    Updates the current task with the progress, and publishes the progress to
+    clients listening for task events. Optionally includes a preliminary word
+    cloud.
     """
     info = {
         'current': progress,
         'total': total
     }
+    if interim is not None:
+        info['interim'] = interim
     current_task.update_state(state='PROGRESS', meta=info)
+    publish_task_event(current_task.request.id, 'PROGRESS', info)
+
+
+@task_postrun.connect(sender=generate_tv_cloud)
+def publish_task_finished(task_id=None, state=None, **kwargs):
+    """
+    Publishes the final state of a word cloud task.
+    The result itself is left in the result backend.
+    """
+    publish_task_event(task_id, state)
+
+
+@task_revoked.connect(sender=generate_tv_cloud)
+def publish_task_revoked(request=None, **kwargs):
+    """
+    Publishes that a word cloud task has been cancelled.
+    """
+    publish_task_event(request.id, 'REVOKED')
 
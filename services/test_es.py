@@ -2,10 +2,27 @@ import os
 
 from nose.tools import assert_equals
 
-from services.es import single_document_word_cloud
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "texcavator.settings")
+
+from django.test.utils import override_settings
+
+from services import es
+from services.corpus import generate_corpus
+from services.es import single_document_word_cloud, get_documents
+from services.fake_es import FakeElasticsearch
 from texcavator.settings import ES_INDEX, ES_DOCTYPE
 
-os.environ.setdefault("DJANGO_SETTINGS_MODULE", "texcavator.settings")
+_settings = override_settings(TERMVECTOR_CACHE_MAX_BYTES=0)
+
+
+def setup_module():
+    _settings.enable()
+    es._client = FakeElasticsearch.with_corpus(ES_INDEX, ES_DOCTYPE, generate_corpus(100))
+
+
+def teardown_module():
+    es._client = None
+    _settings.disable()
 
 
 def test_single_document_word_cloud_invalid_id():
@@ -15,3 +32,26 @@ def test_single_document_word_cloud_invalid_id():
         res = single_document_word_cloud(ES_INDEX, ES_DOCTYPE, id)
         assert_equals(res.get('status'), 'error')
 
+
+def test_get_documents_cache():
+    doc_ids = [doc_id for doc_id, _ in generate_corpus(3)]
+    documents = es._documents
+    es._documents = es.LRUCache(10)
+    try:
+        # Documents retrieved with some of their fields are not cached
+        docs = get_documents(ES_INDEX, ES_DOCTYPE, doc_ids, exclude=['text_content'])
+        assert_equals(len(docs), 3)
+        assert 'text_content' not in docs[doc_ids[0]]
+        assert_equals(len(es._documents), 0)
+
+        # Complete documents are, and the requested fields are selected from them
+        get_documents(ES_INDEX, ES_DOCTYPE, doc_ids[:1])
+        assert 'text_content' in es._documents.get((ES_INDEX, doc_ids[0]))
+        es._client, client = None, es._client
+        try:
+            docs = get_documents(ES_INDEX, ES_DOCTYPE, doc_ids[:1], include=['paper_dc_title'])
+        finally:
+            es._client = client
+        assert_equals(docs[doc_ids[0]].keys(), ['paper_dc_title'])
+    finally:
+        es._documents = documents
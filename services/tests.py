@@ -5,7 +5,32 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+from django.conf import settings
+from django.core.management import call_command
 from django.test import TestCase
+from django.test.utils import override_settings
+
+import json
+import threading
+from collections import Counter
+from StringIO import StringIO
+from tempfile import mkdtemp
+
+from query.stopwords import stopwords_key
+from services.benchmark import percentile, summarize, compare, replay
+from services.metrics import format_labels, _histogram_lines, begin_recording, end_recording, current_recorder, \
+    record_es_request
+from services.models import DocID, ProfileTrace
+from services.profiling import es_operation, start_trace, current_trace, finish_trace
+from services.tasks import cloud_task_key, top_terms, rank_change, sampling_error
+from services import es
+from services.corpus import generate_corpus
+from services.es import first_tokens, create_query, hit_fields, do_search, count_search_results, \
+    single_document_word_cloud, get_document_ids
+from services.fake_es import FakeElasticsearch
+from services.management.commands import gatherdocids
+from services.management.commands.gatherdocids import stratified_quotas
+from services.tvcache import encode_termvector, decode_termvector
 
 
 class SimpleTest(TestCase):
@@ -14,3 +39,363 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class CloudTaskKeyTest(TestCase):
+    def test_cloud_task_key(self):
+        """
+        Tests that identical word clouds share a key, irrespective of Query metadata.
+        """
+        params = {'pk': 1, 'title': 'a', 'query': 'test', 'dates': [], 'exclude_distributions': ['sd_national'],
+                  'exclude_article_types': [], 'selected_pillars': [1, 2]}
+        other = dict(params, pk=2, title='b', selected_pillars=[2, 1])
+        stopwords = stopwords_key(['een', 'de'])
+        key = cloud_task_key(params, 2, stopwords)
+
+        self.assertEqual(key, cloud_task_key(other, 2, stopwords_key(['de', 'een'])))
+        self.assertNotEqual(key, cloud_task_key(params, 2, stopwords_key(['een'])))
+        self.assertNotEqual(key, cloud_task_key(params, 3, stopwords))
+        self.assertNotEqual(key, cloud_task_key(params, 2, stopwords, stems=True))
+
+
+class SamplingTest(TestCase):
+    def test_top_terms(self):
+        counter = Counter({'de': 10, 'kaas': 5, 'melk': 3, 'boter': 1})
+        self.assertEqual(top_terms(counter, 2), ['de', 'kaas'])
+
+    def test_rank_change(self):
+        self.assertEqual(rank_change([], ['a', 'b']), 1.0)
+        self.assertEqual(rank_change(['a', 'b'], ['b', 'a']), 0.0)
+        self.assertEqual(rank_change(['a', 'c'], ['a', 'b']), 0.5)
+
+    def test_sampling_error(self):
+        counter = Counter({'a': 100, 'b': 25})
+        self.assertAlmostEqual(sampling_error(counter, ['a', 'b'], 50, 100),
+                               (0.5 ** 0.5 / 10 + 0.5 ** 0.5 / 5) / 2)
+        self.assertEqual(sampling_error(counter, ['c'], 50, 100), None)
+
+
+class TermVectorCacheTest(TestCase):
+    def test_encoding(self):
+        """
+        Tests that termvectors survive encoding and decoding.
+        """
+        terms = {u'kaas': 3, u'ze\xebn': 1, u'a' * 300: 70000}
+        self.assertEqual(decode_termvector(encode_termvector(terms)), terms)
+        self.assertEqual(decode_termvector(encode_termvector({})), {})
+
+
+class StemmingTest(TestCase):
+    def test_first_tokens(self):
+        """
+        Tests that tokens of a bulk _analyze request are mapped back to their words.
+        """
+        tokens = [{'token': u'kat', 'start_offset': 0, 'end_offset': 6},
+                  {'token': u'hond', 'start_offset': 10, 'end_offset': 16}]
+        stems = first_tokens([u'katten', u'de', u'honden'], tokens)
+        self.assertEqual(stems, {u'katten': u'kat', u'de': u'de', u'honden': u'hond'})
+
+    def test_lookup_cached(self):
+        """
+        Tests that stems found via a lookup are cached.
+        """
+        looked_up = []
+
+        def lookup(words):
+            looked_up.extend(words)
+            return {w: w[:3] for w in words}
+
+        words = [u'stemtest{}'.format(i) for i in range(3)]
+        self.assertEqual(es.get_stemmed_forms('index', words, lookup=lookup), {w: u'ste' for w in words})
+        self.assertEqual(es.get_stemmed_forms('index', words, lookup=lookup), {w: u'ste' for w in words})
+        self.assertEqual(sorted(looked_up), words)
+
+
+class DuplicateNewspapersTest(TestCase):
+    def test_hotfix_filter(self):
+        """
+        Tests that duplicate newspapers are excluded in filter context instead of the query string.
+        """
+        with self.settings(KB_HOTFIX_DUPLICATE_NEWSPAPERS=True, PROJECT_PARENT=mkdtemp()):
+            query = create_query('test', [], [], [], [])
+        self.assertEqual(query['query']['filtered']['query']['query_string']['query'], 'test')
+        self.assertIn({'prefix': {'identifier': 'ddd:11'}},
+                      query['query']['filtered']['filter']['bool']['must_not'])
+
+        with self.settings(KB_HOTFIX_DUPLICATE_NEWSPAPERS=False):
+            query = create_query('test', [], [], [], [])
+        self.assertEqual(query['query']['filtered']['filter']['bool']['must_not'], [])
+
+
+class QueryBuilderTest(TestCase):
+    def test_canonical_query(self):
+        """
+        Tests that equivalent parameters produce identical queries, and that callers receive copies.
+        """
+        dates = [{'lower': '1900-01-01', 'upper': '1910-12-31'}, {'lower': '1850-01-01', 'upper': '1860-12-31'}]
+        query = create_query('test', dates, ['sd_national', 'sd_antilles'], [], [])
+        query['aggs'] = {}
+
+        other = create_query('test', list(reversed(dates)), ['sd_antilles', 'sd_national'], [], [])
+        self.assertNotIn('aggs', other)
+        self.assertEqual(json.dumps(other, sort_keys=True),
+                         json.dumps(create_query('test', dates, ['sd_national', 'sd_antilles'], [], []),
+                                    sort_keys=True))
+
+    def test_bool_query(self):
+        """
+        Tests that bool queries with filter clauses are created for ES 2 and later.
+        """
+        dates = [{'lower': '1900-01-01', 'upper': '1910-12-31'}]
+        with self.settings(ELASTICSEARCH_VERSION=5, KB_HOTFIX_DUPLICATE_NEWSPAPERS=False):
+            query = create_query('test', dates, ['sd_national'], [], [])
+            body = hit_fields({'query': {}})
+
+        self.assertEqual(query['query']['bool']['must']['query_string']['query'], 'test')
+        self.assertEqual(query['query']['bool']['filter'],
+                         [{'bool': {'should': [{'range': {'paper_dc_date': {'gte': '1900-01-01',
+                                                                             'lte': '1910-12-31'}}}]}}])
+        self.assertEqual(len(query['query']['bool']['must_not']), 1)
+        self.assertEqual(body, {'query': {}, '_source': False})
+
+    def test_pillar_lookup(self):
+        """
+        Tests that pillars are filtered via terms lookups if a pillar index is configured.
+        """
+        with self.settings(ES_PILLAR_INDEX='pillars'):
+            query = create_query('test', [], [], [], [2, 1])
+        lookups = query['query']['filtered']['filter']['bool']['must'][0]['bool']['should']
+        self.assertEqual([l['terms']['paper_dc_identifier']['id'] for l in lookups], ['1', '2'])
+        self.assertEqual(lookups[0]['terms']['paper_dc_identifier']['index'], 'pillars')
+
+        # The memoized query depends on the pillar index
+        with self.settings(ES_PILLAR_INDEX=None):
+            query = create_query('test', [], [], [], [2, 1])
+        self.assertNotIn('pillars', json.dumps(query))
+
+
+class ProfilingTest(TestCase):
+    def test_es_operation(self):
+        self.assertEqual(es_operation('POST', '/kb/doc/_search'), '_search')
+        self.assertEqual(es_operation('GET', '/kb/doc/_validate/query?explain=true'), '_validate')
+        self.assertEqual(es_operation('GET', '/kb/doc/ddd:010'), 'get')
+
+    def test_trace(self):
+        """
+        Tests that finished traces are stored, and that only the latest traces are kept.
+        """
+        with self.settings(PROFILE_TRACE_LIMIT=2):
+            for i in range(3):
+                trace = start_trace('trace {}'.format(i))
+                trace.add_call('_search', 10.0, 4, 100)
+                finish_trace()
+
+        self.assertIsNone(current_trace())
+        self.assertEqual([t.name for t in ProfileTrace.objects.all()], ['trace 2', 'trace 1'])
+        self.assertEqual(ProfileTrace.objects.all()[0].took_ms, 4)
+
+
+class MetricsTest(TestCase):
+    def test_histogram_lines(self):
+        """
+        Tests that buckets are exported cumulatively, per combination of labels.
+        """
+        labels = format_labels({'view': 'services.views.search', 'method': 'GET'})
+        self.assertEqual(labels, 'method="GET",view="services.views.search"')
+
+        values = {labels + '|0': '2', labels + '|2': '1', labels + '|sum': '1.5'}
+        lines = _histogram_lines('duration', values, (.1, 1))
+        self.assertEqual(lines, [
+            'duration_bucket{method="GET",view="services.views.search",le="0.1"} 2',
+            'duration_bucket{method="GET",view="services.views.search",le="1"} 2',
+            'duration_bucket{method="GET",view="services.views.search",le="+Inf"} 3',
+            'duration_sum{method="GET",view="services.views.search"} 1.5',
+            'duration_count{method="GET",view="services.views.search"} 3',
+        ])
+
+    def test_recording(self):
+        """
+        Tests that the Elasticsearch requests of a request or task are aggregated until it ends.
+        """
+        with self.settings(METRICS_ENABLED=False):
+            begin_recording()
+            begin_recording()
+            recorder = current_recorder()
+            for wall in (0.001, 0.002, 0.5):
+                record_es_request('_search', wall, None, 100)
+            end_recording()
+            self.assertIs(current_recorder(), recorder)
+            self.assertEqual(recorder.counters[('texcavator_es_request_duration_seconds',
+                                                'operation="_search"|0')], 2)
+            self.assertAlmostEqual(recorder.sums[('texcavator_es_request_duration_seconds',
+                                                  'operation="_search"|sum')], 0.503)
+            end_recording()
+            self.assertIsNone(current_recorder())
+
+
+class BenchmarkTest(TestCase):
+    def test_summarize(self):
+        """
+        Tests the percentiles and throughput of a benchmark run.
+        """
+        summary = summarize([i / 1000.0 for i in range(1, 101)], 2.0)
+        self.assertAlmostEqual(summary['p50_ms'], 50)
+        self.assertAlmostEqual(summary['p99_ms'], 99)
+        self.assertAlmostEqual(summary['max_ms'], 100)
+        self.assertEqual(summary['throughput'], 50)
+        self.assertEqual(percentile([1.0], 95), 1.0)
+
+    def test_compare(self):
+        """
+        Tests that only increases above the tolerance count as regressions.
+        """
+        baseline = {'search': {'p50_ms': 10.0, 'p95_ms': 20.0, 'p99_ms': 40.0}}
+        results = {'search': {'p50_ms': 10.5, 'p95_ms': 30.0, 'p99_ms': 20.0},
+                   'count': {'p50_ms': 5.0, 'p95_ms': 5.0, 'p99_ms': 5.0}}
+        regressions = [(name, stat) for name, stat, _, _, _, regression in compare(results, baseline, 0.1)
+                       if regression]
+        self.assertEqual(regressions, [('search', 'p95_ms')])
+
+    def test_replay(self):
+        """
+        Tests that replayed calls are measured and their errors collected per endpoint.
+        """
+        def fail():
+            raise ValueError('invalid query')
+
+        calls = [('search', lambda: None)] * 5 + [('metadata', fail)] * 2
+        results, wall = replay(calls, concurrency=3, rate=1000, seed=0)
+        self.assertEqual(len(results['search']['latencies']), 5)
+        self.assertEqual(results['search']['errors'], [])
+        self.assertEqual(results['metadata']['latencies'], [])
+        self.assertEqual(results['metadata']['errors'], [u'ValueError: invalid query'] * 2)
+        self.assertGreater(wall, 0)
+
+    def test_sample_ids(self):
+        """
+        Tests that samples of document ids are distinct, complete when small and reproducible by seed.
+        """
+        DocID.objects.bulk_create([DocID(doc_id='doc{}'.format(i)) for i in range(50)])
+        sample = DocID.sample_ids(20, seed=1)
+        self.assertEqual(len(set(sample)), 20)
+        self.assertEqual(DocID.sample_ids(20, seed=1), sample)
+        self.assertEqual(len(set(DocID.sample_ids(20, seed=2))), 20)
+        self.assertEqual(sorted(DocID.sample_ids(100)), sorted(DocID.objects.values_list('doc_id', flat=True)))
+
+
+class GatherDocIdsTest(TestCase):
+    def setUp(self):
+        es._client = FakeElasticsearch.with_corpus(settings.ES_INDEX, settings.ES_DOCTYPE,
+                                                   generate_corpus(500, years=(1880, 1889)))
+
+    def tearDown(self):
+        es._client = None
+
+    def test_stratified_quotas(self):
+        """
+        Tests that quotas are proportional to the counts and add up exactly.
+        """
+        quotas = stratified_quotas({1900: 10, 1901: 10, 1902: 10}, 10)
+        self.assertEqual(sum(quotas.values()), 10)
+        self.assertEqual(sorted(quotas.values()), [3, 3, 4])
+        self.assertEqual(stratified_quotas({1900: 1, 1901: 99}, 50), {1900: 1, 1901: 49})
+
+    def test_gatherdocids(self):
+        """
+        Tests that exactly the requested number of document ids is stored, with or without stratification.
+        """
+        call_command('gatherdocids', '123', stratify=False, scroll_size=10, batch_size=25, stdout=StringIO())
+        self.assertEqual(DocID.objects.count(), 123)
+
+        call_command('gatherdocids', '100', parallel=3, scroll_size=7, stdout=StringIO())
+        docs = es._es().mget({'ids': list(DocID.objects.values_list('doc_id', flat=True))},
+                             index=settings.ES_INDEX)['docs']
+        years = Counter(doc['_source']['paper_dc_date'][:4] for doc in docs)
+        self.assertEqual(sum(years.values()), 100)
+        self.assertEqual(sorted(years), [str(year) for year in range(1880, 1890)])
+
+    def test_gatherdocids_write_error(self):
+        """
+        Tests that the command reports an error while writing, instead of waiting for the scans forever.
+        """
+        def fail(doc_ids):
+            raise ValueError('write failed')
+
+        num_threads = threading.active_count()
+        save_doc_ids = gatherdocids.save_doc_ids
+        gatherdocids.save_doc_ids = fail
+        try:
+            with self.assertRaises(ValueError):
+                call_command('gatherdocids', '400', parallel=2, scroll_size=5, batch_size=5, stdout=StringIO())
+        finally:
+            gatherdocids.save_doc_ids = save_doc_ids
+        self.assertEqual(threading.active_count(), num_threads)
+
+
+@override_settings(TERMVECTOR_CACHE_MAX_BYTES=0, KB_HOTFIX_DUPLICATE_NEWSPAPERS=False)
+class FakeElasticsearchTest(TestCase):
+    def setUp(self):
+        self.dates = [{'lower': '1850-01-01', 'upper': '1995-12-31'}]
+        es._client = FakeElasticsearch.with_corpus(settings.ES_INDEX, settings.ES_DOCTYPE, [
+            ('a', {'text_content': u'De oorlog en de vrede', 'paper_dc_date': '1914-08-01',
+                   'paper_dcterms_spatial': 'Landelijk'}),
+            ('b', {'text_content': u'De koningin bezocht de haven', 'paper_dc_date': '1920-05-01',
+                   'paper_dcterms_spatial': 'Suriname'}),
+            ('c', {'text_content': u'Vrede in de haven', 'paper_dc_date': '2001-01-01',
+                   'paper_dcterms_spatial': 'Landelijk'}),
+        ])
+
+    def tearDown(self):
+        es._client = None
+
+    def search(self, query, exclude_distributions=()):
+        valid, result = do_search(settings.ES_INDEX, settings.ES_DOCTYPE, query, 0, 10, self.dates,
+                                  exclude_distributions, [], [])
+        self.assertTrue(valid)
+        return sorted(hit['_id'] for hit in result['hits']['hits'])
+
+    def test_search(self):
+        """
+        Tests that query strings and filters are evaluated as by Elasticsearch.
+        """
+        self.assertEqual(self.search('vrede'), ['a'])
+        self.assertEqual(self.search('oorlog OR haven'), ['a', 'b'])
+        self.assertEqual(self.search('de AND -oorlog'), ['b'])
+        self.assertEqual(self.search('"de haven"'), ['b'])
+        self.assertEqual(self.search('kon*'), ['b'])
+        self.assertEqual(self.search('de', ['sd_surinam']), ['a'])
+        self.assertEqual(count_search_results(settings.ES_INDEX, settings.ES_DOCTYPE, 'de', self.dates,
+                                              [], [], [])['count'], 2)
+
+        valid, _ = do_search(settings.ES_INDEX, settings.ES_DOCTYPE, '(oorlog', 0, 10, self.dates, [], [], [])
+        self.assertFalse(valid)
+
+    def test_hit_fields(self):
+        """
+        Tests that the fields of hits are returned in the same way for ES 1.x and ES 5, whose stored_fields
+        would not contain the KB fields (as these are not stored).
+        """
+        for version in (1, 5):
+            with self.settings(ELASTICSEARCH_VERSION=version):
+                doc_ids = get_document_ids(settings.ES_INDEX, settings.ES_DOCTYPE, 'haven', self.dates)
+                _, result = do_search(settings.ES_INDEX, settings.ES_DOCTYPE, 'koningin', 0, 10, self.dates,
+                                      [], [], [])
+            self.assertEqual(sorted((d['identifier'], str(d['date'])) for d in doc_ids),
+                             [('b', '1920-05-01')])
+            self.assertEqual(result['hits']['hits'][0]['fields']['paper_dcterms_spatial'], ['Suriname'])
+            self.assertNotIn('_source', result['hits']['hits'][0])
+
+    def test_word_cloud(self):
+        """
+        Tests that word clouds are based on the termvectors of the documents.
+        """
+        result = single_document_word_cloud(settings.ES_INDEX, settings.ES_DOCTYPE, 'b')
+        self.assertEqual(result['result'], {u'de': 2, u'koningin': 1, u'bezocht': 1, u'haven': 1})
+
+    def test_corpus(self):
+        """
+        Tests that the synthetic corpus only depends on its seed.
+        """
+        self.assertEqual(list(generate_corpus(10, seed=1)), list(generate_corpus(10, seed=1)))
+        self.assertNotEqual(list(generate_corpus(10, seed=1)), list(generate_corpus(10, seed=2)))
+        self.assertEqual(len(set(doc_id for doc_id, _ in generate_corpus(100))), 100)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""Cache for the termvectors of documents.
+
+Documents are immutable once indexed, so their termvectors can be cached.
+Entries are keyed on the index generation, the set of fields and the document
+id. They are stored in Redis in a compact binary encoding. The cache keeps
+track of the size of its entries and evicts the least recently used entries
+when it exceeds TERMVECTOR_CACHE_MAX_BYTES.
+"""
+import struct
+import time
+import zlib
+
+from django.conf import settings
+
+from texcavator.utils import redis_client
+
+_PREFIX = 'texcavator:tv:'
+_LRU_KEY = _PREFIX + 'lru'
+_SIZES_KEY = _PREFIX + 'sizes'
+_BYTES_KEY = _PREFIX + 'bytes'
+
+# Sets entries (KEYS[4:], with ARGV[2:] as their data) at time ARGV[1], and
+# increases the total size (KEYS[3]) by the difference with their previous sizes
+_SET_MANY = """
+local added = 0
+for i = 4, #KEYS do
+    local data = ARGV[i - 2]
+    local old = tonumber(redis.call('hget', KEYS[2], KEYS[i])) or 0
+    redis.call('set', KEYS[i], data)
+    redis.call('zadd', KEYS[1], ARGV[1], KEYS[i])
+    redis.call('hset', KEYS[2], KEYS[i], #data)
+    added = added + #data - old
+end
+return redis.call('incrby', KEYS[3], added)
+"""
+
+_COUNT = struct.Struct('<I')
+_ENTRY = struct.Struct('<HI')  # length of the term, term frequency
+
+
+def encode_termvector(terms):
+    """
+    Encodes a dictionary that maps terms to frequencies as a compressed string.
+    """
+    parts = [_COUNT.pack(len(terms))]
+    for term, freq in terms.iteritems():
+        term = term.encode('utf-8')
+        parts.append(_ENTRY.pack(len(term), freq))
+        parts.append(term)
+    return zlib.compress(''.join(parts))
+
+
+def decode_termvector(data):
+    """
+    Decodes a string created by :func:`encode_termvector`.
+    """
+    data = zlib.decompress(data)
+    terms = {}
+    n, = _COUNT.unpack_from(data, 0)
+    offset = _COUNT.size
+    for _ in xrange(n):
+        length, freq = _ENTRY.unpack_from(data, offset)
+        offset += _ENTRY.size
+        terms[data[offset:offset + length].decode('utf-8')] = freq
+        offset += length
+    return terms
+
+
+class TermVectorCache(object):
+    """Cache for the termvectors of the documents in an index generation, for a set of fields."""
+
+    def __init__(self, generation, fields, max_bytes):
+        self.redis = redis_client(settings.TERMVECTOR_CACHE_REDIS_URL)
+        self.prefix = '{}{}:{}:'.format(_PREFIX, generation, ','.join(sorted(fields)))
+        self.max_bytes = max_bytes
+        self._set_many = self.redis.register_script(_SET_MANY)
+
+    def get_many(self, doc_ids):
+        """
+        Returns a dictionary with the cached termvectors for doc_ids.
+        Documents that are not in the cache are not included.
+        """
+        if not doc_ids:
+            return {}
+
+        keys = [self.prefix + doc_id for doc_id in doc_ids]
+        result = {}
+        now = time.time()
+        pipe = self.redis.pipeline(transaction=False)
+        for doc_id, key, data in zip(doc_ids, keys, self.redis.mget(keys)):
+            if data is not None:
+                result[doc_id] = decode_termvector(data)
+                pipe.zadd(_LRU_KEY, now, key)
+        pipe.execute()
+
+        return result
+
+    def set_many(self, termvectors):
+        """
+        Adds the termvectors in a dictionary (that maps document ids to
+        termvectors) to the cache, and evicts entries if necessary.
+        Entries that are already cached (e.g. set by a concurrent word cloud)
+        only count once towards the size of the cache.
+        """
+        if not termvectors:
+            return
+
+        keys = []
+        data = []
+        for doc_id, terms in termvectors.iteritems():
+            keys.append(self.prefix + doc_id)
+            data.append(encode_termvector(terms))
+        total = self._set_many(keys=[_LRU_KEY, _SIZES_KEY, _BYTES_KEY] + keys, args=[repr(time.time())] + data)
+
+        if total > self.max_bytes:
+            self.evict(total - self.max_bytes)
+
+    def evict(self, n_bytes, batch_size=100):
+        """
+        Removes the least recently used entries until n_bytes have been freed.
+        """
+        freed = 0
+        while freed < n_bytes:
+            keys = self.redis.zrange(_LRU_KEY, 0, batch_size - 1)
+            if not keys:
+                break
+            sizes = self.redis.hmget(_SIZES_KEY, keys)
+            size = sum(int(s) for s in sizes if s)
+
+            pipe = self.redis.pipeline()
+            pipe.delete(*keys)
+            pipe.zrem(_LRU_KEY, *keys)
+            pipe.hdel(_SIZES_KEY, *keys)
+            pipe.decrby(_BYTES_KEY, size)
+            pipe.execute()
+            freed += size
+
+
+def termvector_cache_enabled():
+    """
+    Returns whether the termvector cache is enabled (TERMVECTOR_CACHE_MAX_BYTES > 0).
+    The cache requires a dedicated Redis server (TERMVECTOR_CACHE_REDIS_URL), so that
+    it does not compete for memory with Celery's messages and results.
+    """
+    return getattr(settings, 'TERMVECTOR_CACHE_MAX_BYTES', 0) > 0 and \
+        bool(getattr(settings, 'TERMVECTOR_CACHE_REDIS_URL', None))
+
+
+def get_termvector_cache(generation, fields):
+    """
+    Returns the termvector cache for an index generation and a set of fields,
+    or None if caching is disabled.
+    """
+    if not termvector_cache_enabled():
+        return None
+    return TermVectorCache(generation, fields, settings.TERMVECTOR_CACHE_MAX_BYTES)
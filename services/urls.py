@@ -11,9 +11,11 @@ urlpatterns = [
     url(r'^export_cloud/$', export_cloud),
 
     url(r'^task_status/(?P<task_id>[\w-]+)$', check_status_by_task_id),
+    url(r'^task_events/(?P<task_id>[\w-]+)$', task_events),
     url(r'^cancel_task/(?P<task_id>[\w-]+)$', cancel_by_task_id),
 
     url(r'^kb/resolver/$', retrieve_kb_resolver),
+    url(r'^retrieve/$', retrieve_documents),
     url(r'^retrieve/(?P<doc_id>[-\w:]+)', retrieve_document),
     url(r'^search/$', search),
 
@@ -22,5 +24,7 @@ urlpatterns = [
 
     url(r'^metadata/$', metadata),
 
-    url(r'^stem/$', stemmed_form)
+    url(r'^stem/$', stemmed_form),
+
+    url(r'^metrics/$', metrics),
 ]
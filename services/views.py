@@ -1,35 +1,45 @@
 # -* coding: utf-8 -*-
 """Views for the services app
 """
+import json
 import logging
 from collections import Counter
 from sys import stderr, exc_info
 
 import requests
 from celery.result import AsyncResult
+from elasticsearch import TransportError
 
 from django.conf import settings
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.utils.html import escape
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import csrf_exempt
 from django.shortcuts import get_object_or_404
 
 from es import get_search_parameters, do_search, count_search_results, \
-    single_document_word_cloud, get_document, \
-    metadata_aggregation, get_stemmed_form
+    single_document_word_cloud, get_document, get_documents, \
+    metadata_aggregation, get_stemmed_forms, STEMMING_ANALYZER
 
+from texcavator.idf import IdfStoreMissing
 from texcavator.utils import json_response_message, daterange2dates, normalize_cloud
 
-from query.models import Query, StopWord, Newspaper
+from query.models import Query, Newspaper, Stem
+from query.stopwords import compile_stopwords, get_stopwords
 from query.utils import get_query_object
 
 from services.export import export_csv
-from services.tasks import generate_tv_cloud
+from services.metrics import export_metrics
+from services.profiling import current_trace
+from services.progress import subscribe_task_events, listen_task_events
+from services.tasks import start_tv_cloud, cancel_tv_cloud
 from services.elasticsearch_biland import elasticsearch_htmlresp
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of documents that can be retrieved in a single request
+MAX_RETRIEVE_DOCUMENTS = 100
+
 
 @login_required
 def search(request):
@@ -132,30 +142,12 @@ def tv_cloud(request):
     use_stopwords = request.GET.get('stopwords') == "1"
     use_default_stopwords = request.GET.get('stopwords_default') == "1"
     stems = request.GET.get('stems') == "1"
+    sample = request.GET.get('sample') == "1"
 
-    # Retrieve the stopwords
-    stopwords = []
+    # Compile the stopwords
+    stopwords_key = ''
     if use_stopwords:
-        stopwords_user = list(StopWord.objects
-                              .filter(user=request.user)
-                              .filter(query=None)
-                              .values_list('word', flat=True))
-
-        stopwords_query = []
-        if query_id:
-            stopwords_query = list(StopWord.objects
-                                   .filter(user=request.user)
-                                   .filter(query__id=query_id)
-                                   .values_list('word', flat=True))
-
-        stopwords_default = []
-        if use_default_stopwords:
-            stopwords_default = list(StopWord.objects
-                                     .filter(user=None)
-                                     .filter(query=None)
-                                     .values_list('word', flat=True))
-
-        stopwords = stopwords_user + stopwords_query + stopwords_default
+        stopwords_key = compile_stopwords(request.user, query_id, use_default_stopwords)
 
     record_id = request.GET.get('record_id')
     logger.info('services/cloud/ - record_id: {}'.format(record_id))
@@ -168,9 +160,12 @@ def tv_cloud(request):
                                               settings.ES_DOCTYPE,
                                               record_id,
                                               min_length,
-                                              stopwords,
+                                              get_stopwords(stopwords_key),
                                               stems)
-        normalized = normalize_cloud(t_vector['result'], idf_timeframe)
+        try:
+            normalized = normalize_cloud(t_vector['result'], idf_timeframe)
+        except IdfStoreMissing as e:
+            return json_response_message('ERROR', str(e))
         return json_response_message('ok', 'Word cloud generated', {'result': normalized})
     else:
         # Cloud for a query
@@ -184,10 +179,11 @@ def tv_cloud(request):
         if request.GET.get('is_timeline'):
             date_range = daterange2dates(request.GET.get('date_range'))
 
-        task = generate_tv_cloud.delay(params, min_length, stopwords, date_range, stems, idf_timeframe)
-        logger.info('services/cloud/ - Celery task id: {}'.format(task.id))
+        task_id = start_tv_cloud(params, min_length, stopwords_key, date_range, stems, idf_timeframe, sample,
+                                 profile=current_trace() is not None)
+        logger.info('services/cloud/ - Celery task id: {}'.format(task_id))
 
-        return json_response_message('ok', '', {'task': task.id})
+        return json_response_message('ok', '', {'task': task_id})
 
 
 @login_required
@@ -205,6 +201,8 @@ def check_status_by_task_id(request, task_id):
         if task.ready():
             if task.successful():
                 return json_response_message('ok', '', task.get())
+            elif isinstance(task.result, IdfStoreMissing):
+                return json_response_message('ERROR', str(task.result))
             else:
                 return json_response_message('ERROR', 'Generating word cloud failed.')
         else:
@@ -213,12 +211,51 @@ def check_status_by_task_id(request, task_id):
         return json_response_message('ERROR', 'Other error: {}'.format(str(e)))
 
 
+@login_required
+def task_events(request, task_id):
+    """
+    Streams the progress of the generate_tv_cloud task as server-sent events.
+
+    Sends a 'progress' event for every progress update and a single 'done'
+    event when the task has finished; the result itself can then be retrieved
+    via :func:`check_status_by_task_id`.
+    """
+    # Subscribe before checking the state, so no events are missed in between
+    pubsub = subscribe_task_events(task_id)
+    task = AsyncResult(task_id)
+
+    def event(name, data):
+        return 'event: {}\ndata: {}\n\n'.format(name, json.dumps(data))
+
+    def stream():
+        if task.ready():
+            pubsub.close()
+            yield event('done', {'state': task.status})
+            return
+
+        if task.status == 'PROGRESS':
+            yield event('progress', task.result)
+
+        for e in listen_task_events(pubsub):
+            if e is None:
+                yield ': keep-alive\n\n'
+            elif e['state'] == 'PROGRESS':
+                yield event('progress', e['meta'])
+            else:
+                yield event('done', {'state': e['state']})
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
 def cancel_by_task_id(request, task_id):
     """Cancel Celery task.
     """
     logger.info('services/cancel_task/{}'.format(task_id))
 
-    AsyncResult(task_id).revoke(terminate=True)
+    cancel_tv_cloud(task_id)
 
     return json_response_message('ok', '')
 
@@ -228,11 +265,57 @@ def retrieve_document(request, doc_id):
     """Retrieve a document from the ES index"""
     logger.info('services/retrieve/{}'.format(doc_id))
 
-    document = get_document(settings.ES_INDEX, settings.ES_DOCTYPE, doc_id)
+    try:
+        document = get_document(settings.ES_INDEX, settings.ES_DOCTYPE, doc_id)
+    except TransportError as e:
+        logger.error('services/retrieve/{} - {}'.format(doc_id, e))
+        return json_response_message('ERROR', 'Document could not be retrieved.')
 
     if document:
         return json_response_message('SUCCESS', '', document)
-    return json_response_message('ERROR', 'Document not found.')
+    return json_response_message('NOT_FOUND', 'Document not found.')
+
+
+@csrf_exempt
+@login_required
+def retrieve_documents(request):
+    """Retrieve multiple documents from the ES index in a single request.
+
+    Parameters (GET or POST):
+        ids: comma-separated document ids
+        fields (optional): comma-separated fields to return
+        text_length (optional): truncate the text of the documents to this
+            number of characters; 0 omits the text, which can be retrieved
+            later on via retrieve_document
+    """
+    doc_ids = [i for ids in request.REQUEST.getlist('ids') for i in ids.split(',') if i]
+    logger.info('services/retrieve/ - {} documents'.format(len(doc_ids)))
+
+    if not doc_ids:
+        return json_response_message('ERROR', 'No document ids provided.')
+    if len(doc_ids) > MAX_RETRIEVE_DOCUMENTS:
+        return json_response_message('ERROR', 'At most {} documents can be retrieved at once.'
+                                     .format(MAX_RETRIEVE_DOCUMENTS))
+
+    include = [f for f in request.REQUEST.get('fields', '').split(',') if f]
+    text_length = request.REQUEST.get('text_length')
+    text_length = int(text_length) if text_length else None
+    exclude = ['text_content'] if text_length == 0 else None
+
+    try:
+        documents = get_documents(settings.ES_INDEX, settings.ES_DOCTYPE, doc_ids, include, exclude)
+    except TransportError as e:
+        logger.error('services/retrieve/ - {}'.format(e))
+        return json_response_message('ERROR', 'Documents could not be retrieved.')
+
+    if text_length:
+        for doc_id, document in documents.iteritems():
+            text = document.get('text_content')
+            if text and len(text) > text_length:
+                documents[doc_id] = dict(document, text_content=text[:text_length], text_truncated=True)
+
+    missing = [doc_id for doc_id in doc_ids if doc_id not in documents]
+    return json_response_message('SUCCESS', '', {'documents': documents, 'missing': missing})
 
 
 @csrf_exempt
@@ -310,6 +393,19 @@ def download_scan_image(request):
     return response
 
 
+def metrics(request):
+    """
+    Returns the aggregated metrics in the Prometheus text format, to staff
+    users and the addresses in METRICS_ALLOWED_IPS (matched against REMOTE_ADDR,
+    so behind a proxy this is the address of the proxy).
+    """
+    allowed_ips = getattr(settings, 'METRICS_ALLOWED_IPS', ())
+    if not (request.user.is_staff or request.META.get('REMOTE_ADDR') in allowed_ips):
+        return HttpResponse('Forbidden', status=403)
+
+    return HttpResponse(export_metrics(), content_type='text/plain; version=0.0.4')
+
+
 @login_required
 def retrieve_kb_resolver(request):
     logger.info('services/kb/resolver/')
@@ -371,7 +467,20 @@ def metadata(request):
 @csrf_exempt
 @login_required
 def stemmed_form(request):
-    """Returns the stemmed form of a POSTed word"""
-    word = request.POST.get('word')
-    stemmed = get_stemmed_form(settings.ES_INDEX, word)
-    return json_response_message('success', 'Complete', {'stemmed': stemmed})
+    """Returns the stemmed form of a POSTed word, or of multiple POSTed words"""
+    words = request.POST.getlist('words')
+    if not words:
+        word = request.POST.get('word')
+        stemmed = get_stemmed_forms(settings.ES_INDEX, [word], lookup=lookup_stems)[word]
+        return json_response_message('success', 'Complete', {'stemmed': stemmed})
+
+    stems = get_stemmed_forms(settings.ES_INDEX, words, lookup=lookup_stems)
+    return json_response_message('success', 'Complete', {'stems': stems})
+
+
+def lookup_stems(words):
+    """Returns the precomputed stems (see the gatherstems command) for a list of words"""
+    return dict(Stem.objects
+                .filter(analyzer=STEMMING_ANALYZER)
+                .filter(word__in=words)
+                .values_list('word', 'stem'))
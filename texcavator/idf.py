@@ -0,0 +1,251 @@
+"""Read-only, memory-mapped store for inverse document frequencies.
+
+An IDF store is a single file that consists of:
+
+- a header with a magic string, a build version and the number of terms
+- an array of offsets (uint64) into the term blob, one per term plus one
+- an array of IDFs (float32), one per term
+- a blob with all terms (UTF-8), sorted bytewise
+
+The file is memory-mapped, so all web and Celery processes on a machine share
+the same pages via the page cache. Stores are written to a temporary file and
+then renamed, so a new build can replace an existing one while it is in use.
+
+Terms are looked up in batches: the first eight bytes of every term form a
+sorted array of keys, which numpy searches for all terms at once. Terms with a
+common prefix are narrowed down with the next eight bytes, and so on.
+
+Stores created before the IDF store existed (<timeframe>.dawg files) are
+converted on first use if DAWG is installed.
+"""
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+from django.conf import settings
+
+try:
+    import dawg
+except ImportError:
+    dawg = None
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = 'TXCIDF01'
+_HEADER = struct.Struct('<8sQQQ')  # magic, version, number of terms, blob size
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def _encode(term):
+    if isinstance(term, unicode):
+        return term.encode('utf-8')
+    return term
+
+
+def _prefix_keys(terms, level=0):
+    """Returns bytes 8 * level to 8 * level + 8 of the (encoded) terms as big-endian integers."""
+    if not terms:
+        return np.zeros(0, dtype='<u8')
+    padded = ''.join(term[8 * level:8 * level + 8].ljust(8, '\0') for term in terms)
+    return np.frombuffer(padded, dtype='>u8').astype('<u8')
+
+
+class IdfStoreMissing(IOError):
+    """Raised if there is no IDF store for a timeframe."""
+
+
+def write_idf_store(path, items, version=None):
+    """
+    Writes an IDF store to path.
+
+    Parameters:
+        path : str
+            The file to write to
+        items : iterable
+            (term, idf) tuples
+        version : int, optional
+            The build version; defaults to the current time in milliseconds
+
+    Returns:
+        version : int
+            The build version that was written
+    """
+    if version is None:
+        version = int(time.time() * 1000)
+
+    items = sorted((_encode(term), idf) for term, idf in items)
+
+    offsets = np.zeros(len(items) + 1, dtype='<u8')
+    offsets[1:] = np.cumsum([len(term) for term, _ in items])
+    idfs = np.array([idf for _, idf in items], dtype='<f4')
+    blob = ''.join(term for term, _ in items)
+
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as out:
+        out.write(_HEADER.pack(_MAGIC, version, len(items), len(blob)))
+        out.write(offsets.tostring())
+        out.write(idfs.tostring())
+        out.write(blob)
+    os.rename(tmp_path, path)
+
+    return version
+
+
+def read_idf_store_version(path):
+    """
+    Returns the build version in the header of the IDF store at path.
+    """
+    with open(path, 'rb') as in_file:
+        header = in_file.read(_HEADER.size)
+    magic, version, _, _ = _HEADER.unpack(header)
+    if magic != _MAGIC:
+        raise ValueError('{} is not an IDF store'.format(path))
+    return version
+
+
+class IdfStore(object):
+    """A memory-mapped IDF store; see the module documentation for the format."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as in_file:
+            self._mmap = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.version, self._size, _ = _HEADER.unpack_from(self._mmap, 0)
+        if magic != _MAGIC:
+            raise ValueError('{} is not an IDF store'.format(path))
+
+        offset = _HEADER.size
+        self._offsets = np.frombuffer(self._mmap, dtype='<u8', count=self._size + 1, offset=offset)
+        offset += self._offsets.nbytes
+        self._idfs = np.frombuffer(self._mmap, dtype='<f4', count=self._size, offset=offset)
+        self._blob = offset + self._idfs.nbytes
+        self._keys = self._term_keys(np.arange(self._size), 0)
+
+    def __len__(self):
+        return self._size
+
+    def _term(self, i):
+        return self._mmap[self._blob + int(self._offsets[i]):self._blob + int(self._offsets[i + 1])]
+
+    def _term_keys(self, indices, level):
+        """Returns bytes 8 * level to 8 * level + 8 of the terms at indices as big-endian integers (padded with zeros).
+        As the terms are sorted bytewise, the keys of any level are sorted within terms with equal keys of the
+        previous levels."""
+        keys = np.zeros(len(indices), dtype='<u8')
+        blob_size = int(self._offsets[-1])
+        if not blob_size:
+            return keys
+        blob = np.frombuffer(self._mmap, dtype='u1', count=blob_size, offset=self._blob)
+        starts = self._offsets[indices] + np.uint64(8 * level)
+        lengths = self._offsets[indices + 1] - self._offsets[indices]
+        for i in range(8):
+            position = np.minimum(starts + np.uint64(i), np.uint64(blob_size - 1))
+            byte = np.where(lengths > 8 * level + i, blob[position], 0)
+            keys = (keys << np.uint64(8)) | byte.astype('<u8')
+        return keys
+
+    def _search(self, lows, highs, keys, level, side):
+        """Binary search (vectorized) for keys of a level in the ranges lows..highs."""
+        while True:
+            active = lows < highs
+            if not active.any():
+                return lows
+            middles = (lows + highs) // 2
+            term_keys = self._term_keys(middles[active], level)
+            below = np.zeros(len(lows), dtype=bool)
+            below[active] = term_keys < keys[active] if side == 'left' else term_keys <= keys[active]
+            lows = np.where(active & below, middles + 1, lows)
+            highs = np.where(active & ~below, middles, highs)
+
+    def get(self, term, default=None):
+        """
+        Returns the IDF for a term, or default if the term is not in the store.
+        """
+        return self.get_many([term], default)[0]
+
+    def get_many(self, terms, default=None):
+        """
+        Returns the IDFs for a list of terms (default for terms that are not in the store).
+        """
+        keys = [_encode(term) for term in terms]
+        if not keys:
+            return []
+
+        lows = np.searchsorted(self._keys, _prefix_keys(keys), side='left')
+        highs = np.searchsorted(self._keys, _prefix_keys(keys), side='right')
+
+        # Narrow down the terms with a common prefix with the next eight bytes, and so on
+        level = 1
+        ambiguous = np.flatnonzero(highs - lows > 1)
+        while len(ambiguous):
+            level_keys = _prefix_keys([keys[i] for i in ambiguous], level)
+            lo, hi = lows[ambiguous], highs[ambiguous]
+            lows[ambiguous] = self._search(lo, hi, level_keys, level, 'left')
+            highs[ambiguous] = self._search(lo, hi, level_keys, level, 'right')
+            ambiguous = ambiguous[highs[ambiguous] - lows[ambiguous] > 1]
+            level += 1
+
+        # Compare the remaining candidates in full
+        found = (highs > lows).tolist()
+        candidates = np.minimum(lows, max(self._size - 1, 0))
+        starts = (self._offsets[candidates] + np.uint64(self._blob)).tolist() if self._size else [0] * len(keys)
+        ends = (self._offsets[candidates + 1] + np.uint64(self._blob)).tolist() if self._size else [0] * len(keys)
+        idfs = self._idfs[candidates].tolist() if self._size else [default] * len(keys)
+
+        result = []
+        for key, ok, start, end, idf in zip(keys, found, starts, ends, idfs):
+            result.append(idf if ok and self._mmap[start:end] == key else default)
+        return result
+
+
+def idf_store_path(timeframe):
+    """
+    Returns the location of the IDF store for a timeframe.
+    """
+    return os.path.join(settings.PROJECT_PARENT, timeframe + '.idf')
+
+
+def convert_dawg(timeframe):
+    """
+    Converts the <timeframe>.dawg file of an earlier build to an IDF store.
+    Returns whether the file was converted.
+    """
+    dawg_path = os.path.join(settings.PROJECT_PARENT, timeframe + '.dawg')
+    if dawg is None or not os.path.exists(dawg_path):
+        return False
+
+    d = dawg.RecordDAWG('<d')
+    d.load(dawg_path)
+    write_idf_store(idf_store_path(timeframe), ((term, idf[0]) for term, idf in d.iteritems()))
+    logger.warning('Converted %s to an IDF store', dawg_path)
+    return True
+
+
+def get_idf_store(timeframe):
+    """
+    Returns the IDF store for a timeframe.
+
+    The store is opened once per process. If a new build has been written since
+    (detected via the version header), the new build is opened instead.
+    Raises IdfStoreMissing if there is no store (nor a .dawg file to convert).
+    """
+    path = idf_store_path(timeframe)
+    if not os.path.exists(path) and not convert_dawg(timeframe):
+        raise IdfStoreMissing('There are no inverse document frequencies for timeframe "{}" ({} does not exist); '
+                              'run python manage.py gathertermcounts'.format(timeframe, path))
+    version = read_idf_store_version(path)
+
+    with _stores_lock:
+        store = _stores.get(timeframe)
+        if store is None or store.version != version:
+            store = IdfStore(path)
+            _stores[timeframe] = store
+
+    return store
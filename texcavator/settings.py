@@ -12,6 +12,8 @@ https://docs.djangoproject.com/en/1.7/ref/settings/
 import os
 import sys
 
+from kombu import Queue
+
 try:
     from settings_local import *
 except ImportError:
@@ -52,6 +54,9 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 
     'django.contrib.flatpages.middleware.FlatpageFallbackMiddleware',
+
+    'services.profiling.ProfilingMiddleware',
+    'services.metrics.MetricsMiddleware',
 )
 
 ROOT_URLCONF = 'texcavator.urls'
@@ -92,13 +97,34 @@ TEMPLATE_DIRS = (
 # Test settings
 TEST_RUNNER = 'django_nose.NoseTestSuiteRunner'
 
+# Redis settings (used by Celery and for publishing task progress)
+REDIS_URL = 'redis://localhost:6379/0'
+
 # Celery settings
-BROKER_URL = 'redis://localhost:6379/0'
-CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
+BROKER_URL = REDIS_URL
+CELERY_RESULT_BACKEND = REDIS_URL
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 
+# Short, interactive tasks and long-running bulk tasks are handled by separate workers (see README),
+# so a large word cloud or export does not block other users. Word clouds are routed on enqueue,
+# depending on their number of documents (CELERY_INTERACTIVE_MAX_DOCUMENTS).
+CELERY_INTERACTIVE_QUEUE = 'interactive'
+CELERY_BULK_QUEUE = 'bulk'
+CELERY_DEFAULT_QUEUE = CELERY_INTERACTIVE_QUEUE
+CELERY_QUEUES = (
+    Queue(CELERY_INTERACTIVE_QUEUE, routing_key=CELERY_INTERACTIVE_QUEUE),
+    Queue(CELERY_BULK_QUEUE, routing_key=CELERY_BULK_QUEUE),
+)
+CELERY_ROUTES = {
+    'query.tasks.write_newspaper_classification': {'queue': CELERY_BULK_QUEUE},
+    'query.tasks.write_pillar_index': {'queue': CELERY_BULK_QUEUE},
+    'query.tasks.zipquerydata': {'queue': CELERY_BULK_QUEUE},
+}
+# Only reserve one task at a time, so long tasks don't hold up tasks waiting behind them
+CELERYD_PREFETCH_MULTIPLIER = 1
+
 # Logging settings
 # Taken from http://ianalexandr.com/blog/getting-started-with-django-logging-in-5-minutes.html
 LOGGING = {
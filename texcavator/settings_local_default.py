@@ -30,8 +30,17 @@ ELASTICSEARCH_PORT = 9200
 ELASTICSEARCH_USERNAME = None
 ELASTICSEARCH_PASSWORD = None
 ELASTICSEARCH_USE_SSL = False
+# Major version of Elasticsearch; determines the query DSL (filtered queries before 2, stored_fields from 5)
+ELASTICSEARCH_VERSION = 1
 ES_INDEX = 'kb'
 ES_DOCTYPE = 'doc'
+# Index that holds the newspapers per pillar, referenced by terms lookups in queries.
+# If None, the newspaper ids are sent with every query. Run the syncpillars command after enabling.
+ES_PILLAR_INDEX = None
+# Use an in-process stand-in for Elasticsearch with this many synthetic documents instead of a cluster
+# (see services.fake_es), e.g. for tests and benchmarks. 0 uses the cluster.
+ES_FAKE_DOCUMENTS = 0
+ES_FAKE_SEED = 0
 
 # Query settings
 QUERY_ALLOW_LEADING_WILDCARD = False
@@ -43,6 +52,9 @@ QUERY_DATA_DOWNLOAD_PATH = os.path.join(PROJECT_GRANNY,
 QUERY_DATA_MAX_RESULTS = 100000     # max no. of documents to be exported
 QUERY_DATA_UNPRIV_RESULTS = 10000   # no. of documents to be exported for lesser privileged users
 QUERY_DATA_CHUNK_SIZE = 1000		# no. of documents from ES with 1 query
+QUERY_DATA_SPLIT_MB = 0             # split JSON Lines and XML exports into files of at most this size (0: a single file)
+QUERY_DATA_COMPRESSION_LEVEL = 6    # compression level of export archives (zlib: 1-9, zstd: 1-22)
+QUERY_DATA_COMPRESSION_WORKERS = 4  # no. of threads that compress an export archive
 QUERY_DATA_DELETE_DATA = True		# delete query download data
 QUERY_DATA_EXPIRE_DAYS = 1			# delete after one day
 
@@ -76,8 +88,53 @@ LOGIN_REDIRECT_URL = '/'
 WORDCLOUD_MIN_WORDS = 1
 WORDCLOUD_MAX_WORDS = 200
 
+# Number of seconds identical word cloud requests share a single Celery task (0 to disable)
+WORDCLOUD_DEDUPLICATION_TTL = 600
+
+# Sampled word clouds: the minimal number of documents in a sample, and the maximal fraction of
+# words in the word cloud that may still change before sampling stops
+WORDCLOUD_SAMPLE_MIN_SIZE = 5000
+WORDCLOUD_SAMPLE_THRESHOLD = 0.05
+
+# Word clouds for more documents than this are generated by the bulk Celery workers
+CELERY_INTERACTIVE_MAX_DOCUMENTS = 10000
+
+# Number of seconds between preliminary word clouds sent while a word cloud is generated (0 to disable)
+WORDCLOUD_INTERIM_INTERVAL = 5
+
+# Maximum size in bytes of the Redis cache for document termvectors (0 to disable), and the Redis
+# server to use. The cache is only enabled with a dedicated Redis server (not the Celery broker in
+# REDIS_URL), configured without persistence, e.g. 'redis://localhost:6380/0'.
+TERMVECTOR_CACHE_MAX_BYTES = 0
+TERMVECTOR_CACHE_REDIS_URL = None
+
+# Number of recently retrieved documents kept in memory per process (0 to disable)
+DOCUMENT_CACHE_SIZE = 500
+
+# Number of compiled stopword sets kept in memory per process
+STOPWORDS_CACHE_SIZE = 100
+
+# Number of stemmed words kept in memory per process
+STEM_CACHE_SIZE = 10000
+
+# Number of built Elasticsearch queries kept in memory per process
+QUERY_CACHE_SIZE = 1000
+
+# Profiling (see services.profiling): the number of traces kept, and whether Elasticsearch supports
+# the profile API (version 5 and later)
+PROFILE_TRACE_LIMIT = 500
+ES_PROFILE_API = False
+
+# Request-level metrics (see services.metrics), aggregated in Redis and exposed in the Prometheus
+# text format at /services/metrics/ to staff users and the listed addresses of scrapers, which are
+# matched against REMOTE_ADDR. Behind a reverse proxy REMOTE_ADDR is the proxy, so only list addresses
+# that reach the application directly, e.g. ('10.0.0.5',), or block /services/metrics/ in the proxy.
+METRICS_ENABLED = True
+METRICS_ALLOWED_IPS = ()
+
 # Temporary setting for whether or not stemming is available
 STEMMING_AVAILABLE = True
 
-# Temporary setting for whether or not the hotfix for duplicate newspapers should be used
+# Temporary setting for whether or not the hotfix for duplicate newspapers should be used.
+# Run the resolveduplicates command to turn the hotfix into a cached filter on newspaper ids.
 KB_HOTFIX_DUPLICATE_NEWSPAPERS = True
@@ -12,6 +12,7 @@ var stopwordsSave		= function( word, stopwords_cat )
 var clearCloud			= function()
 var placeCloudInTarget	= function( cloud_src, data, target )
 var wordCloudClicked	= function( event )
+var prefetchStems		= function( words )
 var d3CreateCloud		= function( cloud_src, svg_width, svg_height, weightFactor, 
 		text_size_list, text_count_hash, text_type_hash, text_color_hash )
 function destroyDlgCloudword()
@@ -37,6 +38,7 @@ var getCloudParameters = function( params )
 	else { params.words = 1; }							// all words cloud
 
 	if( cloudcfg.stems ) { params.stems = 1; }
+	if( cloudcfg.sample ) { params.sample = 1; }
 	if (cloudcfg.idf) {
 		params.idf_timeframe = $(".idf-timeframe input:checked").val();
 	}
@@ -491,6 +493,24 @@ var wordCloudClicked = function( event )
 }
 
 
+// Stemmed forms of cloud words, by word
+var stem_cache = {};
+
+var prefetchStems = function( words )
+{
+	words = words.filter( function( w ) { return stem_cache[ w ] === undefined; } );
+	if( words.length === 0 ) { return; }
+
+	dojo.xhrPost({
+		url: "services/stem/",
+		handleAs: "json",
+		content: { "words": words },
+		load: function( response ) { dojo.mixin( stem_cache, response.stems ); },
+		error: function( err ) { console.warn( err ); }
+	});
+}
+
+
 // =============================================================================
 var d3CreateCloud = function( target, cloud_src, svg_width, svg_height, weightFactor, 
 	text_size_list, text_count_hash, text_tfidf_hash, text_type_hash, text_color_hash )
@@ -518,6 +538,10 @@ var d3CreateCloud = function( target, cloud_src, svg_width, svg_height, weightFa
 		return { text: d[ 0 ], size: Math.round( weightFactor * d[ 1 ] ) }; 
 	});
 
+	// Retrieve the stemmed forms of all words at once, for the mouseover
+	if( !config.cloud.stems )
+	{ prefetchStems( text_size_list.map( function( d ) { return d.text; } ) ); }
+
 	var fontSize = d3.scale.log().range( [ 10, 100 ] );
 
 	var layout = d3.layout.cloud()
@@ -581,14 +605,18 @@ var d3CreateCloud = function( target, cloud_src, svg_width, svg_height, weightFa
 			// Show stemmed form if we're not showing the stemmed cloud
 			if (!config.cloud.stems)
 			{
-				dojo.xhrPost({
-					url: "services/stem/",
-					handleAs: "json",
-					content: { "word": word.text },
-					sync: true
-				}).then(function(response) {
-					result += ", <u>stemmed</u>: <b>" + response.stemmed + "</b>"; 
-				});
+				if (stem_cache[word.text] === undefined)
+				{
+					dojo.xhrPost({
+						url: "services/stem/",
+						handleAs: "json",
+						content: { "word": word.text },
+						sync: true
+					}).then(function(response) {
+						stem_cache[word.text] = response.stemmed;
+					});
+				}
+				result += ", <u>stemmed</u>: <b>" + stem_cache[word.text] + "</b>"; 
 			}
 
 			result += "</center>";
@@ -59,6 +59,7 @@ var config = {
 		fontscale: 75, // font scale factor
 		fontreduce: true, // reduce fontsize differences
 		stems: false, // apply stemming
+		sample: true, // approximate large clouds using a random sample of documents
 		idf: false, // normalize using inverse document frequencies
 
 		NER: false, // Named Entity Recognition
@@ -79,8 +80,10 @@ var config = {
 	},
 
 	querydataexport: { // query data
-		format: "csv", // "json", "xml", or "csv"
-		simplified: false
+		format: "csv", // "json", "jsonl", "xml", or "csv"
+		archive: "zip", // "zip", "tar.gz" or "tar.zst"
+		simplified: false,
+		metadata_only: false
 	}
 };
 
@@ -738,6 +741,24 @@ var createConfig = function() {
 		innerHTML: "&nbsp;Stemming<br/>"
 	}, cpCloud.domNode);
 
+	var divSample = dojo.create("div", {
+		id: "div-sample"
+	}, cpCloud.domNode);
+
+	var cbSample = new dijit.form.CheckBox({
+		id: "cb-sample",
+		checked: config.cloud.sample,
+		onChange: function(btn) {
+			config.cloud.sample = btn;
+		}
+	}, divSample);
+
+	var labelSample = dojo.create("label", {
+		id: "label-sample",
+		for: "cb-sample",
+		innerHTML: "&nbsp;Approximate large clouds using a sample of documents (faster)<br/>"
+	}, cpCloud.domNode);
+
 	var divIdf = dojo.create("div", {
 		id: "div-idf"
 	}, cpCloud.domNode);
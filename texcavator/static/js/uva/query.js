@@ -247,6 +247,25 @@ function createQueryDlg() {
 		innerHTML: "&nbsp;JSON (native format)<br/>"
 	}, cpQData.domNode);
 
+	var jsonlformat_val = config.querydataexport.format === "jsonl";
+
+	var rbQDataJSONL = new dijit.form.RadioButton({
+		id: "rb-qdata-jsonl",
+		checked: jsonlformat_val,
+		onChange: function(btn) {
+			if (btn) {
+				config.querydataexport.format = "jsonl";
+			}
+		},
+	});
+	rbQDataJSONL.placeAt(cpQData.domNode);
+
+	var labelQDataJSONL = dojo.create("label", {
+		id: "label-qdata-jsonl",
+		for: "rb-qdata-jsonl",
+		innerHTML: "&nbsp;JSON Lines (one document per line, in a single file)<br/>"
+	}, cpQData.domNode);
+
 
 	var xmlformat_val = config.querydataexport.format === "xml";
 
@@ -264,7 +283,7 @@ function createQueryDlg() {
 	var labelQueryDataFormatXML = dojo.create("label", {
 		id: "label-qdata-xml",
 		for: "rb-qdata-xml",
-		innerHTML: "&nbsp;XML (slow! conversion)<br/>"
+		innerHTML: "&nbsp;XML (in a single file)<br/>"
 	}, cpQData.domNode);
 
 	var csvformat_val = config.querydataexport.format === "csv";
@@ -286,6 +305,37 @@ function createQueryDlg() {
 		innerHTML: "&nbsp;CSV (TAB delimited)<br/>"
 	}, cpQData.domNode);
 
+	// Archive format
+	var textQDataArchive = dojo.create("label", {
+		id: "text-qdata-archive",
+		innerHTML: "Archive: <br/>"
+	}, cpQData.domNode);
+
+	var archiveFormats = [
+		["zip", "ZIP (Windows-friendly)"],
+		["tar.gz", "tar.gz"],
+		["tar.zst", "tar.zst (zstd, if available on the server)"]
+	];
+	dojo.forEach(archiveFormats, function(archive) {
+		var rbId = "rb-qdata-archive-" + archive[0].replace(".", "-");
+		var rbQDataArchive = new dijit.form.RadioButton({
+			id: rbId,
+			name: "qdata-archive",
+			checked: config.querydataexport.archive === archive[0],
+			onChange: function(btn) {
+				if (btn) {
+					config.querydataexport.archive = archive[0];
+				}
+			},
+		});
+		rbQDataArchive.placeAt(cpQData.domNode);
+
+		dojo.create("label", {
+			for: rbId,
+			innerHTML: "&nbsp;" + archive[1] + "<br/>"
+		}, cpQData.domNode);
+	});
+
 	// Simplified export
 	var divSimplifiedExport = dojo.create("div", {
 		id: "div-simplified-export"
@@ -305,6 +355,25 @@ function createQueryDlg() {
 		innerHTML: "&nbsp;Simplified export (only article title and full text)<br/>"
 	}, cpQData.domNode);
 
+	// Metadata-only export
+	var divMetadataOnlyExport = dojo.create("div", {
+		id: "div-metadata-only-export"
+	}, cpQData.domNode);
+
+	var cbMetadataOnlyExport = new dijit.form.CheckBox({
+		id: "cb-metadata-only-export",
+		checked: config.querydataexport.metadata_only,
+		onChange: function(btn) {
+			config.querydataexport.metadata_only = btn;
+		}
+	}, divMetadataOnlyExport);
+
+	var labelMetadataOnlyExport = dojo.create("label", {
+		id: "label-metadata-only-export",
+		for: "cb-metadata-only-export",
+		innerHTML: "&nbsp;Metadata only (without the full text)<br/>"
+	}, cpQData.domNode);
+
 
 	// fill the query list
 	var queryListStoreData = new dojo.store.Memory({
@@ -472,8 +541,10 @@ function okDownload(query_title) {
 	var params = {
 		collection: ES_INDEX,
 		query_title: query_title,
-		format: config.querydataexport.format, // "json", "xml" or "csv"
-		simplified: config.querydataexport.simplified
+		format: config.querydataexport.format, // "json", "jsonl", "xml" or "csv"
+		archive: config.querydataexport.archive, // "zip", "tar.gz" or "tar.zst"
+		simplified: config.querydataexport.simplified,
+		metadata_only: config.querydataexport.metadata_only
 	};
 
 	dojo.xhrGet({
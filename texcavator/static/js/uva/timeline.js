@@ -571,9 +571,9 @@ function burstCloud(params) {
 		console.error(err);
 	}).then(function(task_id) {
 		if (task_id) {
-			console.log("Start polling!");
+			console.log("Start listening!");
 			console.log("task_id: " + task_id);
-			check_status(task_id);
+			listen_status(task_id);
 		} else {
 			console.log('No task_id returned');
 		}
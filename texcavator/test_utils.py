@@ -1,9 +1,13 @@
 """Tests for the Texcavator utility functions"""
 import os
-from nose.tools import assert_equals
+import shutil
+import tempfile
+from nose.tools import assert_equals, assert_almost_equals, assert_raises
 
 from django.conf import settings
+from django.test.utils import override_settings
 
+import texcavator.idf as idf
 import texcavator.utils as utils
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "texcavator.settings")
@@ -51,3 +55,79 @@ def test_flip_dict():
     example = {'1': 'one', '2': 'two'}
     result = utils.flip_dict(example)
     assert_equals(result, {'one': '1', 'two': '2'})
+
+
+def test_idf_store():
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'test.idf')
+        version = idf.write_idf_store(path, [(u'test', 0.5), (u'een', 1.5), (u'\xe9\xe9n', 2.0)], version=42)
+        assert_equals(version, 42)
+        assert_equals(idf.read_idf_store_version(path), 42)
+
+        store = idf.IdfStore(path)
+        assert_equals(len(store), 3)
+        assert_almost_equals(store.get(u'test'), 0.5)
+        assert_almost_equals(store.get(u'een'), 1.5)
+        assert_almost_equals(store.get(u'\xe9\xe9n'), 2.0)
+        assert_equals(store.get(u'dit'), None)
+        assert_almost_equals(utils.tfidf(store, u'dit', 3), 3)
+        assert_almost_equals(utils.tfidf(store, u'test', 3), 1.5)
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_idf_store_get_many():
+    directory = tempfile.mkdtemp()
+    try:
+        # Terms that share (or are) prefixes of eight bytes
+        terms = [u'a', u'aa', u'verkiezing', u'verkiezingen', u'verkiezingsuitslag', u'verkiez', u'verkiezi',
+                 u'z' * 20, u'\xe9\xe9n']
+        path = os.path.join(directory, 'test.idf')
+        idf.write_idf_store(path, [(t, float(i)) for i, t in enumerate(terms)])
+        store = idf.IdfStore(path)
+
+        queries = terms + [u'', u'b', u'verkiezin', u'verkiezingenx', u'z' * 19]
+        expected = range(len(terms)) + [None] * 5
+        assert_equals(store.get_many(queries), expected)
+        assert_equals(store.get_many([]), [])
+        assert_equals(store.get(u'verkiezingen'), 3.0)
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_idf_store_missing():
+    directory = tempfile.mkdtemp()
+    try:
+        with override_settings(PROJECT_PARENT=directory):
+            assert_raises(idf.IdfStoreMissing, idf.get_idf_store, 'pre')
+
+            if idf.dawg is not None:
+                d = idf.dawg.RecordDAWG('<d', [(u'een', (1.5, )), (u'test', (0.5, ))])
+                d.save(os.path.join(directory, 'pre.dawg'))
+                store = idf.get_idf_store('pre')
+                assert_equals(store.get_many([u'test', u'een', u'dit']), [0.5, 1.5, None])
+                assert os.path.exists(os.path.join(directory, 'pre.idf'))
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_lru_cache():
+    cache = utils.LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert_equals(cache.get('a'), 1)
+
+    # 'b' is now the least recently used item
+    cache.set('c', 3)
+    assert_equals(cache.get('b'), None)
+    assert_equals(cache.get('a'), 1)
+    assert_equals(cache.get('c'), 3)
+    assert_equals(len(cache), 2)
+
+
+def test_redis_client():
+    # No connection is made until a command is sent
+    client = utils.redis_client('redis://localhost:6379/0')
+    assert client is utils.redis_client('redis://localhost:6379/0')
+    assert client is not utils.redis_client('redis://localhost:6379/1')
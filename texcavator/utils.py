@@ -1,13 +1,19 @@
 """Utility functions for the Texcavator app"""
-import os
+import threading
+from collections import OrderedDict
 from datetime import datetime
 from itertools import izip
 
-import dawg
+import redis
 
 from django.http import JsonResponse
 from django.conf import settings
 
+from texcavator.idf import get_idf_store
+
+_redis_clients = {}
+_redis_clients_lock = threading.Lock()
+
 
 def chunks(l, n):
     """
@@ -73,6 +79,54 @@ def json_response_message(status, message, params=None):
     return JsonResponse(response)
 
 
+def redis_client(url=None):
+    """
+    Returns a client for the Redis server at url (defaults to REDIS_URL).
+
+    There is one client (and so one connection pool) per url per process; the
+    clients are thread-safe, and their pools reconnect after a fork.
+    """
+    url = url or settings.REDIS_URL
+    with _redis_clients_lock:
+        client = _redis_clients.get(url)
+        if client is None:
+            client = redis.StrictRedis.from_url(url)
+            _redis_clients[url] = client
+    return client
+
+
+class LRUCache(object):
+    """
+    A thread-safe, in-process cache that holds the max_size most recently used items.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value
+            return value
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+
 def flip_dict(dictionary):
     """
     Returns a new dict in which the keys and values have switched roles.
@@ -91,9 +145,11 @@ def normalize_cloud(cloud_data, idf_timeframe=''):
     """
     # If IDF is set, multiply term frequencies by inverse document frequencies
     if idf_timeframe:
-        d = dawg.RecordDAWG('<d')
-        d.load(os.path.join(settings.PROJECT_PARENT, idf_timeframe + '.dawg'))
-        result = [{'term': t, 'count': c, 'tfidf': round(tfidf(d, t, c), 2)} for t, c in cloud_data.items()]
+        store = get_idf_store(idf_timeframe)
+        terms = cloud_data.keys()
+        idfs = store.get_many(terms, 1.0)
+        result = [{'term': t, 'count': cloud_data[t], 'tfidf': round(cloud_data[t] * idf, 2)}
+                  for t, idf in zip(terms, idfs)]
         result = sorted(result, key=lambda k: k['tfidf'], reverse=True)
     else:
         result = [{'term': t, 'count': c} for t, c in cloud_data.items()]
@@ -102,10 +158,9 @@ def normalize_cloud(cloud_data, idf_timeframe=''):
     return result[:settings.WORDCLOUD_MAX_WORDS]
 
 
-def tfidf(dawg, word, frequency):
-    try:
-        t = dawg[word][0][0]
-        frequency *= t
-    except KeyError:
-        pass
-    return frequency
+def tfidf(store, word, frequency):
+    """
+    Returns the frequency multiplied by the inverse document frequency of word in the IDF store.
+    Words that are not in the store are not weighted.
+    """
+    return frequency * store.get(word, 1.0)